@@ -0,0 +1,190 @@
+"""Batching separate ``get_*`` calls into one GetThings request.
+
+Application code tends to ask for one kind of thing at a time::
+
+    weights = conn.get_weight_measurements(min_date=week_ago)
+    heights = conn.get_height_measurements(max=1)
+    devices = conn.get_devices()
+
+which is three round trips to HealthVault. In a :py:class:`Batch` the same calls return
+:py:class:`Future` objects instead, and are all sent in one
+:py:meth:`healthvaultlib.healthvault.HealthVaultConn.batch_get` when the batch ends::
+
+    with conn.batch() as batch:
+        weights = batch.get_weight_measurements(min_date=week_ago)
+        heights = batch.get_height_measurements(max=1)
+        devices = batch.get_devices()
+    use(weights.result(), heights.result(), devices.result())
+
+The opposite problem, a batch too big for one request, is handled by :py:func:`plan_batches`,
+which ``batch_get`` uses to split big batches into several requests.
+"""
+import sys
+
+from .xmlutils import SINGLETON_TYPES
+
+
+# The conn methods a Batch can make. They only call batch_get, so run against a
+# Batch they defer their request instead of sending it.
+BATCHABLE_METHODS = frozenset([
+    'get_basic_demographic_info',
+    'get_blood_glucose_measurements',
+    'get_blood_pressure_measurements',
+    'get_height_measurements',
+    'get_weight_measurements',
+    'get_devices',
+    'get_exercise',
+    'get_sleep_sessions',
+])
+
+
+# Rough sizes, in bytes, of a thing and of a thing's key in a GetThings response,
+# for estimating how big a response will be
+THING_SIZE_ESTIMATE = 2000
+KEY_SIZE_ESTIMATE = 300
+
+# How many things to expect for a request without a 'max'
+UNLIMITED_THINGS_ESTIMATE = 100
+
+# The biggest response we'd like to get from one request
+MAX_RESPONSE_SIZE = 1024 * 1024
+
+
+def estimate_response_size(request):
+    """Return a rough estimate of how many bytes the group for a ``batch_get`` request
+    will take up in the response."""
+    if request.get('datatype') in SINGLETON_TYPES:
+        things = 1
+    else:
+        things = request.get('max') or UNLIMITED_THINGS_ESTIMATE
+    if request.get('keys_only') or request.get('include_xml') is False:
+        return things * KEY_SIZE_ESTIMATE
+    return things * THING_SIZE_ESTIMATE
+
+
+def plan_batches(requests, max_groups, max_size=MAX_RESPONSE_SIZE):
+    """Split ``batch_get`` requests into batches to send as separate GetThings requests,
+    each with at most `max_groups` groups and, as far as we can tell, a response of at
+    most `max_size` bytes. (A request that's expected to be bigger than that on its own
+    gets a batch to itself.)
+
+    :returns: a list of lists of indexes into requests, in order
+    """
+    batches = []
+    size = 0
+    for index, request in enumerate(requests):
+        estimate = estimate_response_size(request)
+        if not batches or len(batches[-1]) >= max_groups or size + estimate > max_size:
+            batches.append([])
+            size = 0
+        batches[-1].append(index)
+        size += estimate
+    return batches
+
+
+class Future(object):
+    """The result of a request in a :py:class:`Batch`, once the batch has been sent."""
+    def __init__(self, batch):
+        self._batch = batch
+        self._done = False
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        """Return True if the request has been sent and its result (or exception) is in."""
+        return self._done
+
+    def result(self):
+        """Return the result, sending the batch first if it hasn't been sent yet.
+
+        :raises: whatever sending the batch raised
+        """
+        if not self._done:
+            self._batch.flush()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _set(self, result=None, exc_info=None):
+        self._result, self._exc_info, self._done = result, exc_info, True
+
+
+def _request_key(request, include_info):
+    """Return a hashable key that's the same for requests that would return the same."""
+    return (include_info, tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                                       for (name, value) in request.items() if value is not None)))
+
+
+class Batch(object):
+    """Collects requests, to send them all at once in one ``batch_get``.
+
+    Get one from :py:meth:`healthvaultlib.healthvault.HealthVaultConn.batch`. It has the
+    conn's ``get_*`` methods (those in :py:data:`BATCHABLE_METHODS`) and ``batch_get``,
+    but they return :py:class:`Future` objects: ``batch_get`` a list of them, one per request.
+    The requests are sent when the ``with`` statement ends, when :py:meth:`flush` is called,
+    or when the result of any of the futures is asked for. Identical requests are only
+    sent once. The batch can be used again after it's been sent.
+
+    A batch isn't thread-safe; use one per thread.
+
+    :param conn: the :py:class:`healthvaultlib.healthvault.HealthVaultConn` to send the requests with
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.stats = dict(requests=0, sent=0, batches=0)
+        self._pending = []
+        self._futures = {}
+        self._deadline = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def __getattr__(self, name):
+        if name not in BATCHABLE_METHODS:
+            raise AttributeError(name)
+        # The conn's method, run with this batch as self, so it calls our batch_get
+        return getattr(type(self.conn), name).im_func.__get__(self)
+
+    def batch_get(self, requests, include_info=False, deadline=None):
+        """Like :py:meth:`healthvaultlib.healthvault.HealthVaultConn.batch_get`, but return a list
+        of futures, one per request. The batch is sent with the earliest deadline given."""
+        if not isinstance(requests, list):
+            requests = [requests]
+        if deadline is not None and (self._deadline is None or deadline < self._deadline):
+            self._deadline = deadline
+        futures = []
+        for request in requests:
+            self.stats['requests'] += 1
+            key = _request_key(request, include_info)
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = Future(self)
+                self._pending.append((request, include_info, future))
+            futures.append(future)
+        return futures
+
+    def flush(self):
+        """Send the requests collected so far, in one ``batch_get`` for each value of
+        `include_info` used, and give the futures their results."""
+        pending, deadline = self._pending, self._deadline
+        self._pending, self._futures, self._deadline = [], {}, None
+        for include_info in (False, True):
+            batch = [(request, future) for (request, info, future) in pending if info == include_info]
+            if not batch:
+                continue
+            self.stats['sent'] += len(batch)
+            self.stats['batches'] += 1
+            try:
+                results = self.conn.batch_get([request for (request, future) in batch], include_info,
+                                              deadline=deadline)
+            except Exception:
+                exc_info = sys.exc_info()
+                for request, future in batch:
+                    future._set(exc_info=exc_info)
+                continue
+            for (request, future), result in zip(batch, results):
+                future._set(result)
@@ -0,0 +1,156 @@
+"""Helpers for streaming blobs to and from HealthVault.
+
+HealthVault stores large attachments to things as blobs. They're uploaded in
+chunks to a URL obtained from `BeginPutBlob
+<https://platform.healthvault-ppe.com/platform/XSD/method-beginputblob.xsd>`_,
+then attached to a thing with PutThings, and they're downloaded from a URL
+returned by GetThings. See `Blob streaming
+<http://msdn.microsoft.com/en-us/library/ff803584.aspx>`_.
+
+The functions here never hold more than a couple of chunks of a blob in memory.
+"""
+import base64
+import hashlib
+import time
+
+from healthvaultlib.exceptions import HealthVaultHTTPException
+
+
+# The only hash algorithm HealthVault supports for blobs
+BLOB_HASH_ALGORITHM = "SHA256Block"
+
+# Used when downloading, where HealthVault doesn't tell us a chunk size
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class BlobHasher(object):
+    """Computes the SHA256Block hash of a blob incrementally.
+
+    The blob is split into blocks of `block_size` bytes, each block is hashed with SHA256,
+    and the blob hash is the SHA256 hash of the concatenated block hashes.
+
+    :param integer block_size: The block size HealthVault gave us in the BeginPutBlob response.
+    """
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._blob_hash = hashlib.sha256()
+        self._block_hash = hashlib.sha256()
+        self._block_used = 0
+        self._blocks = 0
+
+    def update(self, data):
+        """Add some more bytes of the blob. `data` can be a string or a buffer."""
+        offset = 0
+        while offset < len(data):
+            size = min(self.block_size - self._block_used, len(data) - offset)
+            self._block_hash.update(buffer(data, offset, size))
+            self._block_used += size
+            offset += size
+            if self._block_used == self.block_size:
+                self._finish_block()
+
+    def _finish_block(self):
+        self._blob_hash.update(self._block_hash.digest())
+        self._block_hash = hashlib.sha256()
+        self._block_used = 0
+        self._blocks += 1
+
+    def digest(self):
+        """Return the base64-encoded hash of everything passed to :py:meth:`update`."""
+        blob_hash = self._blob_hash.copy()
+        if self._block_used or not self._blocks:
+            blob_hash.update(self._block_hash.digest())
+        return base64.b64encode(blob_hash.digest())
+
+
+def transfer_stats(nbytes, started):
+    """Return the throughput metrics for a transfer of `nbytes` that started at time `started`.
+
+    :returns: a dictionary
+
+    Example::
+
+        {'bytes': 10485760, 'seconds': 2.5, 'bytes_per_second': 4194304.0}
+    """
+    seconds = time.time() - started
+    return dict(
+        bytes=nbytes,
+        seconds=seconds,
+        bytes_per_second=nbytes / seconds if seconds > 0 else None,
+    )
+
+
+def _readinto(fileobj, buf):
+    """Fill buf from fileobj, without allocating if the file supports readinto.
+
+    :returns: the number of bytes read, which is less than len(buf) only at end of file
+    """
+    if not hasattr(fileobj, 'readinto'):
+        data = fileobj.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+    view = memoryview(buf)
+    filled = 0
+    while filled < len(buf):
+        n = fileobj.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def upload_chunks(conn, path, fileobj, chunk_size, hasher):
+    """Upload the contents of fileobj to a blob URL in chunks of `chunk_size` bytes.
+
+    Two buffers of `chunk_size` bytes are allocated and reused for the whole upload. We
+    read one chunk ahead so the last chunk can be marked as completing the blob.
+
+    :param conn: An ``httplib.HTTPSConnection`` to the blob URL's host
+    :param string path: The path (and query) part of the blob URL
+    :param fileobj: A file-like object to read the blob from
+    :param integer chunk_size: The chunk size HealthVault gave us in the BeginPutBlob response
+    :param BlobHasher hasher: Updated with every byte uploaded
+    :returns: The number of bytes uploaded
+    :raises: :py:exc:`HealthVaultHTTPException` if HealthVault rejects a chunk
+    """
+    current, ahead = bytearray(chunk_size), bytearray(chunk_size)
+    length = _readinto(fileobj, current)
+    start = 0
+    while True:
+        ahead_length = _readinto(fileobj, ahead) if length == chunk_size else 0
+        last = ahead_length == 0
+        chunk = buffer(current, 0, length)
+        hasher.update(chunk)
+        conn.putrequest('POST', path)
+        conn.putheader('Content-Length', '%d' % length)
+        if length:
+            conn.putheader('Content-Range', 'bytes %d-%d/*' % (start, start + length - 1))
+        if last:
+            conn.putheader('x-hv-blob-complete', '1')
+        conn.endheaders()
+        conn.send(chunk)
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise HealthVaultHTTPException("Non-success HTTP response status uploading blob chunk.  Status=%d, message=%s" %
+                                           (response.status, response.reason),
+                                           code=response.status)
+        start += length
+        if last:
+            return start
+        current, ahead = ahead, current
+        length = ahead_length
+
+
+def download_chunks(response, fileobj, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Copy the body of an HTTP response to fileobj, `chunk_size` bytes at a time.
+
+    :returns: The number of bytes copied
+    """
+    nbytes = 0
+    chunk = response.read(chunk_size)
+    while chunk:
+        fileobj.write(chunk)
+        nbytes += len(chunk)
+        chunk = response.read(chunk_size)
+    return nbytes
@@ -0,0 +1,212 @@
+"""Failing fast when a HealthVault server is in trouble.
+
+A :py:class:`CircuitBreaker` watches the requests sent to each server. When too many
+of them fail or are slow, it "opens" for that server: requests fail straight away
+with :py:exc:`healthvaultlib.exceptions.HealthVaultCircuitOpenException` instead of
+tying up a thread waiting on it. After a while it lets a few probe requests through,
+and closes again if they succeed.
+"""
+import collections
+import httplib
+import logging
+import socket
+import threading
+import time
+
+from .exceptions import HealthVaultCircuitOpenException, HealthVaultHTTPException
+
+
+logger = logging.getLogger(__name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _Circuit(object):
+    """The state of the circuit for one server."""
+    def __init__(self):
+        self.state = CLOSED
+        # (time, failed, slow) for each recent request
+        self.outcomes = collections.deque()
+        self.opened_at = None
+        self.probes = 0
+        self.probe_successes = 0
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a HealthVault server that's failing or slow.
+
+    For each server, the outcomes of the requests that finished in the last `window`
+    seconds are kept. Once there are at least `min_requests` of them, the circuit
+    opens if the fraction that failed reaches `failure_rate`, or the fraction that
+    took `slow_request_time` seconds or more reaches `slow_rate`. A request fails if
+    it couldn't be sent or answered (socket errors, bad HTTP), or HealthVault answered
+    with an HTTP 5xx status. Errors HealthVault reports in a successful response
+    (e.g. access denied) mean the server is working, so they don't count.
+
+    While open, requests to the server raise
+    :py:exc:`healthvaultlib.exceptions.HealthVaultCircuitOpenException` without being
+    sent. After `open_time` seconds the circuit is half-open: up to `probes` requests
+    are let through at a time. If `probes` of them succeed, the circuit closes; if any
+    fails, it opens again.
+
+    One breaker can be shared by many `HealthVaultConn` objects; pass it to each as
+    `circuit_breaker`.
+
+    Example::
+
+        def alert(server, old_state, new_state):
+            statsd.incr('healthvault.circuit.%s' % new_state)
+
+        breaker = CircuitBreaker(failure_rate=0.5, slow_request_time=20)
+        breaker.add_listener(alert)
+        conn = HealthVaultConn(..., circuit_breaker=breaker)
+
+    The breaker's :py:attr:`stats` count the times circuits have opened, gone half-open
+    and closed, and the requests rejected because a circuit was open.
+
+    :param float failure_rate: the fraction of failed requests that opens the circuit
+    :param float slow_request_time: seconds after which a request counts as slow; None to ignore time taken
+    :param float slow_rate: the fraction of slow requests that opens the circuit
+    :param integer min_requests: how many requests there must have been in the window before it can open
+    :param float window: how many seconds of requests to judge the server by
+    :param float open_time: how many seconds to fail fast for before probing the server
+    :param integer probes: how many probe requests to let through at once, and how many must succeed
+    """
+    def __init__(self, failure_rate=0.5, slow_request_time=None, slow_rate=0.5, min_requests=10,
+                 window=60, open_time=30, probes=1):
+        self.failure_rate = failure_rate
+        self.slow_request_time = slow_request_time
+        self.slow_rate = slow_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_time = open_time
+        self.probes = probes
+        self.stats = dict(opened=0, half_opened=0, closed=0, rejected=0)
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def add_listener(self, listener):
+        """Call ``listener(server, old_state, new_state)`` whenever a circuit changes state.
+        The states are :py:data:`CLOSED`, :py:data:`OPEN` and :py:data:`HALF_OPEN`."""
+        self._listeners.append(listener)
+
+    def state(self, server):
+        """Return the state of the circuit for a server."""
+        changes = []
+        with self._lock:
+            circuit = self._circuits.setdefault(server, _Circuit())
+            self._check_open_time(server, circuit, time.time(), changes)
+            state = circuit.state
+        self._notify(changes)
+        return state
+
+    def is_failure(self, exc):
+        """Return True if `exc` means the server is in trouble."""
+        if isinstance(exc, HealthVaultHTTPException):
+            return exc.code is None or exc.code >= 500
+        return isinstance(exc, (socket.error, httplib.HTTPException))
+
+    def call(self, server, func, *args, **kwargs):
+        """Return func(*args, **kwargs), which sends a request to server, unless the
+        server's circuit is open.
+
+        :raises: :py:exc:`healthvaultlib.exceptions.HealthVaultCircuitOpenException` if
+            the circuit is open, or whatever func raises
+        """
+        changes = []
+        with self._lock:
+            circuit = self._circuits.setdefault(server, _Circuit())
+            probe = self._admit(server, circuit, time.time(), changes)
+        self._notify(changes)
+        if probe is None:
+            raise HealthVaultCircuitOpenException("%s is failing; not sending it requests for now" % server)
+
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            failed = self.is_failure(e)
+            self._record(server, circuit, probe, start, failed)
+            raise
+        self._record(server, circuit, probe, start, False)
+        return result
+
+    def _admit(self, server, circuit, now, changes):
+        """Return whether the request is a probe (True or False), or None if it must
+        be rejected. Called with the lock held."""
+        self._check_open_time(server, circuit, now, changes)
+        if circuit.state == CLOSED:
+            return False
+        if circuit.state == HALF_OPEN and circuit.probes < self.probes:
+            circuit.probes += 1
+            return True
+        self.stats['rejected'] += 1
+        return None
+
+    def _record(self, server, circuit, probe, start, failed):
+        now = time.time()
+        slow = self.slow_request_time is not None and now - start >= self.slow_request_time
+        changes = []
+        with self._lock:
+            if probe:
+                circuit.probes -= 1
+            if probe and circuit.state == HALF_OPEN:
+                if failed or slow:
+                    self._change(server, circuit, OPEN, now, changes)
+                else:
+                    circuit.probe_successes += 1
+                    if circuit.probe_successes >= self.probes:
+                        self._change(server, circuit, CLOSED, now, changes)
+            elif not probe and circuit.state == CLOSED:
+                outcomes = circuit.outcomes
+                outcomes.append((now, failed, slow))
+                while outcomes and outcomes[0][0] < now - self.window:
+                    outcomes.popleft()
+                if len(outcomes) >= self.min_requests and self._tripped(outcomes):
+                    self._change(server, circuit, OPEN, now, changes)
+        self._notify(changes)
+
+    def _tripped(self, outcomes):
+        failures = sum(1 for (when, failed, slow) in outcomes if failed)
+        if failures >= self.failure_rate * len(outcomes):
+            return True
+        if self.slow_request_time is None:
+            return False
+        slows = sum(1 for (when, failed, slow) in outcomes if slow)
+        return slows >= self.slow_rate * len(outcomes)
+
+    def _check_open_time(self, server, circuit, now, changes):
+        if circuit.state == OPEN and now >= circuit.opened_at + self.open_time:
+            self._change(server, circuit, HALF_OPEN, now, changes)
+
+    def _change(self, server, circuit, state, now, changes):
+        """Move a circuit to a new state. Called with the lock held; listeners are
+        told about the changes afterwards."""
+        old_state = circuit.state
+        circuit.state = state
+        if state == OPEN:
+            circuit.opened_at = now
+            self.stats['opened'] += 1
+            logger.warning("Circuit for %s opened; failing requests to it fast for %s seconds" %
+                           (server, self.open_time))
+        elif state == HALF_OPEN:
+            circuit.probe_successes = 0
+            self.stats['half_opened'] += 1
+            logger.info("Circuit for %s half-open; probing it" % server)
+        else:
+            circuit.outcomes.clear()
+            self.stats['closed'] += 1
+            logger.info("Circuit for %s closed" % server)
+        changes.append((server, old_state, state))
+
+    def _notify(self, changes):
+        for server, old_state, new_state in changes:
+            for listener in self._listeners:
+                try:
+                    listener(server, old_state, new_state)
+                except Exception:
+                    logger.exception("Circuit breaker listener failed")
@@ -0,0 +1,667 @@
+"""Caching things we've already fetched from HealthVault.
+
+Every version of a thing has its own version stamp, and a version never changes once
+written. So a parsed thing can be kept for as long as we like, as long as we only use it
+when HealthVault still has that same version.
+
+:py:class:`ThingCache` keeps parsed things by thing ID and version stamp. Its
+:py:meth:`ThingCache.batch_get` first asks HealthVault for just the keys of the
+things (without their data), then fetches the data only for things that are new or
+have changed since they were cached.
+
+:py:class:`ResponseCache` instead keeps whole responses for a while, for applications
+that ask for the same things over and over.
+
+A :py:class:`PersonInfoCache` remembers which person and record each wctoken is for,
+so connecting doesn't need a GetPersonInfo request every time.
+
+A :py:class:`NegativeCache` remembers records and wctokens HealthVault has told us
+we can't use, so we don't keep asking.
+
+A :py:class:`RequestCoalescer` doesn't keep anything once a request is done; it just makes
+identical requests made at the same time share one round trip.
+"""
+import collections
+import cPickle as pickle
+import hashlib
+import httplib
+import logging
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from .exceptions import (_get_exception_class_for, HealthVaultCircuitOpenException,
+                         HealthVaultDeadlineExceededException, HealthVaultHTTPException)
+from .status_codes import HealthVaultStatus
+from .targets import ApplicationTarget
+from .xmlutils import SINGLETON_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+
+# Errors that mean HealthVault couldn't be reached, didn't answer properly or in time, or
+# isn't being asked while it's failing, rather than that it refused the request. A
+# ResponseCache keeps serving what it has when it gets these.
+UNAVAILABLE_ERRORS = (HealthVaultHTTPException, HealthVaultCircuitOpenException,
+                      HealthVaultDeadlineExceededException, socket.error, httplib.HTTPException)
+
+
+class ThingCache(object):
+    """A cache of parsed things, keyed by thing ID and version stamp.
+
+    The most recently used things are kept in memory. If `path` is given, every thing
+    is also written to a SQLite database there, so things that fall out of memory (or
+    were cached by an earlier process) don't have to be fetched again.
+
+    Only the latest version we've seen of each thing is kept.
+
+    Example::
+
+        cache = ThingCache(maxsize=5000, path='/var/lib/ourapp/things.db')
+        weights, heights = cache.batch_get(conn, [{'datatype': DataType.WEIGHT_MEASUREMENTS},
+                                                  {'datatype': DataType.HEIGHT_MEASUREMENTS}])
+        print cache.stats
+
+    :param integer maxsize: the most things to keep in memory
+    :param string path: the SQLite database file to use as well, or None to only cache in memory
+    """
+    def __init__(self, maxsize=1000, path=None):
+        self.maxsize = maxsize
+        self.stats = dict(hits=0, misses=0)
+        self._lock = threading.Lock()
+        # thing_id -> (version_stamp, data), least recently used first
+        self._things = collections.OrderedDict()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS things '
+                             '(thing_id TEXT PRIMARY KEY, version_stamp TEXT, data BLOB)')
+            self._db.commit()
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups that found the thing in the cache, or None if there haven't been any."""
+        lookups = self.stats['hits'] + self.stats['misses']
+        return float(self.stats['hits']) / lookups if lookups else None
+
+    def get(self, thing_id, version_stamp):
+        """Look up a version of a thing.
+
+        :returns: (True, data) if that version is cached, or (False, None) if it isn't
+        """
+        with self._lock:
+            found, data = self._get(thing_id, version_stamp)
+            self.stats['hits' if found else 'misses'] += 1
+            return found, data
+
+    def _get(self, thing_id, version_stamp):
+        entry = self._things.pop(thing_id, None)
+        if entry is None and self._db is not None:
+            row = self._db.execute('SELECT version_stamp, data FROM things WHERE thing_id = ?',
+                                   (thing_id,)).fetchone()
+            if row is not None:
+                entry = (row[0], pickle.loads(str(row[1])))
+        if entry is None:
+            return False, None
+        self._remember(thing_id, entry)
+        if entry[0] != version_stamp:
+            return False, None
+        return True, entry[1]
+
+    def put(self, thing_id, version_stamp, data):
+        """Cache a version of a thing, replacing any other version of it."""
+        with self._lock:
+            self._things.pop(thing_id, None)
+            self._remember(thing_id, (version_stamp, data))
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO things (thing_id, version_stamp, data) VALUES (?, ?, ?)',
+                                 (thing_id, version_stamp,
+                                  sqlite3.Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))))
+                self._db.commit()
+
+    def _remember(self, thing_id, entry):
+        self._things[thing_id] = entry
+        while len(self._things) > self.maxsize:
+            self._things.popitem(last=False)
+
+    def batch_get(self, conn, requests, include_info=False):
+        """Like :py:meth:`healthvaultlib.healthvault.HealthVaultConn.batch_get`, but only
+        downloads the data of things that aren't already in the cache.
+
+        This makes two requests at most: one for the keys of the things that match the
+        requests, and, if any of those versions aren't cached, one for their data.
+
+        :param conn: a connected :py:class:`healthvaultlib.healthvault.HealthVaultConn`
+        :param list requests: as for ``batch_get``
+        :param boolean include_info: as for ``batch_get``
+        :returns: the same as ``batch_get`` would have returned
+        """
+        if not isinstance(requests, list):
+            requests = [requests]
+        keys_only = [dict(request, include_xml=False) for request in requests]
+        groups = conn.batch_get(keys_only, include_info=True)
+
+        data = {}
+        missing = []
+        for group in groups:
+            for info, unused in group:
+                found, cached = self.get(info['thing_id'], info['version_stamp'])
+                if found:
+                    data[info['thing_id']] = cached
+                else:
+                    missing.append((info['thing_id'], info['version_stamp']))
+        if missing:
+            fetched = conn.get_things_by_keys(missing)
+            for thing_id, version_stamp in missing:
+                if thing_id in fetched:
+                    self.put(thing_id, version_stamp, fetched[thing_id])
+                    data[thing_id] = fetched[thing_id]
+
+        results = []
+        for request, group in zip(requests, groups):
+            things = [(info, data[info['thing_id']]) for (info, unused) in group if info['thing_id'] in data]
+            if include_info:
+                results.append(things)
+                continue
+            parsed = [thing for (info, thing) in things if thing is not None]
+            if parsed and request.get('datatype') in SINGLETON_TYPES:
+                results.append(parsed[0])
+            else:
+                results.append(parsed)
+        return results
+
+
+class _Call(object):
+    """A call in progress for :py:class:`SingleFlight`."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        """Wait for the call to finish, then return its result or raise its exception."""
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class SingleFlight(object):
+    """Makes sure there's only one call in progress for each key. Anyone else wanting
+    the same thing in the meantime waits for that call and gets its result.
+
+    Example::
+
+        flight = SingleFlight()
+        # in any number of threads at once; fetch only runs once
+        data = flight.do(key, fetch)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def claim(self, key):
+        """Start a call for key, unless one is already in progress.
+
+        :returns: (call, leader). If leader is True, the caller must make the call and then
+            :py:meth:`finish` it. Otherwise someone else is making it, and ``call.wait()``
+            returns its result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def finish(self, key, result=None, exc_info=None):
+        """Finish the call for key, passing its result (or exception) to everyone waiting for it."""
+        with self._lock:
+            call = self._calls.pop(key)
+        call.result, call.exc_info = result, exc_info
+        call.event.set()
+
+    def do(self, key, func):
+        """Return func(), unless a call for key is already in progress, in which case
+        wait for it and return its result instead."""
+        call, leader = self.claim(key)
+        if not leader:
+            return call.wait()
+        result = exc_info = None
+        try:
+            result = func()
+        except BaseException:
+            exc_info = sys.exc_info()
+            raise
+        finally:
+            # However func() ended, the key is released and anyone waiting woken
+            self.finish(key, result, exc_info)
+        return result
+
+
+class RequestCoalescer(object):
+    """Makes identical requests that are in flight at the same time share one HTTP call.
+
+    Pass one to :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `coalescer`
+    (the same one to all the conns in a process). Then when a request is made while an
+    identical one is waiting for its response, it waits for that response too, instead
+    of being sent. Requests are identical if they're for the same method, application,
+    wctoken and record, with the same <info> apart from whitespace between elements; so
+    a response is never shared between users.
+
+    Only read-only methods should be coalesced. :py:attr:`stats` counts the requests made
+    through the coalescer, and how many of them were saved from being sent.
+
+    :param methods: the names of the methods to coalesce requests for
+    """
+    def __init__(self, methods=('GetThings',)):
+        self.methods = frozenset(methods)
+        self.stats = dict(requests=0, coalesced=0)
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+
+    def key(self, method_name, app_id, wctoken, record_id, info):
+        """Return the key identifying a request."""
+        info = re.sub(r'>\s+<', '><', info.strip())
+        return (method_name, app_id, wctoken, record_id, hashlib.sha1(info).hexdigest())
+
+    def do(self, key, send):
+        """Return send(), unless an identical request is in flight, in which case
+        return (or raise) what it does."""
+        call, leader = self._flight.claim(key)
+        with self._lock:
+            self.stats['requests'] += 1
+            if not leader:
+                self.stats['coalesced'] += 1
+        if not leader:
+            return call.wait()
+        result = exc_info = None
+        try:
+            result = send()
+        except BaseException:
+            exc_info = sys.exc_info()
+            raise
+        finally:
+            # However send() ended, the key is released and anyone waiting woken
+            self._flight.finish(key, result, exc_info)
+        return result
+
+
+class ResponseCache(object):
+    """A read-through cache of the results of
+    :py:meth:`healthvaultlib.healthvault.HealthVaultConn.batch_get`.
+
+    Pass one to a :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `response_cache`,
+    and every ``batch_get`` (and so ``get_weight_measurements``, ``get_devices``, etc.) uses it.
+    The same cache can be shared by many conns. Results are cached per record and per request,
+    so a batch that's partly cached only asks HealthVault for the rest.
+
+    * A cached result is used for `ttl` seconds (or the data type's entry in `ttls`).
+    * For `stale_ttl` seconds after that it's still returned straight away, while it's
+      refreshed in the background.
+    * For `stale_if_error` seconds after the ttl, it's returned if HealthVault can't be
+      reached or fails (see :py:data:`UNAVAILABLE_ERRORS`).
+    * Only one request for the same thing is made at a time; other threads wanting it wait
+      for that request rather than making their own.
+    * At most `maxsize` results are kept, dropping the least recently used.
+
+    The same result objects are returned to every caller, so don't modify them.
+
+    Example::
+
+        cache = ResponseCache(ttl=60, ttls={DataType.BASIC_DEMOGRAPHIC_DATA: 3600})
+        conn = HealthVaultConn(..., response_cache=cache)
+
+    :param float ttl: seconds to use a result for before asking HealthVault again
+    :param dict ttls: maps data types to their own ttls
+    :param float stale_ttl: seconds after the ttl that a result is still returned while it's refreshed
+    :param float stale_if_error: seconds after the ttl that a result is still returned if HealthVault is unavailable
+    :param integer maxsize: the most results to keep
+    """
+    def __init__(self, ttl=60, ttls=None, stale_ttl=300, stale_if_error=3600, maxsize=1000):
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.stale_ttl = stale_ttl
+        self.stale_if_error = stale_if_error
+        self.maxsize = maxsize
+        self.stats = dict(hits=0, misses=0, stale=0, refreshes=0, errors=0)
+        self._lock = threading.Lock()
+        # key -> (result, time stored, ttl), least recently used first
+        self._entries = collections.OrderedDict()
+        self._flight = SingleFlight()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _key(self, conn, request, include_info):
+        """Requests are identified by the XML we'd send for them, which is the same
+        however the request dictionary was written."""
+        mode = 'keys' if request.get('keys_only') else include_info
+        return (conn.record_id, conn._build_thing_group(**request), mode)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def _put(self, key, result, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (result, time.time(), ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, record_id=None):
+        """Forget the cached results for a record, e.g. after changing things in it,
+        or for every record if record_id is None."""
+        with self._lock:
+            for key in list(self._entries):
+                if record_id is None or key[0] == record_id:
+                    del self._entries[key]
+
+    def batch_get(self, conn, requests, include_info=False):
+        """Return what ``conn.batch_get(requests, include_info)`` would, using cached
+        results where we can."""
+        if not isinstance(requests, list):
+            requests = [requests]
+        results = [None] * len(requests)
+        todo = []
+        now = time.time()
+        for index, request in enumerate(requests):
+            key = self._key(conn, request, include_info)
+            ttl = self.ttls.get(request.get('datatype'), self.ttl)
+            entry = self._get(key)
+            if entry is not None:
+                result, stored, entry_ttl = entry
+                if now < stored + entry_ttl:
+                    self._count('hits')
+                    results[index] = result
+                    continue
+                if now < stored + entry_ttl + self.stale_ttl:
+                    self._count('stale')
+                    results[index] = result
+                    self._refresh(conn, request, key, ttl, include_info)
+                    continue
+            self._count('misses')
+            todo.append((index, request, key, ttl))
+        if todo:
+            self._fill(conn, todo, include_info, results)
+        return results
+
+    def _fill(self, conn, todo, include_info, results):
+        """Fetch the results for the requests in todo, in one request for those nobody
+        else is already fetching."""
+        leading, waiting = [], []
+        for index, request, key, ttl in todo:
+            call, leader = self._flight.claim(key)
+            (leading if leader else waiting).append((index, request, key, ttl, call))
+        if leading:
+            try:
+                fetched = conn._batch_get([request for (index, request, key, ttl, call) in leading], include_info)
+            except BaseException:
+                exc_info = sys.exc_info()
+                for index, request, key, ttl, call in leading:
+                    self._flight.finish(key, exc_info=exc_info)
+                if not isinstance(exc_info[1], Exception):
+                    # e.g. KeyboardInterrupt, which no cached result should hide
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                for index, request, key, ttl, call in leading:
+                    results[index] = self._stale_or_raise(key, exc_info)
+            else:
+                for (index, request, key, ttl, call), result in zip(leading, fetched):
+                    self._put(key, result, ttl)
+                    self._flight.finish(key, result)
+                    results[index] = result
+        for index, request, key, ttl, call in waiting:
+            try:
+                results[index] = call.wait()
+            except Exception:
+                results[index] = self._stale_or_raise(key, sys.exc_info())
+
+    def _stale_or_raise(self, key, exc_info):
+        """Return the cached result for key if HealthVault is unavailable and it's not too old,
+        otherwise re-raise the exception."""
+        entry = self._get(key)
+        if entry is not None and isinstance(exc_info[1], UNAVAILABLE_ERRORS):
+            result, stored, ttl = entry
+            if time.time() < stored + ttl + self.stale_if_error:
+                logger.warning("HealthVault unavailable (%s), returning a cached result" % exc_info[1])
+                self._count('errors')
+                return result
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _refresh(self, conn, request, key, ttl, include_info):
+        """Start fetching a new result for key in the background, unless that's already happening."""
+        call, leader = self._flight.claim(key)
+        if not leader:
+            return
+        self._count('refreshes')
+        thread = threading.Thread(target=self._run_refresh, args=(conn, request, key, ttl, include_info))
+        thread.daemon = True
+        thread.start()
+
+    def _run_refresh(self, conn, request, key, ttl, include_info):
+        try:
+            result = conn._batch_get([request], include_info)[0]
+        except BaseException:
+            logger.warning("Could not refresh cached HealthVault result", exc_info=True)
+            self._flight.finish(key, exc_info=sys.exc_info())
+            return
+        self._put(key, result, ttl)
+        self._flight.finish(key, result)
+
+
+class PersonInfoCache(object):
+    """Remembers the person info (as returned by
+    :py:meth:`healthvaultlib.healthvault.HealthVaultConn.get_person_info`) for each wctoken,
+    for `ttl` seconds.
+
+    Pass one to :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `person_info_cache`
+    and :py:meth:`healthvaultlib.healthvault.HealthVaultConn.connect` uses it. A conn
+    removes its wctoken's entry if HealthVault says the wctoken has expired or access has
+    been denied.
+
+    wctokens are only stored hashed. Subclasses implement :py:meth:`_load`, :py:meth:`_save`
+    and :py:meth:`_delete` to keep entries somewhere.
+
+    :param float ttl: how many seconds to remember person info for
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    def _key(self, wctoken):
+        return hashlib.sha256(wctoken).hexdigest()
+
+    def get(self, wctoken):
+        """Return the person info for wctoken, or None if we don't have it (or it's too old)."""
+        entry = self._load(self._key(wctoken))
+        if entry is None:
+            return None
+        stored, person_info = entry
+        if time.time() >= stored + self.ttl:
+            self._delete(self._key(wctoken))
+            return None
+        return person_info
+
+    def put(self, wctoken, person_info):
+        """Remember the person info for wctoken."""
+        self._save(self._key(wctoken), (time.time(), person_info))
+
+    def invalidate(self, wctoken):
+        """Forget the person info for wctoken."""
+        self._delete(self._key(wctoken))
+
+    def _load(self, key):
+        """Return the (time stored, person info) entry for key, or None."""
+        raise NotImplementedError
+
+    def _save(self, key, entry):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryPersonInfoCache(PersonInfoCache):
+    """Keeps person info in memory, for one process."""
+    def __init__(self, ttl=3600):
+        super(MemoryPersonInfoCache, self).__init__(ttl)
+        self._entries = {}
+
+    def _load(self, key):
+        return self._entries.get(key)
+
+    def _save(self, key, entry):
+        self._entries[key] = entry
+
+    def _delete(self, key):
+        self._entries.pop(key, None)
+
+
+class SQLitePersonInfoCache(PersonInfoCache):
+    """Keeps person info in a SQLite database, which any number of processes can share.
+
+    :param string path: the database file
+    """
+    def __init__(self, path, ttl=3600):
+        super(SQLitePersonInfoCache, self).__init__(ttl)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS person_info '
+                             '(token_hash TEXT PRIMARY KEY, stored REAL, person_info BLOB)')
+            self._db.commit()
+
+    def _load(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT stored, person_info FROM person_info WHERE token_hash = ?',
+                                   (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], pickle.loads(str(row[1]))
+
+    def _save(self, key, entry):
+        stored, person_info = entry
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO person_info (token_hash, stored, person_info) VALUES (?, ?, ?)',
+                             (key, stored, sqlite3.Binary(pickle.dumps(person_info, pickle.HIGHEST_PROTOCOL))))
+            self._db.commit()
+
+    def _delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM person_info WHERE token_hash = ?', (key,))
+            self._db.commit()
+
+
+class NegativeCache(object):
+    """Remembers records and wctokens that HealthVault has refused, so requests using
+    them fail straight away instead of going to HealthVault again.
+
+    Pass one to :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `negative_cache`.
+    When a request fails with one of :py:data:`RECORD_STATUSES`, its record is marked, and
+    with one of :py:data:`WCTOKEN_STATUSES`, its wctoken is. Until the mark expires, any
+    request for that record or with that wctoken raises the same kind of exception HealthVault
+    caused, without any network traffic.
+
+    A mark lasts `ttl` seconds at first. Each time the record or wctoken fails again after
+    that, the time is multiplied by `backoff`, up to `max_ttl`. A successful request clears it.
+
+    When the user authorizes our application again, call :py:meth:`handle_target` (or
+    :py:meth:`clear`) so the record can be used straight away.
+
+    :param float ttl: seconds a record or wctoken is refused for after its first failure
+    :param float backoff: what to multiply the time by on each further failure
+    :param float max_ttl: the longest a record or wctoken is refused for
+    """
+    # Status codes that mean the record can't be used
+    RECORD_STATUSES = (
+        HealthVaultStatus.ACCESS_DENIED,
+        HealthVaultStatus.INVALID_RECORD,
+        HealthVaultStatus.INVALID_RECORD_STATE,
+    )
+    # Status codes that mean the wctoken (or the person it's for) can't be used
+    WCTOKEN_STATUSES = (
+        HealthVaultStatus.CREDENTIAL_TOKEN_EXPIRED,
+        HealthVaultStatus.INVALID_PERSON,
+        HealthVaultStatus.INVALID_PERSON_STATE,
+    )
+
+    def __init__(self, ttl=300, backoff=2, max_ttl=24 * 3600):
+        self.ttl = ttl
+        self.backoff = backoff
+        self.max_ttl = max_ttl
+        self.stats = dict(refused=0, marked=0)
+        self._lock = threading.Lock()
+        # ('record', record_id) or ('wctoken', hash) -> (refused until, failures, code, message)
+        self._entries = {}
+
+    def _keys(self, record_id, wctoken):
+        keys = []
+        if record_id is not None:
+            keys.append(('record', record_id))
+        if wctoken is not None:
+            keys.append(('wctoken', hashlib.sha256(wctoken).hexdigest()))
+        return keys
+
+    def check(self, record_id=None, wctoken=None):
+        """Raise an exception if the record or wctoken is currently refused.
+
+        :raises: the kind of :py:exc:`healthvaultlib.exceptions.HealthVaultException` that HealthVault's
+            status code maps to, with its `code` set.
+        """
+        now = time.time()
+        with self._lock:
+            for key in self._keys(record_id, wctoken):
+                entry = self._entries.get(key)
+                if entry is not None and now < entry[0]:
+                    until, failures, code, message = entry
+                    self.stats['refused'] += 1
+                    break
+            else:
+                return
+        raise _get_exception_class_for(code)("Not asking HealthVault again until %s: %s"
+                                             % (time.ctime(until), message), code=code)
+
+    def failed(self, exc, record_id=None, wctoken=None):
+        """Mark the record or wctoken, if `exc` is a HealthVault error that means it can't be used.
+
+        :param exc: the exception a request raised
+        :param record_id: the record the request was for, if any
+        :param wctoken: the wctoken the request used, if any
+        """
+        code = getattr(exc, 'code', None)
+        if code in self.RECORD_STATUSES:
+            keys = self._keys(record_id, None)
+        elif code in self.WCTOKEN_STATUSES:
+            keys = self._keys(None, wctoken)
+        else:
+            return
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                failures = self._entries.get(key, (0, 0))[1] + 1
+                ttl = min(self.ttl * self.backoff ** (failures - 1), self.max_ttl)
+                self._entries[key] = (now + ttl, failures, code, str(exc))
+                self.stats['marked'] += 1
+
+    def clear(self, record_id=None, wctoken=None):
+        """Stop refusing the record and wctoken, e.g. because the user has authorized our
+        application again."""
+        with self._lock:
+            for key in self._keys(record_id, wctoken):
+                self._entries.pop(key, None)
+
+    def handle_target(self, target, record_id=None, wctoken=None):
+        """Call this with the target HealthVault redirects the user back to our application with
+        (see :py:class:`healthvaultlib.targets.ApplicationTarget`). If the user has just authorized
+        the application, the record and wctoken are cleared.
+        """
+        if target == ApplicationTarget.APP_AUTH_SUCCESS:
+            self.clear(record_id, wctoken)
@@ -0,0 +1,61 @@
+"""Running several HealthVault requests at once.
+
+Each request made by a :py:class:`healthvaultlib.healthvault.HealthVaultConn` opens its own
+HTTPS connection, so requests for the same conn can safely run in different threads.
+"""
+import Queue
+import sys
+import threading
+
+from .deadlines import current_deadline, deadline
+
+
+def run_concurrently(func, items, max_workers=4):
+    """Call func(item) for each item, running up to max_workers calls at a time in threads.
+
+    :param func: callable taking one argument
+    :param list items: the arguments to call func with
+    :param integer max_workers: the most calls to run at the same time
+    The calls are made with the current thread's deadline, if any (see :py:mod:`healthvaultlib.deadlines`).
+
+    :returns: a list, in the same order as items, of (result, exc_info) pairs. exc_info is
+        None if the call returned normally; otherwise result is None and exc_info is what
+        ``sys.exc_info()`` returned in the failed call.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    todo = Queue.Queue()
+    for index, item in enumerate(items):
+        todo.put((index, item))
+
+    when = current_deadline()
+
+    def work():
+        with deadline(when):
+            worker()
+
+    def worker():
+        while True:
+            try:
+                index, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (func(item), None)
+            except Exception:
+                results[index] = (None, sys.exc_info())
+
+    if max_workers <= 1 or len(items) == 1:
+        worker()
+        return results
+
+    threads = [threading.Thread(target=work) for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,61 @@
+"""Deadlines for whole calls that may make several HealthVault requests.
+
+A call like ``conn.get_weight_measurements(deadline=time.time() + 10)`` may page, retry or
+get a new session token, each making a request. The deadline is kept for the current
+thread while the call runs (and passed on to the threads of
+:py:func:`healthvaultlib.concurrency.run_concurrently`), so every request it makes is
+given only the time that's left, and none is started once it has passed.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+from .exceptions import HealthVaultDeadlineExceededException
+
+
+_local = threading.local()
+
+
+def current_deadline():
+    """Return the deadline for the current thread, as a ``time.time()`` value, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline(when):
+    """Run the body with `when` (a ``time.time()`` value, or None for no deadline) as the
+    current thread's deadline. An earlier deadline that's already in force is kept."""
+    previous = current_deadline()
+    if previous is not None and (when is None or previous < when):
+        when = previous
+    _local.deadline = when
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def time_left():
+    """Return how many seconds are left before the current thread's deadline, or None if
+    there isn't one.
+
+    :raises: :py:exc:`healthvaultlib.exceptions.HealthVaultDeadlineExceededException` if it's passed
+    """
+    when = current_deadline()
+    if when is None:
+        return None
+    left = when - time.time()
+    if left <= 0:
+        raise HealthVaultDeadlineExceededException("Deadline passed %.3f seconds ago" % -left)
+    return left
+
+
+def limit(timeout):
+    """Return `timeout` (seconds, or None for none), cut short if need be to the time left
+    before the current thread's deadline."""
+    left = time_left()
+    if left is None:
+        return timeout
+    if timeout is None:
+        return left
+    return min(timeout, left)
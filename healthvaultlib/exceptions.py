@@ -55,3 +55,36 @@ class HealthVaultHTTPException(HealthVaultException):
     and the exception message to the response message.
     """
     pass
+
+
+class HealthVaultCircuitOpenException(HealthVaultException):
+    """Raised instead of sending a request to a HealthVault server that's been failing,
+    while a :py:class:`healthvaultlib.breaker.CircuitBreaker` is giving it a rest.
+    Try again later.
+    """
+    pass
+
+
+class HealthVaultDeadlineExceededException(HealthVaultException):
+    """Raised instead of sending a request when the deadline given for the call that
+    needs it has passed.
+    """
+    pass
+
+
+class HealthVaultHedgeCancelledException(HealthVaultException):
+    """Raised in place of whatever a request was doing when it was cancelled because
+    the other of a pair of hedged requests finished first (see :py:mod:`healthvaultlib.hedging`).
+    It never gets past the hedging.
+    """
+    pass
+
+
+class HealthVaultRateLimitedException(HealthVaultException):
+    """Raised instead of sending a request that would go over the request rate allowed
+    by a :py:class:`healthvaultlib.limits.RateLimiter`, when it isn't to wait.
+    The :py:attr:`retry_after` attribute is how many seconds until it could be sent.
+    """
+    def __init__(self, *args, **kwargs):
+        self.retry_after = kwargs.pop('retry_after', None)
+        super(HealthVaultRateLimitedException, self).__init__(*args, **kwargs)
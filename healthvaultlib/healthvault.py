@@ -27,13 +27,28 @@ import logging
 from random import randint
 import socket
 import datetime
+import tempfile
+import threading
+import time
 from urllib import urlencode
+import urlparse
+from xml.sax.saxutils import escape
 import xml.etree.ElementTree as ET
 
+from .batching import Batch, plan_batches
+from .blobs import BlobHasher, download_chunks, transfer_stats, upload_chunks
+from .concurrency import run_concurrently
+from . import deadlines
 from .datatypes import DataType
-from healthvaultlib.exceptions import _get_exception_class_for, HealthVaultHTTPException, HealthVaultException
+from healthvaultlib.exceptions import (_get_exception_class_for, HealthVaultHTTPException, HealthVaultException,
+                                       HealthVaultHedgeCancelledException, HealthVaultRateLimitedException)
+from . import hedging
+from .status_codes import HealthVaultStatus
 from .hvcrypto import HVCrypto
-from .xmlutils import (   pretty_xml, elt_as_string, parse_group)
+from .retry import NON_IDEMPOTENT_METHODS
+from .xmlutils import (   pretty_xml, parse_begin_put_blob, parse_blob,
+                         parse_subscription, parse_thing, parse_group_things, parse_group_keys, group_data,
+                         parse_person_info)
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +56,61 @@ logger = logging.getLogger(__name__)
 # The version current when we wrote this
 HEALTHVAULT_VERSION = "1.11.1023.7909"
 
+# Size of the pieces we read and send when streaming a request body
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Streamed request bodies bigger than this are spooled to a temporary file
+# instead of being kept in memory
+SPOOL_MAX_SIZE = 1024 * 1024
+
+# How many things we name in one RemoveThings request to start with. If HealthVault
+# says that's too many, we split the request in half until it's happy.
+MAX_THINGS_PER_REQUEST = 200
+
+# How many things we ask for by ID in one GetThings group. HealthVault returns at most
+# this many things in full per group; any others only come back as keys.
+MAX_THINGS_PER_GROUP = 30
+
+# How many groups we put in one GetThings request. Too many and HealthVault fails the
+# request with TOO_MANY_GROUPS_IN_QUERY.
+MAX_GROUPS_PER_REQUEST = 10
+
+# How many keys we ask for per request when paging through things with iter_thing_keys
+KEYS_PAGE_SIZE = 1000
+
+# How many things we ask for per request when paging through things with iter_things,
+# if we're not given a PageSizer to decide. Any more than MAX_THINGS_PER_GROUP and
+# HealthVault only sends the keys of the rest, which then take another request.
+THINGS_PAGE_SIZE = MAX_THINGS_PER_GROUP
+
+# How many of the requests a big batch_get is split into to send at the same time
+BATCH_WORKERS = 4
+
+# Status codes that mean the wctoken can't be used any more
+_WCTOKEN_STATUSES = (
+    HealthVaultStatus.CREDENTIAL_TOKEN_EXPIRED,
+    HealthVaultStatus.ACCESS_DENIED,
+)
+
+# The sections of a thing that can be asked for in a GetThings request; see
+# https://platform.healthvault-ppe.com/platform/XSD/method-getthings.xsd
+THING_SECTIONS = ('core', 'audits', 'blobpayload', 'effectivepermissions', 'tags',
+                  'digitalsignatures', 'signatureinfo')
+
+# What a keys-only query asks HealthVault for: enough to identify each thing and
+# tell when it last changed, but not its data
+KEYS_ONLY_SECTIONS = ['core', 'audits']
+
+# Status codes that mean a RemoveThings request failed because of particular things in
+# it, rather than something that would make any request fail
+_THING_STATUSES = (
+    HealthVaultStatus.INVALID_THING,
+    HealthVaultStatus.THING_TYPE_UNDELETABLE,
+    HealthVaultStatus.VERSION_STAMP_MISSING,
+    HealthVaultStatus.VERSION_STAMP_MISMATCH,
+    HealthVaultStatus.TOO_MANY_THINGS_SPECIFIED,
+)
+
 def format_datetime(dt):
     """Format a datetime for use in HealthVault requests.
 
@@ -50,7 +120,19 @@ def format_datetime(dt):
         <http://msdn.microsoft.com/en-us/library/ms256220.aspx>`_ (CCYY-MM-DDThh:mm:ss)
     :rtype: string
     """
-    return dt.strftime("%Y-%m-%dT%H:%m:%S")
+    return dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _round_up_to_second(dt):
+    """Return dt rounded up to a whole second.
+
+    :py:func:`format_datetime` leaves out fractions of a second, so paging with an
+    `eff-date-max` of the oldest thing so far would skip older things in the same second.
+    Rounding up instead means all the things in that second come back again.
+    """
+    if dt.microsecond:
+        return dt.replace(microsecond=0) + datetime.timedelta(seconds=1)
+    return dt
 
 
 def _msg_time():
@@ -63,6 +145,34 @@ def _msg_time():
     return format_datetime(datetime.datetime.now())
 
 
+def _spool_info(chunks):
+    """Copy the chunks of an <info> element to a spooled temporary file,
+    computing the SHA1 hash HealthVault wants in the request header as we go.
+
+    :param chunks: iterable of strings which together make up the <info> element
+    :returns: (file, digest) - the spooled file, positioned at the start, and the raw SHA1 digest
+    """
+    info_hash = hashlib.sha1()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        info_hash.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool, info_hash.digest()
+
+
+def _part_length(part):
+    """Return the length in bytes of one part of a request payload (a string or a file)"""
+    if isinstance(part, basestring):
+        return len(part)
+    part.seek(0, 2)
+    length = part.tell()
+    part.seek(0)
+    return length
+
+
 class HealthVaultConn(object):
     """A HealthVaultConn object is used to access data for one patient ("record").
 
@@ -139,6 +249,39 @@ class HealthVaultConn(object):
        new wctoken, so you should set your HealthVaultConn.record_id back to None before getting the new wctoken.
        (UUID)
 
+    Optional behavior:
+
+    :param response_cache: a :py:class:`healthvaultlib.cache.ResponseCache` for :py:meth:`batch_get`
+       (and the methods that use it) to read through. It can be shared by many `HealthVaultConn` objects.
+    :param thing_store: a :py:class:`healthvaultlib.store.ThingStore` to write every thing fetched by
+       :py:meth:`batch_get` to. It can be shared by many `HealthVaultConn` objects.
+    :param range_index: a :py:class:`healthvaultlib.ranges.RangeIndex` for :py:meth:`batch_get` to answer
+       date-range requests from where it can. If given, it's used instead of `response_cache`.
+    :param person_info_cache: a :py:class:`healthvaultlib.cache.PersonInfoCache` for :py:meth:`connect`
+       to look up the record_id for a wctoken in before asking HealthVault.
+    :param negative_cache: a :py:class:`healthvaultlib.cache.NegativeCache`, so requests for records
+       or with wctokens that HealthVault has recently refused fail without asking it again.
+    :param retry_policy: a :py:class:`healthvaultlib.retry.RetryPolicy`, so requests that fail in a way
+       that might go away are tried again.
+    :param circuit_breaker: a :py:class:`healthvaultlib.breaker.CircuitBreaker`, so requests fail fast
+       while `server` is failing or slow. It can be shared by many `HealthVaultConn` objects.
+    :param limiter: a :py:class:`healthvaultlib.limits.AdaptiveLimiter` that limits how many requests
+       are in flight at once. Share one between all the `HealthVaultConn` objects in a process.
+    :param rate_limiter: a :py:class:`healthvaultlib.limits.RateLimiter` that limits how many requests
+       per second are sent for our application and each record.
+    :param coalescer: a :py:class:`healthvaultlib.cache.RequestCoalescer`, so identical GetThings
+       requests made at the same time share one HTTP call. Share one between all the
+       `HealthVaultConn` objects in a process.
+    :param connection_pool: a :py:class:`healthvaultlib.pool.ConnectionPool` to reuse connections to
+       HealthVault from. Share one between all the `HealthVaultConn` objects in a process.
+    :param hedger: a :py:class:`healthvaultlib.hedging.Hedger`, so a read that's much slower than most
+       is sent again and whichever copy answers first is used. Share one between all the
+       `HealthVaultConn` objects in a process.
+    :param float connect_timeout: how many seconds to wait for a connection to HealthVault. The default,
+       None, waits as long as the operating system does.
+    :param float read_timeout: how many seconds to wait for HealthVault to accept or send more of a request
+       or response. The default, None, waits forever.
+
     :raises: :py:exc:`HealthVaultException` if there's any problem connecting to HealthVault or getting authorized.
     """
 
@@ -150,7 +293,10 @@ class HealthVaultConn(object):
 
     def __init__(self, app_id, app_thumbprint, public_key, private_key, server=None, shell_server=None,
                  sharedsec=None, auth_token=None,
-                 wctoken=None, record_id=None):
+                 wctoken=None, record_id=None, response_cache=None, thing_store=None, range_index=None,
+                 person_info_cache=None, negative_cache=None, retry_policy=None,
+                 circuit_breaker=None, limiter=None, rate_limiter=None, coalescer=None,
+                 connection_pool=None, hedger=None, connect_timeout=None, read_timeout=None):
         self.wctoken = wctoken
         self.app_id = app_id
         self.app_thumbprint = app_thumbprint
@@ -163,9 +309,30 @@ class HealthVaultConn(object):
         self.sharedsec = sharedsec or str(randint(2 ** 64, 2 ** 65 - 1))
 
         self.record_id = record_id
+        self.person_id = None
+
+        self.response_cache = response_cache
+        self.person_info_cache = person_info_cache
+        self.negative_cache = negative_cache
+        self.thing_store = thing_store
+        self.range_index = range_index
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.coalescer = coalescer
+        self.connection_pool = connection_pool
+        self.hedger = hedger
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
 
         self.authorized = False
 
+        # Counts of requests made and bytes sent and received, e.g. to compare how much
+        # different GetThings formats cost
+        self.stats = dict(requests=0, bytes_sent=0, bytes_received=0)
+        self._stats_lock = threading.Lock()
+
         if not isinstance(public_key, long):
             raise ValueError("public key must be a long; it's %r" % public_key)
         if not isinstance(private_key, long):
@@ -334,16 +501,63 @@ class HealthVaultConn(object):
         if self.record_id:
             return self.record_id
 
+        person_info = self.get_person_info()
+        self.person_id = person_info['person_id']
+        return person_info['selected_record_id']
+
+    def get_person_info(self):
+        """Return information about the person whose wctoken we have and the records they've
+        authorized our application to access.
+
+        This uses `GetPersonInfo <https://platform.healthvault-ppe.com/platform/XSD/method-getpersoninfo.xsd>`_,
+        unless this conn has a `person_info_cache` that already knows the answer.
+
+        :returns: a dictionary
+
+        Example::
+
+            {'person_id': '1a6b7e2f-...', 'name': 'John Doe', 'selected_record_id': '9c0d1e55-...',
+             'records': [{'id': '9c0d1e55-...', 'name': 'John Doe', 'display_name': 'John',
+                          'rel_name': 'Self', 'state': 'Active',
+                          'auth_expires': datetime.datetime(9999, 12, 31, 23, 59, 59, 999000)}]}
+
+        :raises: HealthVaultException if the response doesn't say which record was selected.
+        """
+        if self.person_info_cache is not None:
+            person_info = self.person_info_cache.get(self.wctoken)
+            if person_info is not None:
+                return person_info
+
         (response, body, tree) = self._build_and_send_request("GetPersonInfo", "<info/>", use_record_id=False)
 
-        record_id_elt = tree.find('{urn:com.microsoft.wc.methods.response.GetPersonInfo}info/person-info/selected-record-id')
-        if record_id_elt is None:
+        person_info_elt = tree.find('{urn:com.microsoft.wc.methods.response.GetPersonInfo}info/person-info')
+        person_info = parse_person_info(person_info_elt) if person_info_elt is not None else {}
+        if not person_info.get('selected_record_id'):
             logger.error("No record ID in response.  response=%s" % body)
             raise HealthVaultException("selected record ID not found in HV response (%s)" % body)
 
-        return record_id_elt.text
+        if self.person_info_cache is not None:
+            self.person_info_cache.put(self.wctoken, person_info)
+        return person_info
 
-    def _send_request(self, payload):
+    def _connect(self, host, port):
+        """Return an HTTPS connection to host, connected using our timeouts, cut short
+        to the time left before the current deadline.
+
+        Not part of the public API.
+        """
+        connect_timeout = deadlines.limit(self.connect_timeout)
+        if connect_timeout is None:
+            conn = httplib.HTTPSConnection(host, port)
+        else:
+            conn = httplib.HTTPSConnection(host, port, timeout=connect_timeout)
+        conn.connect()
+        read_timeout = deadlines.limit(self.read_timeout)
+        if read_timeout != connect_timeout:
+            conn.sock.settimeout(read_timeout)
+        return conn
+
+    def _send_request(self, payload, idempotent=True):
         """
         Send payload as a request to the HealthVault API.
 
@@ -360,36 +574,136 @@ class HealthVaultConn(object):
             elementtree
                 ElementTree.Element object with parsed body
 
-        :param string payload: The request body
-        :raises: HealthVaultException if HTTP response status is not 200 or status in parsed response is not 0.
+        :param payload: The request body. Either a string, or a list of parts that
+            are sent one after another, each a string or a seekable file. Files are
+            sent in chunks of :py:data:`STREAM_CHUNK_SIZE` bytes, so they're never
+            read into memory all at once.
+        :param boolean idempotent: False if the request mustn't be sent twice (see
+            :py:data:`.retry.NON_IDEMPOTENT_METHODS`), so it's never sent again on a new
+            connection when a pooled one fails.
+        :raises: HealthVaultException if HTTP response status is not 200 or status in parsed response is not 0,
+            or :py:exc:`.exceptions.HealthVaultDeadlineExceededException` if the current deadline has passed.
+
+        Not part of the public API.
+        """
+        # Raises if the current deadline has already passed
+        deadlines.time_left()
+        if self.circuit_breaker is not None:
+            return self.circuit_breaker.call(self.server, self._limited_post, payload, idempotent)
+        return self._limited_post(payload, idempotent)
+
+    def _limited_post(self, payload, idempotent=True):
+        """Send payload to HealthVault once the limiter, if there is one, allows it.
+
+        Not part of the public API.
+        """
+        if self.limiter is not None:
+            return self.limiter.call(self._post, payload, idempotent)
+        return self._post(payload, idempotent)
+
+    def _post_on(self, conn, parts, length):
+        """Send the request on conn, and return the response (without reading it).
+
+        Not part of the public API.
+        """
+        self._send_on(conn, parts, length)
+        return conn.getresponse()
+
+    def _send_on(self, conn, parts, length):
+        """Send the request on conn.
 
         Not part of the public API.
         """
-        conn = httplib.HTTPSConnection(self.server, 443)
         conn.putrequest('POST', '/platform/wildcat.ashx')
         conn.putheader('Content-Type', 'text/xml')
-        conn.putheader('Content-Length', '%d' % len(payload))
+        conn.putheader('Content-Length', '%d' % length)
         conn.endheaders()
         #logger.debug("Posting request: %s" % payload)
         try:
-            conn.send(payload)
+            for part in parts:
+                if isinstance(part, basestring):
+                    conn.send(part)
+                    continue
+                part.seek(0)
+                chunk = part.read(STREAM_CHUNK_SIZE)
+                while chunk:
+                    conn.send(chunk)
+                    chunk = part.read(STREAM_CHUNK_SIZE)
         except socket.error, v:
             if v[0] == 32:      # Broken pipe
                 conn.close()
             raise
-        response = conn.getresponse()
-        if response.status != 200:
-            logger.error("Non-success HTTP response status from HealthVault.  Status=%d, message=%s" %
-                         (response.status, response.reason))
-            raise HealthVaultHTTPException("Non-success HTTP response status from HealthVault.  Status=%d, message=%s" %
-                                       (response.status, response.reason),
-                                        code=response.status)
-        body = response.read()
+
+    def _post(self, payload, idempotent=True):
+        """Send payload to HealthVault; the part of :py:meth:`_send_request` that goes
+        through the circuit breaker and limiter, if there are any.
+
+        If a pooled connection turns out to have been closed by HealthVault while it was
+        idle, an idempotent request is sent again on a new connection; but only if it failed
+        in a way that means HealthVault can't have acted on it: while it was being sent
+        (other than by timing out), or by the connection closing with no response at all.
+
+        Not part of the public API.
+        """
+        parts = [payload] if isinstance(payload, basestring) else payload
+        length = sum(_part_length(part) for part in parts)
+        pool = self.connection_pool
+        conn = pool.get(self.server, 443) if pool is not None else None
+        try:
+            if conn is not None:
+                hedging.use(conn)
+                conn.sock.settimeout(deadlines.limit(self.read_timeout))
+                unsent = False
+                try:
+                    try:
+                        self._send_on(conn, parts, length)
+                    except socket.error as e:
+                        # It didn't get through, unless it just timed out
+                        unsent = not isinstance(e, socket.timeout)
+                        raise
+                    try:
+                        response = conn.getresponse()
+                    except httplib.BadStatusLine:
+                        # Closed without a response, as an idle connection is
+                        unsent = True
+                        raise
+                except (socket.error, httplib.HTTPException):
+                    conn.close()
+                    if not (unsent and idempotent) or hedging.cancelled():
+                        raise
+                    # HealthVault closed it while it was idle; try a new one
+                    conn = None
+            if conn is None:
+                conn = self._connect(self.server, 443)
+                if pool is not None:
+                    pool.created()
+                hedging.use(conn)
+                response = self._post_on(conn, parts, length)
+            if response.status != 200:
+                conn.close()
+                logger.error("Non-success HTTP response status from HealthVault.  Status=%d, message=%s" %
+                             (response.status, response.reason))
+                raise HealthVaultHTTPException("Non-success HTTP response status from HealthVault.  Status=%d, message=%s" %
+                                           (response.status, response.reason),
+                                            code=response.status)
+            body = response.read()
+        except (socket.error, httplib.HTTPException):
+            if hedging.cancelled():
+                raise HealthVaultHedgeCancelledException("Cancelled; the other copy of the request finished first")
+            raise
+        if not hedging.finish():
+            # Cancelled just as it finished, so the connection may have been shut down
+            conn.close()
+            raise HealthVaultHedgeCancelledException("Cancelled; the other copy of the request finished first")
+        if pool is not None and not response.will_close:
+            pool.put(self.server, 443, conn)
+        self._count(requests=1, bytes_sent=length, bytes_received=len(body))
         tree = ET.fromstring(body)
         status = int(tree.find('status/code').text)
         if status != 0:
             msg = tree.find("status/error/message").text
-            logger.error("HealthVault error. status=%d, message=%s, request=%s, response=%s" % (status, msg, pretty_xml(payload), pretty_xml(body)))
+            request = pretty_xml(payload) if isinstance(payload, basestring) else "(streamed)"
+            logger.error("HealthVault error. status=%d, message=%s, request=%s, response=%s" % (status, msg, request, pretty_xml(body)))
             exc_class = _get_exception_class_for(status)
             raise exc_class(
                 "Non-success status from HealthVault API.  Status=%d, message=%s" % (status, msg),
@@ -404,26 +718,18 @@ class HealthVaultConn(object):
         #conditions = "7ea7a1f9-880b-4bd4-b593-f5660f20eda8"
         #weightmeasurementype = "3d34d87e-7fc1-4153-800f-f56592cb0d17"
 
-    def _build_and_send_request(self, method_name, info, method_version=1, use_record_id=True,
-                               use_target_person_id=False, use_wctoken=True):
-        """
-        Given the <info>...</info> part of a request, wrap it with all the identification and auth stuff
-        to form a complete request, call sendRequest() to send it, and return whatever sendRequest returns.
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, n in counts.items():
+                self.stats[name] += n
 
-        :param string method_name: The name of the method to call, e.g. "GetThings"
-        :param string info: The <info> part of the request
-        :param integer method_version: Override the default method version (1)
-        :param boolean use_record_id: Whether to include the <record-id> in the request (default: True)
-        :param boolean use_target_person_id: Whether to include the <target-person-id> in the request (default: False)
-        :param boolean use_wctoken: Whether to include the wctoken (<auth-token>) in the request (default: True)
+    def _build_request_head(self, method_name, method_version, headerinfo, use_record_id,
+                            use_target_person_id, use_wctoken):
+        """Return the start of a request, up to where the <info> goes, with the header
+        signed using our shared secret.
 
         Not part of the public API.
         """
-        # https://platform.healthvault-ppe.com/platform/XSD/request.xsd
-
-        infodigest = base64.encodestring(hashlib.sha1(info).digest())
-        headerinfo = '<info-hash><hash-data algName="SHA1">' + infodigest.strip() + '</hash-data></info-hash>'
-
         header = '<header>'\
                  '<method>' + method_name + '</method>'\
                  '<method-version>' + str(method_version) + '</method-version>'
@@ -459,11 +765,127 @@ class HealthVaultConn(object):
         hashedheader64 = base64.encodestring(hashedheader.digest())
 
         hauthxml = '<auth><hmac-data algName="HMACSHA1">' + hashedheader64.strip() + '</hmac-data></auth>'
-        payload = '<wc-request:request xmlns:wc-request="urn:com.microsoft.wc.request">' + hauthxml + header + info + '</wc-request:request>'
+        return '<wc-request:request xmlns:wc-request="urn:com.microsoft.wc.request">' + hauthxml + header
+
+    def _send_refreshing_auth_token(self, send):
+        """Return send(), first getting a new session token and calling it again if our
+        session token had expired and the retry policy says to.
+
+        Not part of the public API.
+        """
+        try:
+            return send()
+        except HealthVaultException as e:
+            if not (self.retry_policy.refresh_auth_token
+                    and e.code == HealthVaultStatus.AUTHENTICATED_SESSION_TOKEN_EXPIRED):
+                raise
+            logger.info("Session token expired, getting a new one")
+            self.auth_token = self._get_auth_token()
+            return send()
+
+    def _build_and_send_request(self, method_name, info, method_version=1, use_record_id=True,
+                               use_target_person_id=False, use_wctoken=True):
+        """
+        Given the <info>...</info> part of a request, wrap it with all the identification and auth stuff
+        to form a complete request, call sendRequest() to send it, and return whatever sendRequest returns.
 
-        return self._send_request(payload)
+        For large requests, `info` can be an iterable of strings (e.g. a generator) instead.
+        The pieces are hashed and spooled to a temporary file as they're produced, and
+        the request body is then streamed from there, so memory use stays bounded
+        however big the request is.
 
-    def batch_get(self, requests):
+        :param string method_name: The name of the method to call, e.g. "GetThings"
+        :param info: The <info> part of the request, as a string or an iterable of strings
+        :param integer method_version: Override the default method version (1)
+        :param boolean use_record_id: Whether to include the <record-id> in the request (default: True)
+        :param boolean use_target_person_id: Whether to include the <target-person-id> in the request (default: False)
+        :param boolean use_wctoken: Whether to include the wctoken (<auth-token>) in the request (default: True)
+
+        Not part of the public API.
+        """
+        # https://platform.healthvault-ppe.com/platform/XSD/request.xsd
+
+        record_id = self.record_id if use_record_id else None
+        wctoken = self.wctoken if use_wctoken else None
+        if self.negative_cache is not None:
+            self.negative_cache.check(record_id, wctoken)
+
+        if isinstance(info, basestring):
+            infodigest = base64.encodestring(hashlib.sha1(info).digest())
+        else:
+            info, digest = _spool_info(info)
+            infodigest = base64.encodestring(digest)
+        headerinfo = '<info-hash><hash-data algName="SHA1">' + infodigest.strip() + '</hash-data></info-hash>'
+        idempotent = method_name not in NON_IDEMPOTENT_METHODS
+
+        def post():
+            # Built afresh for each attempt, so the msg-time and auth token are current
+            head = self._build_request_head(method_name, method_version, headerinfo, use_record_id,
+                                            use_target_person_id, use_wctoken)
+            tail = '</wc-request:request>'
+            if isinstance(info, basestring):
+                return self._send_request(head + info + tail, idempotent=idempotent)
+            return self._send_request([head, info, tail], idempotent=idempotent)
+
+        def admit_hedge():
+            # A hedge is only worth sending if it can go straight away
+            if self.rate_limiter is None:
+                return True
+            try:
+                with self.rate_limiter.options(blocking=False):
+                    self.rate_limiter.acquire(self.app_id, record_id)
+            except HealthVaultRateLimitedException:
+                return False
+            return True
+
+        hedge = (self.hedger is not None and method_name in self.hedger.methods
+                 and idempotent and isinstance(info, basestring))
+
+        def send():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(self.app_id, record_id)
+            if hedge:
+                return self.hedger.call(post, admit_hedge)
+            return post()
+
+        def send_and_retry():
+            if self.retry_policy is None:
+                return send()
+            return self.retry_policy.call(lambda: self._send_refreshing_auth_token(send),
+                                          idempotent=idempotent,
+                                          description=method_name)
+
+        def send_and_record():
+            # Only the request actually sent records its failure, not any coalesced with it,
+            # so one failure only backs off once
+            try:
+                return send_and_retry()
+            except HealthVaultException as e:
+                if self.negative_cache is not None:
+                    self.negative_cache.failed(e, record_id, wctoken)
+                raise
+
+        try:
+            try:
+                if (self.coalescer is not None and method_name in self.coalescer.methods
+                        and isinstance(info, basestring)):
+                    key = self.coalescer.key(method_name, self.app_id, wctoken, record_id, info)
+                    result = self.coalescer.do(key, send_and_record)
+                else:
+                    result = send_and_record()
+            finally:
+                if not isinstance(info, basestring):
+                    info.close()
+        except HealthVaultException as e:
+            if use_wctoken and self.person_info_cache is not None and e.code in _WCTOKEN_STATUSES:
+                # The wctoken's no good any more, so neither is what we remembered about it
+                self.person_info_cache.invalidate(self.wctoken)
+            raise
+        if self.negative_cache is not None:
+            self.negative_cache.clear(record_id, wctoken)
+        return result
+
+    def batch_get(self, requests, include_info=False, deadline=None):
         """Request multiple kinds of things in a single batch request to reduce round-trip delays.
 
         :param list requests: A list of dictionaries. Each dictionary must have a 'datatype' key whose value
@@ -472,9 +894,30 @@ class HealthVaultConn(object):
             sense to provide min_date or max_date with.  Optionally it can also have a 'max' key whose
             value is the integer maximum number of records to return.
 
+            An 'updated_min' key, also a datetime, limits the results to things that were created or
+            changed since then, whatever their effective date. A 'sections' key can give a list
+            of the sections of each thing to return, from :py:data:`THING_SECTIONS`; the default
+            is ``['core']``. An 'include_xml' key set to False leaves out the things' data, which
+            is then None. A 'transforms' key can name HealthVault transforms to apply to the
+            data on the server, e.g. ``['mtt']``. (See :py:meth:`get_things`.)
+
+            What the extra sections and transforms return is included in each thing's info
+            (see `include_info` below).
+
+            A 'keys_only' key set to True makes the result for that request a list of
+            :py:data:`healthvaultlib.xmlutils.ThingKey` tuples, (thing_id, version_stamp,
+            type_id, eff_date, updated), without the things' data. That's much less to download
+            when we only need to know what's there and what's changed. Every key is included,
+            but `updated` is None for any beyond the first :py:data:`MAX_THINGS_PER_GROUP`.
+            See also :py:meth:`iter_thing_keys`.
+
             Records are always sorted by effective date descending, so passing max=1 will return the
             most recent record.
 
+            HealthVault only returns :py:data:`MAX_THINGS_PER_GROUP` things per group in full,
+            listing just the keys of the rest; those are then fetched by ID (or for 'keys_only',
+            returned as they are), so each result is complete.
+
             Example::
 
                 from healthvaultlib.datatypes import DataType
@@ -482,6 +925,12 @@ class HealthVaultConn(object):
                            {'datatype': DataType.HEIGHT_MEASUREMENT, 'min_date': datetime.datetime(...)},
                            {'datatype': DataType.DEVICES}])
 
+        :param boolean include_info: If true, the result for each request is a list of (info, data)
+            pairs, one per thing, where info is a dictionary identifying the thing, as returned by
+            :py:func:`healthvaultlib.xmlutils.parse_thing_info`, and data is the parsed thing.
+        :param float deadline: A ``time.time()`` by which the whole call must finish, however many
+            requests, retries and new session tokens it takes. (See :py:mod:`.deadlines`.)
+
         :returns: A list containing, in order, the same results that calling the individual methods to get the
             various datatypes would have returned.
 
@@ -496,15 +945,207 @@ class HealthVaultConn(object):
         if not isinstance(requests, list):
             requests = [requests]
 
+        with deadlines.deadline(deadline):
+            if self.range_index is not None:
+                return self.range_index.batch_get(self, requests, include_info)
+            if self.response_cache is not None:
+                return self.response_cache.batch_get(self, requests, include_info)
+            return self._batch_get(requests, include_info)
+
+    def batch(self):
+        """Return a :py:class:`healthvaultlib.batching.Batch`, to make several ``get_*`` calls
+        in one request.
+
+        Example::
+
+            with conn.batch() as batch:
+                weights = batch.get_weight_measurements(min_date=week_ago)
+                devices = batch.get_devices()
+            # Both were fetched in one GetThings request as the with statement ended
+            for weight in weights.result():
+                ...
+        """
+        return Batch(self)
+
+    def _batch_get(self, requests, include_info):
+        """Implement :py:meth:`batch_get`, without any caching.
+
+        Big batches are split by :py:func:`healthvaultlib.batching.plan_batches` into several
+        requests, which are sent up to :py:data:`BATCH_WORKERS` at a time.
+
+        Not part of the public API.
+        """
+        batches = plan_batches(requests, MAX_GROUPS_PER_REQUEST)
+        if len(batches) == 1:
+            return self._batch_get_one(requests, include_info)
+        response = [None] * len(requests)
+        results = run_concurrently(lambda batch: self._batch_get_one([requests[i] for i in batch], include_info),
+                                   batches, BATCH_WORKERS)
+        for batch, (result, exc_info) in zip(batches, results):
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            for index, group_result in zip(batch, result):
+                response[index] = group_result
+        return response
+
+    def _batch_get_one(self, requests, include_info, observe=None):
+        """Send a batch small enough for one GetThings request.
+
+        If `observe` is given, it's called with the number of things in the response, its
+        size in bytes and the seconds it took to get it (not counting any things fetched
+        afterwards by :py:meth:`_get_unprocessed`).
+
+        Not part of the public API.
+        """
         groups = [self._build_thing_group(**request) for request in requests]
         info = '<info>' + ''.join(groups) + '</info>'
 
+        start = time.time()
         (response, body, tree) = self._build_and_send_request("GetThings", info)
+        elapsed = time.time() - start
         #logger.debug("get_things response body:\n%s", body)
         info = tree.find('{urn:com.microsoft.wc.methods.response.GetThings}info')
-        response = [parse_group(group) for group in info.findall('group')]
+        response = []
+        for request, group in zip(requests, info.findall('group')):
+            if request.get('keys_only'):
+                response.append(parse_group_keys(group))
+                continue
+            things = parse_group_things(group)
+            if self.thing_store is not None and request.get('include_xml') is not False:
+                self.thing_store.put_things(self.record_id, things)
+            things += self._get_unprocessed(request, group)
+            response.append(things if include_info else group_data(things))
+        if observe is not None:
+            observe(len(info.findall('group/thing')), len(body), elapsed)
         return response
 
+    def _get_unprocessed(self, request, group):
+        """Return (info, data) pairs for the things HealthVault left out of a group's response
+        because there were more than it returns in full, in the order it listed them.
+
+        Not part of the public API.
+        """
+        ids = [elt.text for elt in group.findall('unprocessed-thing-key-info/thing-id')]
+        if not ids:
+            return []
+        fetch = dict((name, request[name]) for name in ('sections', 'include_xml', 'transforms') if name in request)
+        by_id = [dict(fetch, thing_ids=ids[i:i + MAX_THINGS_PER_GROUP])
+                 for i in range(0, len(ids), MAX_THINGS_PER_GROUP)]
+        found = {}
+        for things in self._batch_get(by_id, True):
+            found.update((info['thing_id'], (info, data)) for (info, data) in things)
+        # Any that have been deleted since are left out
+        return [found[thing_id] for thing_id in ids if thing_id in found]
+
+    def iter_thing_keys(self, datatype, min_date=None, max_date=None, updated_min=None, page_size=KEYS_PAGE_SIZE,
+                        deadline=None):
+        """Generate the keys of all the things of a data type, however many there are, asking
+        for `page_size` of them per request.
+
+        HealthVault returns things in order of effective date, newest first, so each request
+        after the first asks for things no newer than the oldest one so far (rounded up to
+        a whole second, as that's all HealthVault is told). Things from that same second
+        come back again and are skipped.
+
+        Example::
+
+            ours = dict(db.query("SELECT thing_id, version_stamp FROM weights"))
+            changed = [key for key in conn.iter_thing_keys(DataType.WEIGHT_MEASUREMENTS)
+                       if ours.get(key.thing_id) != key.version_stamp]
+
+        :param string datatype: The UUID representing the data type to list.
+        :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
+        :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param datetime.datetime updated_min: Only things created or updated since this are returned.
+        :param integer page_size: How many keys to ask for in each request.
+        :param float deadline: A ``time.time()`` by which all the pages must have been fetched.
+        :returns: an iterator of :py:data:`healthvaultlib.xmlutils.ThingKey` tuples
+        """
+        # IDs of the things we've already returned that the next page may return again
+        boundary = set()
+        while True:
+            keys = self.batch_get({'datatype': datatype, 'min_date': min_date, 'max_date': max_date,
+                                   'updated_min': updated_min, 'max': page_size, 'keys_only': True},
+                                  deadline=deadline)[0]
+            new = [key for key in keys if key.thing_id not in boundary]
+            for key in new:
+                yield key
+            if len(keys) < page_size:
+                return
+            if not new:
+                # More things share one effective date than fit in a page
+                page_size *= 2
+                continue
+            oldest = keys[-1].eff_date
+            cursor = _round_up_to_second(oldest)
+            if cursor != max_date:
+                boundary = set()
+            second = oldest.replace(microsecond=0)
+            boundary.update(key.thing_id for key in keys if key.eff_date >= second)
+            max_date = cursor
+
+    def iter_things(self, datatype, min_date=None, max_date=None, updated_min=None, sections=None,
+                    page_size=THINGS_PAGE_SIZE, page_sizer=None, deadline=None):
+        """Generate all the things of a data type, however many there are, a page at a time,
+        as (info, data) pairs like :py:meth:`batch_get` returns with `include_info`.
+
+        Pages are fetched the same way as by :py:meth:`iter_thing_keys`. How many things to
+        ask for in each is `page_size`, unless a :py:class:`healthvaultlib.paging.PageSizer`
+        is given as `page_sizer`, which then decides, learning as it goes from the size of
+        each response and how long it took. Either way it's at most :py:data:`MAX_THINGS_PER_GROUP`,
+        the most HealthVault returns in full, unless more than that share one second.
+
+        Pages always come from HealthVault, not from the `response_cache` or `range_index`.
+
+        Example::
+
+            sizer = PageSizer(target_size=32 * 1024)
+            for info, weight in conn.iter_things(DataType.WEIGHT_MEASUREMENTS, page_sizer=sizer):
+                ...
+
+        :param string datatype: The UUID representing the data type to get.
+        :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
+        :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param datetime.datetime updated_min: Only things created or updated since this are returned.
+        :param list sections: The sections of each thing to return; see :py:meth:`batch_get`.
+        :param integer page_size: How many things to ask for in each request, without a `page_sizer`.
+        :param page_sizer: A :py:class:`healthvaultlib.paging.PageSizer` to choose the page sizes.
+        :param float deadline: A ``time.time()`` by which all the pages must have been fetched.
+        :returns: an iterator of (info, data) pairs
+        """
+        # IDs of the things we've already returned that the next page may return again
+        boundary = set()
+        # The least we can ask for and still get past max_date
+        least = 1
+        while True:
+            size = page_sizer.page_size(datatype) if page_sizer is not None else page_size
+            size = max(least, min(size, MAX_THINGS_PER_GROUP))
+            observed = []
+            with deadlines.deadline(deadline):
+                things = self._batch_get_one([{'datatype': datatype, 'min_date': min_date, 'max_date': max_date,
+                                               'updated_min': updated_min, 'sections': sections, 'max': size}],
+                                             True, observe=lambda *args: observed.append(args))[0]
+            if page_sizer is not None and observed:
+                page_sizer.observe(datatype, *observed[0])
+            new = [(info, data) for (info, data) in things if info['thing_id'] not in boundary]
+            for thing in new:
+                yield thing
+            if len(things) < size:
+                return
+            if not new:
+                # More things share one second than fit in a page; the ones that
+                # don't come back in full are fetched by ID
+                least = size * 2
+                continue
+            least = 1
+            oldest = things[-1][0]['eff_date']
+            cursor = _round_up_to_second(oldest)
+            if cursor != max_date:
+                boundary = set()
+            second = oldest.replace(microsecond=0)
+            boundary.update(info['thing_id'] for (info, data) in things if info['eff_date'] >= second)
+            max_date = cursor
+
     def associate_alternate_id(self, idstring):
         """Associate some identification string from your application to the current person and record.
 
@@ -548,16 +1189,210 @@ class HealthVaultConn(object):
         info = '<info><alternate-id>%s</alternate-id></info>' % idstring
         self._build_and_send_request("DisassociateAlternateId", info)
 
-    def _build_thing_group(self, datatype, min_date=None, max_date=None, max=None, filter=None):
+    def _subscription_xml(self, url, type_ids, notification_key, notification_key_version_id, subscription_id=None):
+        """Return the <subscription>...</subscription> part of a request to create or update
+        an event subscription.
+
+        Internal use only.
+        """
+        return '<subscription>'\
+               '<common>'\
+               '{id}'\
+               '<notification-authentication-info><hv-eventing-shared-key>'\
+               '<notification-key>{key}</notification-key>'\
+               '<notification-key-version-id>{version}</notification-key-version-id>'\
+               '</hv-eventing-shared-key></notification-authentication-info>'\
+               '<notification-channel><http-notification-channel>'\
+               '<url>{url}</url>'\
+               '</http-notification-channel></notification-channel>'\
+               '</common>'\
+               '<record-item-changed-event><filters><filter><type-ids>'\
+               '{type_ids}'\
+               '</type-ids></filter></filters></record-item-changed-event>'\
+               '</subscription>'.format(
+                   id='<id>%s</id>' % subscription_id if subscription_id else '',
+                   key=escape(notification_key),
+                   version=escape(notification_key_version_id),
+                   url=escape(url),
+                   type_ids=''.join('<type-id>%s</type-id>' % type_id for type_id in type_ids))
+
+    def subscribe(self, url, type_ids, notification_key, notification_key_version_id):
+        """Ask HealthVault to notify our application when things of some types change in any
+        record the application is authorized to access.
+
+        This uses `SubscribeToEvent <https://platform.healthvault-ppe.com/platform/XSD/method-subscribetoevent.xsd>`_.
+        It doesn't need a user to be connected.
+
+        HealthVault will POST notifications to `url`, signed with `notification_key`.
+        See :py:class:`healthvaultlib.notifications.NotificationReceiver` for a WSGI
+        application that can receive them.
+
+        :param string url: The HTTPS URL to send notifications to.
+        :param list type_ids: The data types to be notified about, e.g. ``[DataType.WEIGHT_MEASUREMENTS]``
+        :param string notification_key: A secret shared with HealthVault, used to sign notifications.
+        :param string notification_key_version_id: Identifies this version of the key, so the key
+            can be changed later without losing notifications signed with the old one.
+        :returns: The new subscription's ID (UUID)
+        :raises: :py:exc:`HealthVaultException` on errors, e.g. SUBSCRIPTION_LIMIT_EXCEEDED (133).
+        """
+        info = '<info>' + self._subscription_xml(url, type_ids, notification_key,
+                                                 notification_key_version_id) + '</info>'
+        (response, body, tree) = self._build_and_send_request("SubscribeToEvent", info,
+                                                              use_record_id=False, use_wctoken=False)
+        info = tree.find('{urn:com.microsoft.wc.methods.response.SubscribeToEvent}info')
+        return info.find('subscription-id').text
+
+    def get_subscriptions(self):
+        """Return our application's event subscriptions.
+
+        This uses `GetEventSubscriptions
+        <https://platform.healthvault-ppe.com/platform/XSD/method-geteventsubscriptions.xsd>`_.
+
+        :returns: a list of dictionaries
+
+        Example::
+
+            [{'common': {'id': '9c8b8a6e-...',
+                         'notification_authentication_info': {
+                             'hv_eventing_shared_key': {'notification_key': 'secret',
+                                                        'notification_key_version_id': '1'}},
+                         'notification_channel': {
+                             'http_notification_channel': {'url': 'https://example.com/hv/notify'}}},
+              'record_item_changed_event': {
+                  'filters': [{'type_ids': ['3d34d87e-7fc1-4153-800f-f56592cb0d17']}]}}]
+        """
+        (response, body, tree) = self._build_and_send_request("GetEventSubscriptions", "<info/>",
+                                                              use_record_id=False, use_wctoken=False)
+        info = tree.find('{urn:com.microsoft.wc.methods.response.GetEventSubscriptions}info')
+        return [parse_subscription(elt) for elt in info.iter('subscription')]
+
+    def update_subscription(self, subscription_id, url, type_ids, notification_key, notification_key_version_id):
+        """Replace the details of an existing event subscription.
+
+        This uses `UpdateEventSubscription
+        <https://platform.healthvault-ppe.com/platform/XSD/method-updateeventsubscription.xsd>`_.
+        The parameters are the same as for :py:meth:`subscribe`.
+
+        :param string subscription_id: The ID returned by :py:meth:`subscribe`.
+        :raises: :py:exc:`HealthVaultException` on errors, e.g. SUBSCRIPTION_NOT_FOUND (132).
+        """
+        info = '<info>' + self._subscription_xml(url, type_ids, notification_key,
+                                                 notification_key_version_id, subscription_id) + '</info>'
+        self._build_and_send_request("UpdateEventSubscription", info, use_record_id=False, use_wctoken=False)
+
+    def unsubscribe(self, subscription_id):
+        """Delete an event subscription.
+
+        This uses `UnsubscribeToEvent
+        <https://platform.healthvault-ppe.com/platform/XSD/method-unsubscribetoevent.xsd>`_.
+
+        :param string subscription_id: The ID returned by :py:meth:`subscribe`.
+        :raises: :py:exc:`HealthVaultException` on errors, e.g. SUBSCRIPTION_NOT_FOUND (132).
+        """
+        info = '<info><subscription-id>%s</subscription-id></info>' % subscription_id
+        self._build_and_send_request("UnsubscribeToEvent", info, use_record_id=False, use_wctoken=False)
+
+    def put_things(self, things):
+        """Add or update things.
+
+        This uses `PutThings <https://platform.healthvault-ppe.com/platform/XSD/method-putthings.xsd>`_.
+
+        The things are written to a spooled temporary file as they're hashed, and sent from
+        it in chunks, so however many there are, they're never held in memory all at once.
+
+        :param things: an iterable (e.g. a generator) of strings, each the XML of one
+            <thing> element. To update a thing, include its thing-id with the version stamp
+            it has now; leave it out to add a new thing.
+        :returns: a list of (thing_id, version_stamp) pairs, one for each thing, in order.
+        """
+        def chunks():
+            yield '<info>'
+            for thing in things:
+                yield thing
+            yield '</info>'
+        (response, body, tree) = self._build_and_send_request("PutThings", chunks(), method_version=2)
+        return [(key.text, key.get('version-stamp'))
+                for key in tree.findall('{urn:com.microsoft.wc.methods.response.PutThings}info/thing-id')]
+
+    def remove_things(self, thing_keys, chunk_size=MAX_THINGS_PER_REQUEST, max_workers=4):
+        """Delete things, naming as many in each request as HealthVault allows and
+        sending several requests at a time.
+
+        This uses `RemoveThings <https://platform.healthvault-ppe.com/platform/XSD/method-removethings.xsd>`_.
+
+        HealthVault removes all the things in a request or none of them. If a request fails
+        because of some of the things in it (e.g. one was already deleted, or its version stamp
+        is out of date), it's split in half and retried until the failing things are identified,
+        so one bad key doesn't stop the others from being removed.
+
+        :param thing_keys: a list of (thing_id, version_stamp) pairs
+        :param integer chunk_size: How many things to name in each request to start with.
+        :param integer max_workers: The most requests to have in flight at the same time.
+        :returns: a dictionary mapping each thing_id to None if it was removed, or to the
+            exception (usually a :py:exc:`HealthVaultException`) explaining why it wasn't.
+
+        Example::
+
+            {'5b23c6c5-...': None,
+             '9a1d0e8e-...': HealthVaultException('Non-success status from HealthVault API.  Status=13, ...')}
+        """
+        thing_keys = list(thing_keys)
+        chunks = [thing_keys[i:i + chunk_size] for i in range(0, len(thing_keys), chunk_size)]
+        outcomes = {}
+        results = run_concurrently(self._remove_things_chunk, chunks, max_workers)
+        for chunk, (result, exc_info) in zip(chunks, results):
+            if exc_info is not None:
+                # Something like a network error
+                result = dict((thing_id, exc_info[1]) for (thing_id, version_stamp) in chunk)
+            outcomes.update(result)
+        return outcomes
+
+    def _remove_things_chunk(self, thing_keys):
+        """Remove some things in one request, splitting it up if it fails because of
+        particular things. Returns a dictionary like :py:meth:`remove_things`.
+
+        Not part of the public API.
+        """
+        info = '<info>' + ''.join('<thing-id version-stamp="%s">%s</thing-id>' % (version_stamp, thing_id)
+                                  for (thing_id, version_stamp) in thing_keys) + '</info>'
+        try:
+            self._build_and_send_request("RemoveThings", info)
+        except HealthVaultException as e:
+            if e.code not in _THING_STATUSES:
+                return dict((thing_id, e) for (thing_id, version_stamp) in thing_keys)
+            if len(thing_keys) == 1:
+                return {thing_keys[0][0]: e}
+            half = len(thing_keys) // 2
+            outcomes = self._remove_things_chunk(thing_keys[:half])
+            outcomes.update(self._remove_things_chunk(thing_keys[half:]))
+            return outcomes
+        return dict((thing_id, None) for (thing_id, version_stamp) in thing_keys)
+
+    def _build_thing_group(self, datatype=None, min_date=None, max_date=None, max=None, filter=None,
+                           thing_ids=None, thing_keys=None, updated_min=None, sections=None, include_xml=True,
+                           keys_only=False, transforms=None):
         """Return the <group>...</group> part of a GetThings request for this datatype
         and optional data parameters.
 
-        :param string datatype: The UUID representing the data type to retrieve.
+        :param string datatype: The UUID representing the data type to retrieve. Can be
+           None if `thing_ids` or `thing_keys` is given.
         :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
         :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
         :param integer max: Maximum number of records to return.
         :param string filter: XML to be added to the filter section of the query to
            further limit the data returned.
+        :param list thing_ids: Only return the things with these IDs.
+        :param list thing_keys: Only return these versions of things, given as (thing_id, version_stamp) pairs.
+        :param datetime.datetime updated_min: Only things created or updated since this are returned.
+        :param list sections: The sections of each thing to return, from :py:data:`THING_SECTIONS`.
+           Defaults to ``['core']``.
+        :param boolean include_xml: If False, leave out each thing's data-xml, e.g. when we only
+           need to know which things there are and their version stamps.
+        :param boolean keys_only: Ask for just what's needed to identify each thing and tell
+           when it last changed; overrides `sections` and `include_xml`.
+        :param list transforms: Names of transforms for HealthVault to apply to each thing's
+           data, e.g. ``['mtt', 'stt']``. Each is returned as well as, or, if `include_xml`
+           is False, instead of the raw data.
 
         :returns: string containing the "<group>...</group>" part of the GetThings request that will
            retrieve that data type with those parameters.
@@ -565,24 +1400,110 @@ class HealthVaultConn(object):
         Internal use only.
         """
 
+        if keys_only:
+            sections, include_xml, transforms = KEYS_ONLY_SECTIONS, False, None
+        sections = sections or ['core']
+        for section in sections:
+            if section not in THING_SECTIONS:
+                raise ValueError("Unknown thing section %r" % section)
         filter = filter or ""
+        if datatype:
+            filter = '<type-id>' + datatype + '</type-id>' + filter
         if min_date:
             filter += '<eff-date-min>' + format_datetime(min_date) + '</eff-date-min>'
         if max_date:
             filter += '<eff-date-max>' + format_datetime(max_date) + '</eff-date-max>'
+        if updated_min:
+            filter += '<updated-date-min>' + format_datetime(updated_min) + '</updated-date-min>'
         if max is None:
             grp_tag = '<group>'
         else:
             grp_tag = '<group max="%d">' % max
+        ids = ''.join('<id>%s</id>' % thing_id for thing_id in thing_ids or [])
+        ids += ''.join('<key version-stamp="%s">%s</key>' % (version_stamp, thing_id)
+                       for (thing_id, version_stamp) in thing_keys or [])
         return grp_tag +\
-               '<filter>'\
-               '<type-id>{datatype}</type-id>'\
-               '{filter}' \
-               '</filter>'\
-               '<format><section>core</section><xml/></format>'\
-               '</group>'.format(datatype=datatype, filter=filter)
-
-    def get_things(self, hv_datatype, min_date=None, max_date=None, max=None, filter=None, debug=False):
+               ids +\
+               ('<filter>' + filter + '</filter>' if filter else '') +\
+               '<format>' +\
+               ''.join('<section>%s</section>' % section for section in sections) +\
+               ('<xml/>' if include_xml else '') +\
+               ''.join('<xml>%s</xml>' % escape(transform) for transform in transforms or []) +\
+               '</format>'\
+               '</group>'
+
+    def get_things_by_ids(self, thing_ids, max_workers=4, deadline=None):
+        """Fetch things whose IDs we already know, whatever their data types.
+
+        The IDs are packed :py:data:`MAX_THINGS_PER_GROUP` to a group and
+        :py:data:`MAX_GROUPS_PER_REQUEST` groups to a GetThings request, and up
+        to `max_workers` requests are sent at a time. Things that HealthVault
+        leaves out of a response because of its own limits are asked for again.
+
+        :param list thing_ids: The IDs of the things to fetch. (UUIDs)
+        :param integer max_workers: The most requests to have in flight at the same time.
+        :param float deadline: A ``time.time()`` by which all the requests must have finished.
+        :returns: a dictionary mapping the ID of each thing found to the parsed thing, as the
+            `get_*` method for its data type would return it in its list. IDs of things that
+            weren't found (e.g. they've been deleted) are left out.
+        :raises: :py:exc:`HealthVaultException` if any request fails, or there's a thing whose
+            data type we can't parse.
+        """
+        with deadlines.deadline(deadline):
+            return self._get_things_by_reference('thing_ids', list(thing_ids), max_workers)
+
+    def get_things_by_keys(self, thing_keys, max_workers=4, deadline=None):
+        """Like :py:meth:`get_things_by_ids`, but fetches particular versions of things.
+
+        :param list thing_keys: (thing_id, version_stamp) pairs.
+        :param integer max_workers: The most requests to have in flight at the same time.
+        :param float deadline: A ``time.time()`` by which all the requests must have finished.
+        :returns: a dictionary mapping thing IDs to parsed things.
+        """
+        with deadlines.deadline(deadline):
+            return self._get_things_by_reference('thing_keys', list(thing_keys), max_workers)
+
+    def _get_things_by_reference(self, kind, refs, max_workers):
+        """Implement :py:meth:`get_things_by_ids` (`kind` is 'thing_ids') and
+        :py:meth:`get_things_by_keys` (`kind` is 'thing_keys').
+
+        Not part of the public API.
+        """
+        per_request = MAX_THINGS_PER_GROUP * MAX_GROUPS_PER_REQUEST
+        chunks = [refs[i:i + per_request] for i in range(0, len(refs), per_request)]
+        things = {}
+        for (result, exc_info) in run_concurrently(lambda chunk: self._get_things_chunk(kind, chunk),
+                                                   chunks, max_workers):
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            things.update(result)
+        return things
+
+    def _get_things_chunk(self, kind, refs):
+        """Fetch the things for up to one request's worth of IDs or keys.
+
+        Not part of the public API.
+        """
+        groups = [self._build_thing_group(**{kind: refs[i:i + MAX_THINGS_PER_GROUP]})
+                  for i in range(0, len(refs), MAX_THINGS_PER_GROUP)]
+        info = '<info>' + ''.join(groups) + '</info>'
+        (response, body, tree) = self._build_and_send_request("GetThings", info)
+        info = tree.find('{urn:com.microsoft.wc.methods.response.GetThings}info')
+        things = {}
+        unprocessed = []
+        for group in info.findall('group'):
+            for thing in group.findall('thing'):
+                things[thing.find('thing-id').text] = parse_thing(thing)
+            for key in group.findall('unprocessed-thing-key-info/thing-id'):
+                unprocessed.append(key.text if kind == 'thing_ids' else (key.text, key.get('version-stamp')))
+        if unprocessed:
+            if len(unprocessed) >= len(refs):
+                raise HealthVaultException("HealthVault returned none of the things requested in full")
+            things.update(self._get_things_chunk(kind, unprocessed))
+        return things
+
+    def get_things(self, hv_datatype, min_date=None, max_date=None, max=None, filter=None, debug=False,
+                   updated_min=None, sections=None, include_xml=True, keys_only=False, transforms=None):
         """Call the get_things API to retrieve some things (data items).
 
         See also
@@ -594,6 +1515,13 @@ class HealthVaultConn(object):
         :param integer max: Maximum number of records to return.
         :param string filter: XML to be added to the filter section of the query to
            further limit the data returned.
+        :param datetime.datetime updated_min: Only things created or updated since this are returned.
+        :param list sections: The sections of each thing to return, from :py:data:`THING_SECTIONS`.
+           Defaults to ``['core']``.
+        :param boolean include_xml: If False, leave out each thing's data-xml.
+        :param boolean keys_only: Ask for just what's needed to identify each thing and tell
+           when it last changed; overrides `sections` and `include_xml`.
+        :param list transforms: Names of transforms for HealthVault to apply to each thing's data.
         :returns: ElementTree Element object containing the <wc:info> element of the response
         :raises: HealthVaultException if the request doesn't succeed with a 200 status
             or the status in the XML response is non-zero.
@@ -604,20 +1532,23 @@ class HealthVaultConn(object):
             yet been implemented here.
         """
 
-        info = '<info>' + self._build_thing_group(hv_datatype, min_date, max_date, max, filter) + '</info>'
+        info = '<info>' + self._build_thing_group(hv_datatype, min_date, max_date, max, filter,
+                                                  updated_min=updated_min, sections=sections,
+                                                  include_xml=include_xml, keys_only=keys_only,
+                                                  transforms=transforms) + '</info>'
 
         (response, body, tree) = self._build_and_send_request("GetThings", info)
         if debug:
             logger.debug("get_things response body:\n%s", body)
-        info = tree.find('{urn:com.microsoft.wc.methods.response.GetThings}info')
-        print "get_things returning: %s" % elt_as_string(info)
-        return info
+        return tree.find('{urn:com.microsoft.wc.methods.response.GetThings}info')
 
 
-    def get_basic_demographic_info(self):
+    def get_basic_demographic_info(self, deadline=None):
         """Gets `basic demographic info (v2)
         <http://developer.healthvault.com/pages/types/type.aspx?id=3b3e6b16-eb69-483c-8d7e-dfe116ae6092>`_
 
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
+
         :returns: a dictionary - some values might be None if they're not returned by HealthVault.
 
         Example::
@@ -628,24 +1559,26 @@ class HealthVaultConn(object):
         :raises: HealthVaultException if the request fails in some way.
         """
 
-        return self.batch_get({'datatype': DataType.BASIC_DEMOGRAPHIC_DATA})[0]
+        return self.batch_get({'datatype': DataType.BASIC_DEMOGRAPHIC_DATA}, deadline=deadline)[0]
 
-    def get_blood_glucose_measurements(self, min_date=None, max_date=None, max=None, debug=False):
+    def get_blood_glucose_measurements(self, min_date=None, max_date=None, max=None, debug=False, deadline=None):
         """Get `Blood Glucose Measurements
         <http://developer.healthvault.com/pages/types/type.aspx?id=879e7c04-4e8a-4707-9ad3-b054df467ce4>`_
 
         :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
         :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
         :returns: a list of dictionaries.
         """
-        return self.batch_get({'datatype': DataType.BLOOD_GLUCOSE_MEASUREMENT, 'min_date': min_date, 'max_date': max_date, 'max': max})[0]
+        return self.batch_get({'datatype': DataType.BLOOD_GLUCOSE_MEASUREMENT, 'min_date': min_date, 'max_date': max_date, 'max': max}, deadline=deadline)[0]
 
-    def get_blood_pressure_measurements(self, min_date=None, max_date=None, max=None):
+    def get_blood_pressure_measurements(self, min_date=None, max_date=None, max=None, deadline=None):
         """Get `Blood Pressure measurements
         <http://developer.healthvault.com/pages/types/type.aspx?id=ca3c57f4-f4c1-4e15-be67-0a3caf5414ed>`_
 
         :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
         :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
         :returns: a list of dictionaries
 
         Example::
@@ -668,24 +1601,26 @@ class HealthVaultConn(object):
         :type max_date: datetime.datetime
         :raises: HealthVaultException if the request fails in some way.
         """
-        return self.batch_get({'datatype': DataType.BLOOD_PRESSURE_MEASUREMENTS, 'min_date': min_date, 'max_date': max_date, 'max': max})[0]
+        return self.batch_get({'datatype': DataType.BLOOD_PRESSURE_MEASUREMENTS, 'min_date': min_date, 'max_date': max_date, 'max': max}, deadline=deadline)[0]
 
-    def get_height_measurements(self, min_date=None, max_date=None, max=None):
+    def get_height_measurements(self, min_date=None, max_date=None, max=None, deadline=None):
         """Get `Height measurements
         <http://developer.healthvault.com/pages/types/type.aspx?id=40750a6a-89b2-455c-bd8d-b420a4cb500b>`_
 
         :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
         :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
         :returns: list of dictionaries
         """
-        return self.batch_get({'datatype': DataType.HEIGHT_MEASUREMENTS, 'min_date': min_date, 'max_date': max_date, 'max': max})[0]
+        return self.batch_get({'datatype': DataType.HEIGHT_MEASUREMENTS, 'min_date': min_date, 'max_date': max_date, 'max': max}, deadline=deadline)[0]
 
-    def get_weight_measurements(self, min_date=None, max_date=None, max=None):
+    def get_weight_measurements(self, min_date=None, max_date=None, max=None, deadline=None):
         """Get all `weight measurements
         <http://developer.healthvault.com/pages/types/type.aspx?id=3d34d87e-7fc1-4153-800f-f56592cb0d17>`_
 
         :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
         :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
         :returns: a list of dictionaries
 
         Example::
@@ -698,12 +1633,14 @@ class HealthVaultConn(object):
 
         :raises: HealthVaultException if the request fails in some way.
         """
-        return self.batch_get({'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': min_date, 'max_date': max_date, 'max': max})[0]
+        return self.batch_get({'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': min_date, 'max_date': max_date, 'max': max}, deadline=deadline)[0]
 
-    def get_devices(self):
+    def get_devices(self, deadline=None):
         """Get `devices
         <http://developer.healthvault.com/pages/types/type.aspx?id=ef9cf8d5-6c0b-4292-997f-4047240bc7be>`_
 
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
+
         :returns: a list of dictionaries.
 
         Example::
@@ -734,24 +1671,180 @@ class HealthVaultConn(object):
 
         :raises: HealthVaultException if the request fails in some way.
         """
-        return self.batch_get({'datatype': DataType.DEVICES})[0]
+        return self.batch_get({'datatype': DataType.DEVICES}, deadline=deadline)[0]
 
-    def get_exercise(self, min_date=None, max_date=None, max=None):
+    def get_exercise(self, min_date=None, max_date=None, max=None, deadline=None):
         """Returns `exercise records
         <http://developer.healthvault.com/sdk/docs/urn.com.microsoft.wc.thing.exercise.2.html>`_
 
         :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
         :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
         :returns: list of dictionaries with exercise things
         """
-        return self.batch_get({'datatype': DataType.EXERCISE, 'min_date': min_date, 'max_date': max_date, 'max': max})[0]
+        return self.batch_get({'datatype': DataType.EXERCISE, 'min_date': min_date, 'max_date': max_date, 'max': max}, deadline=deadline)[0]
 
-    def get_sleep_sessions(self, min_date=None, max_date=None, max=None):
+    def get_sleep_sessions(self, min_date=None, max_date=None, max=None, deadline=None):
         """Returns `sleep session records
         <http://developer.healthvault.com/pages/types/type.aspx?id=11c52484-7f1a-11db-aeac-87d355d89593>`_.
 
         :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
         :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :param float deadline: A ``time.time()`` by which the call must finish. (See :py:mod:`.deadlines`.)
         :returns: list of dictionaries with sleep sessions.
         """
-        return self.batch_get({'datatype': DataType.SLEEP_SESSIONS, 'min_date': min_date, 'max_date': max_date, 'max': max})[0]
+        return self.batch_get({'datatype': DataType.SLEEP_SESSIONS, 'min_date': min_date, 'max_date': max_date, 'max': max}, deadline=deadline)[0]
+
+    def _open_blob_url(self, url):
+        """Return (connection, path) for a blob URL that HealthVault gave us.
+
+        Not part of the public API.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        return self._connect(parts.hostname, parts.port or 443), path
+
+    def begin_put_blob(self):
+        """Ask HealthVault where and how to upload a new blob.
+
+        This uses `BeginPutBlob <https://platform.healthvault-ppe.com/platform/XSD/method-beginputblob.xsd>`_.
+        Most applications will want :py:meth:`upload_blob` or :py:meth:`put_blob` instead.
+
+        :returns: a dictionary
+
+        Example::
+
+            {'blob_ref_url': 'https://platform.healthvault-ppe.com/streaming/wildcatblob.ashx?blob-ref-token=...',
+             'blob_chunk_size': 4194304,
+             'max_blob_size': 1073741824,
+             'blob_hash_algorithm': 'SHA256Block',
+             'block_size': 2097152}
+        """
+        (response, body, tree) = self._build_and_send_request("BeginPutBlob", "<info/>")
+        return parse_begin_put_blob(tree.find('{urn:com.microsoft.wc.methods.response.BeginPutBlob}info'))
+
+    def upload_blob(self, fileobj):
+        """Upload the contents of a file-like object as a new blob, without attaching it to any thing yet.
+
+        The data is read and sent in chunks of the size HealthVault asks for, using a fixed pair of
+        buffers, so the blob is never held in memory as a whole.
+
+        :param fileobj: a file-like object, read until end of file.
+        :returns: a dictionary with what's needed to attach the blob to a thing, plus throughput metrics
+
+        Example::
+
+            {'blob_ref_url': 'https://...', 'content_length': 10485760, 'hash': 'base64 hash',
+             'block_size': 2097152, 'bytes': 10485760, 'seconds': 2.5, 'bytes_per_second': 4194304.0}
+
+        :raises: :py:exc:`HealthVaultException` if the upload fails in some way.
+        """
+        started = time.time()
+        params = self.begin_put_blob()
+        hasher = BlobHasher(params['block_size'])
+        conn, path = self._open_blob_url(params['blob_ref_url'])
+        try:
+            nbytes = upload_chunks(conn, path, fileobj, params['blob_chunk_size'], hasher)
+        finally:
+            conn.close()
+        result = transfer_stats(nbytes, started)
+        result.update(
+            blob_ref_url=params['blob_ref_url'],
+            content_length=nbytes,
+            hash=hasher.digest(),
+            block_size=params['block_size'],
+        )
+        logger.debug("Uploaded blob of %d bytes at %s bytes/second", nbytes, result['bytes_per_second'])
+        return result
+
+    def put_blob(self, thing_id, version_stamp, fileobj, name="", content_type="application/octet-stream"):
+        """Upload a blob and attach it to an existing thing.
+
+        See :py:meth:`upload_blob`. The thing is then updated with PutThings.
+
+        :param string thing_id: The ID of the thing to attach the blob to. (UUID)
+        :param string version_stamp: The current version stamp of the thing. (UUID)
+        :param fileobj: a file-like object, read until end of file.
+        :param string name: The name of the blob. A thing can have one blob with each name;
+            the default blob has the empty name.
+        :param string content_type: The MIME type of the blob.
+        :returns: a dictionary like :py:meth:`upload_blob` returns, plus the new
+            'thing_id' and 'version_stamp' of the thing.
+        :raises: :py:exc:`HealthVaultException` if the upload fails in some way.
+        """
+        blob = self.upload_blob(fileobj)
+        info = '<info><thing>'\
+               '<thing-id version-stamp="{version_stamp}">{thing_id}</thing-id>'\
+               '<blob-payload><blob>'\
+               '<blob-info>'\
+               '<name>{name}</name>'\
+               '<content-type>{content_type}</content-type>'\
+               '<hash-info>'\
+               '<algorithm>SHA256Block</algorithm>'\
+               '<params><block-size>{block_size}</block-size></params>'\
+               '<hash>{hash}</hash>'\
+               '</hash-info>'\
+               '</blob-info>'\
+               '<content-length>{content_length}</content-length>'\
+               '<blob-ref-url>{blob_ref_url}</blob-ref-url>'\
+               '</blob></blob-payload>'\
+               '</thing></info>'.format(thing_id=thing_id, version_stamp=version_stamp,
+                                        name=escape(name), content_type=escape(content_type),
+                                        block_size=blob['block_size'], hash=blob['hash'],
+                                        content_length=blob['content_length'],
+                                        blob_ref_url=escape(blob['blob_ref_url']))
+        (response, body, tree) = self._build_and_send_request("PutThings", info, method_version=2)
+        key = tree.find('{urn:com.microsoft.wc.methods.response.PutThings}info/thing-id')
+        blob.update(thing_id=key.text, version_stamp=key.get('version-stamp'))
+        return blob
+
+    def get_blob(self, thing_id, fileobj, name=""):
+        """Download a blob attached to a thing, writing it to a file-like object.
+
+        The blob is copied in chunks as it arrives and is never held in memory as a whole.
+
+        :param string thing_id: The ID of the thing the blob is attached to. (UUID)
+        :param fileobj: a file-like object to write the blob to.
+        :param string name: The name of the blob. Defaults to the thing's default blob.
+        :returns: a dictionary describing the blob, plus throughput metrics
+
+        Example::
+
+            {'name': '', 'content_type': 'application/pdf', 'hash': 'base64 hash',
+             'content_length': 10485760, 'blob_ref_url': 'https://...',
+             'bytes': 10485760, 'seconds': 2.5, 'bytes_per_second': 4194304.0}
+
+        :raises: :py:exc:`HealthVaultException` if the thing has no blob with that name or
+            the download fails in some way.
+        """
+        started = time.time()
+        info = '<info><group>'\
+               '<id>{thing_id}</id>'\
+               '<format>'\
+               '<section>core</section><section>blobpayload</section>'\
+               '<blob-payload-request><blob-format><blob-format-spec>streamed</blob-format-spec></blob-format>'\
+               '</blob-payload-request>'\
+               '</format>'\
+               '</group></info>'.format(thing_id=thing_id)
+        (response, body, tree) = self._build_and_send_request("GetThings", info)
+        info = tree.find('{urn:com.microsoft.wc.methods.response.GetThings}info')
+        blobs = [parse_blob(elt) for elt in info.findall('group/thing/blob-payload/blob')]
+        matching = [blob for blob in blobs if blob['name'] == name]
+        if not matching:
+            raise HealthVaultException("Thing %s has no blob named %r" % (thing_id, name))
+        blob = matching[0]
+
+        conn, path = self._open_blob_url(blob['blob_ref_url'])
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise HealthVaultHTTPException("Non-success HTTP response status downloading blob.  Status=%d, message=%s" %
+                                               (response.status, response.reason),
+                                               code=response.status)
+            nbytes = download_chunks(response, fileobj)
+        finally:
+            conn.close()
+        blob.update(transfer_stats(nbytes, started))
+        logger.debug("Downloaded blob of %d bytes at %s bytes/second", nbytes, blob['bytes_per_second'])
+        return blob
@@ -0,0 +1,221 @@
+"""Hedged requests, to cut the time taken by the slowest reads.
+
+Most GetThings requests take about the same time, but a few take many times longer, and
+those set the time the slowest calls take. Sending the same read again once it's taken
+longer than nearly all recent requests, and using whichever answer comes back first,
+gets rid of most of the slow ones for the price of a few more requests. A :py:class:`Hedger`
+does that; pass one to :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `hedger`.
+
+Each copy of a hedged request runs in its own thread on its own connection. When one
+finishes, the other is cancelled by shutting down its connection.
+"""
+import collections
+import math
+import Queue
+import socket
+import sys
+import threading
+import time
+
+from . import deadlines
+from .exceptions import HealthVaultHedgeCancelledException
+
+
+_local = threading.local()
+
+
+class Hedger(object):
+    """Sends a second copy of a request that's taking longer than `percentile` percent
+    of the last `window` requests, and uses whichever copy finishes first.
+
+    Hedging doesn't start until `min_samples` requests have been timed, and never waits
+    less than `min_delay` seconds. To keep the extra load down, each request earns
+    `max_rate` of a hedge and each hedge spends a whole one, so there are never more than
+    about `max_rate` hedges per request (plus at most `burst` saved up).
+
+    Only methods in `methods` are hedged, and then only if they're safe to send twice
+    (see :py:data:`healthvaultlib.retry.NON_IDEMPOTENT_METHODS`).
+
+    :py:attr:`stats` counts the requests, the hedges sent, the hedges that won, and the
+    hedges that weren't sent because the :py:class:`healthvaultlib.limits.RateLimiter` said no.
+
+    :param float percentile: how slow, as a percentile of recent requests, a request
+        must be to be hedged
+    :param float max_rate: how many hedges to allow per request
+    :param integer burst: the most unused hedges that can be saved up
+    :param integer window: how many recent requests to work out the percentile from
+    :param integer min_samples: how many requests to time before hedging any
+    :param float min_delay: the least time, in seconds, to wait before hedging
+    :param methods: the names of the methods to hedge
+    """
+    def __init__(self, percentile=95, max_rate=0.05, burst=10, window=1000, min_samples=20, min_delay=0.01,
+                 methods=('GetThings',)):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.burst = burst
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.methods = frozenset(methods)
+        self.stats = dict(requests=0, hedged=0, won=0, refused=0)
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self._budget = 0.0
+
+    def delay(self):
+        """Return how many seconds to wait before hedging a request, or None if we haven't
+        timed enough requests to say yet."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(math.ceil(self.percentile / 100.0 * len(latencies))) - 1
+        return max(self.min_delay, latencies[max(0, index)])
+
+    def record(self, seconds):
+        """Remember that a request took `seconds` seconds."""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def call(self, func, admit=None):
+        """Return func(), which sends a request, calling it a second time at once in
+        another thread if the first is slow and a hedge is allowed.
+
+        :param admit: called before sending a hedge, and the hedge not sent if it returns False
+        :raises: whatever func raised, if every copy sent failed
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            self._budget = min(self.burst, self._budget + self.max_rate)
+            can_hedge = self._budget >= 1
+        delay = self.delay() if can_hedge else None
+        if delay is None:
+            start = time.time()
+            result = func()
+            self.record(time.time() - start)
+            return result
+
+        done = Queue.Queue()
+        primary = _Attempt(func, done)
+        attempts = [primary]
+        try:
+            first = done.get(timeout=delay)
+        except Queue.Empty:
+            if self._hedge(admit):
+                attempts.append(_Attempt(func, done))
+            first = done.get()
+        # A copy that failed only counts if the other one fails too
+        left = len(attempts) - 1
+        while first.exc_info is not None and left:
+            first = done.get()
+            left -= 1
+        for attempt in attempts:
+            if attempt is not first:
+                attempt.cancel()
+        if first.exc_info is not None:
+            raise first.exc_info[0], first.exc_info[1], first.exc_info[2]
+        self.record(first.elapsed)
+        if first is not primary:
+            with self._lock:
+                self.stats['won'] += 1
+        return first.result
+
+    def _hedge(self, admit):
+        """Return True, having spent a hedge, if one may be sent now."""
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+        if admit is not None and not admit():
+            with self._lock:
+                self._budget += 1
+                self.stats['refused'] += 1
+            return False
+        with self._lock:
+            self.stats['hedged'] += 1
+        return True
+
+
+class _Attempt(object):
+    """One copy of a hedged request, running in its own thread.
+
+    Not part of the public API.
+    """
+    def __init__(self, func, done):
+        self.cancelled = False
+        self.result = self.exc_info = self.elapsed = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._start = time.time()
+        when = deadlines.current_deadline()
+
+        def run():
+            _local.attempt = self
+            try:
+                with deadlines.deadline(when):
+                    self.result = func()
+            except BaseException:
+                self.exc_info = sys.exc_info()
+            finally:
+                # The caller is always woken, however func() ended
+                self.elapsed = time.time() - self._start
+                done.put(self)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def use(self, conn):
+        with self._lock:
+            if not self.cancelled:
+                self._conn = conn
+                return
+        conn.close()
+        raise HealthVaultHedgeCancelledException("Cancelled; the other copy of the request finished first")
+
+    def finish(self):
+        with self._lock:
+            self._conn = None
+            return not self.cancelled
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            conn, self._conn = self._conn, None
+        sock = getattr(conn, 'sock', None)
+        if sock is not None:
+            # Wakes up the thread if it's waiting for the response
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+def _current_attempt():
+    return getattr(_local, 'attempt', None)
+
+
+def use(conn):
+    """Note that the current thread's request is being sent on `conn`, so that cancelling
+    it shuts `conn` down. Does nothing if the request isn't hedged.
+
+    :raises: :py:exc:`healthvaultlib.exceptions.HealthVaultHedgeCancelledException`, having
+        closed `conn`, if the request has already been cancelled
+    """
+    attempt = _current_attempt()
+    if attempt is not None:
+        attempt.use(conn)
+
+
+def cancelled():
+    """Return True if the current thread's request is a hedged one that's been cancelled."""
+    attempt = _current_attempt()
+    return attempt is not None and attempt.cancelled
+
+
+def finish():
+    """Note that the current thread's request has read its response, so its connection
+    can't be shut down by cancelling it any more.
+
+    :returns: False if it was cancelled first, in which case the connection may have been shut down
+    """
+    attempt = _current_attempt()
+    return attempt is None or attempt.finish()
@@ -0,0 +1,366 @@
+"""Limiting how much traffic we send HealthVault.
+
+An :py:class:`AdaptiveLimiter` limits how many requests we have in flight at once. It
+finds out how many concurrent requests HealthVault will handle well, the way TCP finds
+out how fast it can send: it allows one more request in flight each time a full window
+of requests succeeds promptly ("additive increase"), and halves the limit when requests
+are throttled, fail or are slow ("multiplicative decrease"). Callers over the limit wait
+their turn, first come first served.
+
+A :py:class:`RateLimiter` limits how many requests we send per second, per application
+and optionally per record, so bursts (e.g. backfills) stay inside HealthVault's quotas.
+"""
+import collections
+from contextlib import contextmanager
+import httplib
+import logging
+import socket
+import sqlite3
+import threading
+import time
+
+from . import deadlines
+from .exceptions import (HealthVaultDeadlineExceededException, HealthVaultHTTPException,
+                         HealthVaultRateLimitedException)
+
+
+logger = logging.getLogger(__name__)
+
+
+# HTTP statuses HealthVault (or something in front of it) uses to ask us to back off
+THROTTLE_HTTP_STATUSES = (429, 503)
+
+
+class AdaptiveLimiter(object):
+    """Limits the number of requests in flight, adjusting the limit with AIMD.
+
+    Create one per process and pass it to every
+    :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `limiter`, so they all share
+    the limit. Every request then waits for a slot before it's sent.
+
+    Each request that succeeds in less than `slow_request_time` seconds raises the limit by
+    ``increase / limit``, so it grows by about `increase` for each limit's worth of good
+    requests. A request that's throttled (HTTP 429 or 503), fails (socket errors, bad HTTP,
+    HTTP 5xx) or is slow multiplies the limit by `decrease`. Requests that were already in
+    flight when the limit was cut don't cut it again; they were sent under the old limit.
+
+    Example::
+
+        limiter = AdaptiveLimiter(initial_limit=4, max_limit=32, slow_request_time=10)
+        conn = HealthVaultConn(..., limiter=limiter)
+        ...
+        statsd.gauge('healthvault.limit', limiter.limit)
+        statsd.gauge('healthvault.queued', limiter.queue_depth)
+
+    :param integer initial_limit: how many requests to allow in flight to begin with
+    :param integer min_limit: the limit is never cut below this
+    :param integer max_limit: the limit never grows above this
+    :param float increase: how much to grow the limit by for each limit's worth of good requests
+    :param float decrease: what to multiply the limit by when there's trouble
+    :param float slow_request_time: seconds after which a request counts as slow; None to ignore time taken
+    """
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, increase=1.0, decrease=0.5,
+                 slow_request_time=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_request_time = slow_request_time
+        self.stats = dict(requests=0, throttled=0, failed=0, slow=0, decreases=0)
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        # Events of the callers waiting for a slot, in the order they arrived
+        self._waiting = collections.deque()
+        # Bumped each time the limit is cut, so requests sent before then don't cut it again
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """The number of requests allowed in flight now."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """The number of requests in flight now."""
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        """The number of callers waiting for a slot now."""
+        return len(self._waiting)
+
+    def classify(self, exc):
+        """Return 'throttled' or 'failed' if `exc` means HealthVault is having trouble, else None.
+        Errors HealthVault reports in a successful response mean it's working fine."""
+        if isinstance(exc, HealthVaultHTTPException):
+            if exc.code in THROTTLE_HTTP_STATUSES:
+                return 'throttled'
+            return 'failed' if exc.code is None or exc.code >= 500 else None
+        if isinstance(exc, (socket.error, httplib.HTTPException)):
+            return 'failed'
+        return None
+
+    def acquire(self):
+        """Wait for a slot, and return a token to pass to :py:meth:`release`.
+
+        :raises: :py:exc:`healthvaultlib.exceptions.HealthVaultDeadlineExceededException`
+            if the current deadline passes while waiting
+        """
+        with self._lock:
+            if not self._waiting and self._in_flight < self.limit:
+                self._in_flight += 1
+                return self._epoch
+            event = threading.Event()
+            self._waiting.append(event)
+        event.wait(deadlines.limit(None))
+        with self._lock:
+            if not event.is_set():
+                self._waiting.remove(event)
+                raise HealthVaultDeadlineExceededException("Deadline passed waiting to send a request")
+            # Whoever set the event counted us as in flight
+            return self._epoch
+
+    def release(self, token, elapsed, exc=None):
+        """Give back a slot, adjusting the limit according to how the request went.
+
+        :param token: what :py:meth:`acquire` returned
+        :param float elapsed: how many seconds the request took
+        :param exc: the exception the request raised, if any
+        """
+        trouble = self.classify(exc) if exc is not None else None
+        if trouble is None and self.slow_request_time is not None and elapsed >= self.slow_request_time:
+            trouble = 'slow'
+        with self._lock:
+            self.stats['requests'] += 1
+            self._in_flight -= 1
+            if trouble is not None:
+                self.stats[trouble] += 1
+                if token == self._epoch:
+                    self._cut()
+            elif exc is None:
+                self._limit = min(self.max_limit, self._limit + self.increase / self._limit)
+            self._wake()
+
+    def _cut(self):
+        """Cut the limit after trouble. Called with the lock held."""
+        self._limit = max(self.min_limit, self._limit * self.decrease)
+        self._epoch += 1
+        self.stats['decreases'] += 1
+        logger.info("Cut HealthVault request limit to %d" % self.limit)
+
+    def _wake(self):
+        """Give free slots to waiting callers, oldest first. Called with the lock held."""
+        while self._waiting and self._in_flight < self.limit:
+            self._in_flight += 1
+            self._waiting.popleft().set()
+
+    def call(self, func, *args, **kwargs):
+        """Return func(*args, **kwargs) once there's a slot for it."""
+        token = self.acquire()
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.release(token, time.time() - start, e)
+            raise
+        self.release(token, time.time() - start)
+        return result
+
+
+# Request priorities for a RateLimiter
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+
+class RateLimiter(object):
+    """Limits the rate of requests with token buckets: one per application, and optionally
+    one per record.
+
+    A bucket holds up to `burst` tokens and fills at `rate` tokens per second. Each request
+    takes a token from its application's bucket (and its record's, if there's a `record_rate`),
+    waiting for them if need be. A request that doesn't use a record only needs the
+    application's token.
+
+    Background requests can't take the last `reserve` fraction of any bucket's tokens, so
+    there are always some left for interactive requests, however busy a background sync is.
+
+    Whether a request is interactive or background, and whether it waits for tokens or fails
+    straight away with :py:exc:`healthvaultlib.exceptions.HealthVaultRateLimitedException`,
+    are set by `priority` and `blocking`, and can be changed for the calls made in the
+    current thread with :py:meth:`options`::
+
+        limiter = MemoryRateLimiter(rate=10, burst=20, record_rate=2)
+        conn = HealthVaultConn(..., rate_limiter=limiter)
+        with limiter.options(priority=BACKGROUND):
+            SyncEngine(store).sync(conn, datatypes, handler)
+        with limiter.options(blocking=False):
+            conn.get_weight_measurements()   # raises if we're over the rate
+
+    Requests made in threads that a call starts (e.g. by :py:meth:`get_things_by_ids`) use
+    the limiter's `priority` and `blocking`, so a process that only does background work can
+    just create its limiter with ``priority=BACKGROUND``.
+
+    Subclasses keep the buckets somewhere by implementing :py:meth:`_transaction`,
+    :py:meth:`_load` and :py:meth:`_save`.
+
+    :param float rate: requests per second allowed for each application
+    :param float burst: how many requests an application can send at once after being idle;
+        defaults to `rate`
+    :param float record_rate: requests per second allowed for each record, or None for no limit
+    :param float record_burst: how many requests a record can get at once; defaults to `record_rate`
+    :param float reserve: the fraction of each bucket kept for interactive requests
+    :param string priority: :py:data:`INTERACTIVE` or :py:data:`BACKGROUND`
+    :param boolean blocking: whether to wait for tokens, rather than fail straight away
+    """
+    def __init__(self, rate, burst=None, record_rate=None, record_burst=None, reserve=0.2,
+                 priority=INTERACTIVE, blocking=True):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.record_rate = record_rate
+        self.record_burst = record_burst or (max(1, record_rate) if record_rate else None)
+        self.reserve = reserve
+        self.priority = priority
+        self.blocking = blocking
+        self.stats = dict(requests=0, waits=0, waited=0.0, refused=0)
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def options(self, priority=None, blocking=None):
+        """Use this priority and/or blocking behavior for requests made by the current thread
+        in the body of the with statement."""
+        previous = getattr(self._local, 'options', None)
+        self._local.options = (priority or self._option('priority'),
+                               self._option('blocking') if blocking is None else blocking)
+        try:
+            yield
+        finally:
+            self._local.options = previous
+
+    def _option(self, name):
+        options = getattr(self._local, 'options', None)
+        if options is None:
+            return getattr(self, name)
+        return options[0] if name == 'priority' else options[1]
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+
+    def acquire(self, app_id, record_id=None):
+        """Take the tokens for a request, waiting for them unless we're not blocking.
+
+        :raises: :py:exc:`healthvaultlib.exceptions.HealthVaultRateLimitedException` if there
+            aren't tokens and we're not blocking, or
+            :py:exc:`healthvaultlib.exceptions.HealthVaultDeadlineExceededException` if the
+            current deadline would pass before there are
+        """
+        buckets = [('app:' + app_id, self.rate, self.burst)]
+        if record_id is not None and self.record_rate:
+            buckets.append(('record:' + record_id, self.record_rate, self.record_burst))
+        background = self._option('priority') == BACKGROUND
+        while True:
+            wait = self._take(buckets, background, time.time())
+            if not wait:
+                self._count(requests=1)
+                return
+            if not self._option('blocking'):
+                self._count(refused=1)
+                raise HealthVaultRateLimitedException(
+                    "Request rate limit reached; try again in %.2f seconds" % wait, retry_after=wait)
+            left = deadlines.time_left()
+            if left is not None and wait >= left:
+                raise HealthVaultDeadlineExceededException("Deadline would pass waiting for the request rate limit")
+            self._count(waits=1, waited=wait)
+            time.sleep(wait)
+
+    def _take(self, buckets, background, now):
+        """Take a token from each of the (key, rate, burst) buckets if they all have one,
+        and return 0; otherwise take none and return how many seconds until they might."""
+        with self._transaction():
+            entries = self._load([key for (key, rate, burst) in buckets])
+            wait = 0
+            for key, rate, burst in buckets:
+                tokens, updated = entries.get(key, (burst, now))
+                tokens = min(burst, tokens + max(0, now - updated) * rate)
+                entries[key] = tokens
+                needed = 1 + (min(self.reserve * burst, burst - 1) if background else 0)
+                if tokens < needed:
+                    wait = max(wait, (needed - tokens) / float(rate))
+            if not wait:
+                self._save(dict((key, (tokens - 1, now)) for (key, tokens) in entries.items()))
+            return wait
+
+    @contextmanager
+    def _transaction(self):
+        """Make the loading and saving in the body atomic, across everything sharing the buckets."""
+        raise NotImplementedError
+
+    def _load(self, keys):
+        """Return a dictionary mapping those of keys that have buckets to (tokens, time updated)."""
+        raise NotImplementedError
+
+    def _save(self, entries):
+        """Save a dictionary mapping keys to (tokens, time updated)."""
+        raise NotImplementedError
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Keeps token buckets in memory, for one process. Share one between all the
+    `HealthVaultConn` objects in the process."""
+    def __init__(self, rate, **kwargs):
+        super(MemoryRateLimiter, self).__init__(rate, **kwargs)
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield
+
+    def _load(self, keys):
+        return dict((key, self._buckets[key]) for key in keys if key in self._buckets)
+
+    def _save(self, entries):
+        self._buckets.update(entries)
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """Keeps token buckets in a SQLite database, so all the processes (e.g. web workers)
+    using the same file share the rate limits.
+
+    :param string path: the database file
+    """
+    def __init__(self, path, rate, **kwargs):
+        super(SQLiteRateLimiter, self).__init__(rate, **kwargs)
+        self._lock = threading.Lock()
+        # We begin our own transactions, so other processes can't get in between
+        # reading and writing a bucket
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _load(self, keys):
+        entries = {}
+        for key in keys:
+            row = self._db.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                entries[key] = row
+        return entries
+
+    def _save(self, entries):
+        self._db.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                             [(key, tokens, updated) for (key, (tokens, updated)) in entries.items()])
@@ -0,0 +1,246 @@
+"""Receiving HealthVault event notifications.
+
+Once an application has subscribed to events with
+:py:meth:`healthvaultlib.healthvault.HealthVaultConn.subscribe`, HealthVault POSTs
+a notification to the subscription's URL whenever matching things change.
+See `HealthVault Eventing <http://msdn.microsoft.com/en-us/library/jj863108.aspx>`_.
+
+:py:class:`NotificationReceiver` is a WSGI application that checks each notification's
+signature, parses it, and queues it for the application to act on in its own time.
+:py:class:`RecordChangeCoalescer` can then turn those notifications into a few
+targeted requests for just the things that changed.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import Queue
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from .xmlutils import parse_notification
+
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_signature(header):
+    """Split the signature header HealthVault sends with a notification.
+
+    It looks like ``HMACSHA256 <notification key version id>:<base64 signature>``.
+
+    :returns: (version_id, signature), or (None, None) if the header isn't in that form
+    """
+    if not header:
+        return None, None
+    try:
+        algorithm, value = header.split(None, 1)
+        version_id, signature = value.rsplit(':', 1)
+        signature = base64.b64decode(signature)
+    except (ValueError, TypeError):
+        return None, None
+    if algorithm != 'HMACSHA256':
+        return None, None
+    return version_id, signature
+
+
+class NotificationReceiver(object):
+    """A WSGI application to receive HealthVault event notifications.
+
+    Each request's ``X-HV-Signature`` header is checked against the notification keys
+    we know about, looked up by key version. Requests that aren't properly signed are
+    rejected with a 401 response.
+
+    Notifications are parsed with :py:func:`healthvaultlib.xmlutils.parse_notification`
+    and put on :py:attr:`queue`, a bounded ``Queue.Queue``, for worker threads to handle.
+    The response never waits for a worker. If the queue is full, we respond 503 so
+    that HealthVault will send the notification again later.
+
+    Example::
+
+        receiver = NotificationReceiver({'1': 'our-notification-key'})
+        # serve receiver with any WSGI server, then elsewhere:
+        notification = receiver.queue.get()
+        change = notification['record_change_notification']
+        print change['record_id'], change['things']
+
+    :param dict keys: maps notification key version IDs to notification keys, as passed to
+        :py:meth:`healthvaultlib.healthvault.HealthVaultConn.subscribe`
+    :param integer maxsize: the most notifications to hold in the queue
+    """
+    def __init__(self, keys=None, maxsize=1000):
+        self.queue = Queue.Queue(maxsize)
+        self.stats = dict(received=0, rejected=0, dropped=0)
+        self._stats_lock = threading.Lock()
+        # Maps key version ID to an HMAC object already keyed with that key; we copy it
+        # for each notification rather than setting up the key again.
+        self._hmacs = {}
+        for version_id, key in (keys or {}).items():
+            self.add_key(version_id, key)
+
+    def add_key(self, version_id, key):
+        """Accept notifications signed with this version of a notification key."""
+        self._hmacs[version_id] = hmac.new(key.encode('utf-8') if isinstance(key, unicode) else key,
+                                           digestmod=hashlib.sha256)
+
+    def add_subscription(self, subscription):
+        """Accept notifications signed with the key of a subscription, as returned by
+        :py:meth:`healthvaultlib.healthvault.HealthVaultConn.get_subscriptions`."""
+        shared_key = subscription['common']['notification_authentication_info']['hv_eventing_shared_key']
+        self.add_key(shared_key['notification_key_version_id'], shared_key['notification_key'])
+
+    def verify(self, body, header):
+        """Return True if `header` (the value of the X-HV-Signature header) is a valid
+        signature of `body` with one of our keys."""
+        version_id, signature = _parse_signature(header)
+        keyed = self._hmacs.get(version_id)
+        if keyed is None:
+            return False
+        mac = keyed.copy()
+        mac.update(body)
+        return hmac.compare_digest(mac.digest(), signature)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return self._respond(start_response, '405 Method Not Allowed')
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return self._respond(start_response, '400 Bad Request')
+        body = environ['wsgi.input'].read(length)
+
+        if not self.verify(body, environ.get('HTTP_X_HV_SIGNATURE')):
+            logger.warning("Rejecting HealthVault notification with bad signature")
+            self._count('rejected')
+            return self._respond(start_response, '401 Unauthorized')
+
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError:
+            logger.error("Could not parse HealthVault notification: %r" % body)
+            return self._respond(start_response, '400 Bad Request')
+        elts = [root] if root.tag == 'notification' else root.findall('notification')
+        for elt in elts:
+            self._count('received')
+            try:
+                self.queue.put_nowait(parse_notification(elt))
+            except Queue.Full:
+                logger.warning("Notification queue full, asking HealthVault to retry later")
+                self._count('dropped')
+                return self._respond(start_response, '503 Service Unavailable')
+        return self._respond(start_response, '200 OK')
+
+    def _respond(self, start_response, status):
+        start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', '0')])
+        return []
+
+
+class RecordChangeCoalescer(object):
+    """Turns record change notifications into as few GetThings requests as possible.
+
+    HealthVault often sends several notifications in a row for the same record, e.g. when
+    a device uploads a batch of readings. Instead of fetching things as each notification
+    arrives, the changed thing IDs are collected per record, and once `window` seconds
+    have passed since the first notification for that record, the things are fetched by ID
+    all together and passed to `handler`.
+
+    Example::
+
+        receiver = NotificationReceiver({'1': 'our-notification-key'})
+        coalescer = RecordChangeCoalescer(get_conn, handler, window=10)
+        worker = threading.Thread(target=coalescer.run, args=(receiver.queue,))
+        worker.daemon = True
+        worker.start()
+
+    :param get_conn: callable taking a record ID and returning a
+        :py:class:`healthvaultlib.healthvault.HealthVaultConn` that can read that record.
+    :param handler: callable taking (record_id, things), where `things` is a dictionary mapping
+        each changed thing's ID to the parsed thing, or to None if the thing no longer exists.
+    :param float window: how many seconds to collect changes to a record before fetching them.
+    """
+    def __init__(self, get_conn, handler, window=5.0):
+        self.get_conn = get_conn
+        self.handler = handler
+        self.window = window
+        self._lock = threading.Lock()
+        # record_id -> (time first change was seen, set of thing IDs)
+        self._pending = {}
+
+    def add(self, notification):
+        """Add a notification, as parsed by :py:func:`healthvaultlib.xmlutils.parse_notification`."""
+        change = notification.get('record_change_notification')
+        if not change or not change['things']:
+            return
+        with self._lock:
+            first_seen, thing_ids = self._pending.setdefault(change['record_id'], (time.time(), set()))
+            thing_ids.update(change['things'])
+
+    def next_due(self):
+        """Return the number of seconds until the next record is due to be fetched,
+        or None if nothing is pending."""
+        with self._lock:
+            if not self._pending:
+                return None
+            first = min(first_seen for (first_seen, thing_ids) in self._pending.values())
+        return max(0, first + self.window - time.time())
+
+    def flush(self, force=False):
+        """Fetch and dispatch the changes for every record whose window has passed, or
+        for all records if `force` is True.
+
+        If fetching a record's things fails, or the handler raises an exception, the error
+        is logged and its thing IDs are kept to be tried again on a later flush (so the
+        handler may be given the same changes more than once).
+
+        :returns: The number of records dispatched.
+        """
+        now = time.time()
+        with self._lock:
+            due = [record_id for (record_id, (first_seen, thing_ids)) in self._pending.items()
+                   if force or first_seen + self.window <= now]
+            batches = [(record_id, self._pending.pop(record_id)[1]) for record_id in due]
+        dispatched = 0
+        for record_id, thing_ids in batches:
+            try:
+                found = self.get_conn(record_id).get_things_by_ids(sorted(thing_ids))
+            except Exception:
+                logger.exception("Error fetching changed things for record %s" % record_id)
+                self._requeue(record_id, thing_ids, now)
+                continue
+            try:
+                self.handler(record_id, dict((thing_id, found.get(thing_id)) for thing_id in thing_ids))
+            except Exception:
+                logger.exception("Error handling changed things for record %s" % record_id)
+                self._requeue(record_id, thing_ids, now)
+                continue
+            dispatched += 1
+        return dispatched
+
+    def _requeue(self, record_id, thing_ids, now):
+        """Keep thing IDs we couldn't dispatch, to try again on a later flush."""
+        with self._lock:
+            first_seen, pending_ids = self._pending.setdefault(record_id, (now, set()))
+            pending_ids.update(thing_ids)
+
+    def run(self, queue, stop=None):
+        """Take notifications from `queue` (e.g. :py:attr:`NotificationReceiver.queue`) and
+        fetch changes as they come due, until the `stop` event (a ``threading.Event``) is set.
+        Meant to be the target of a worker thread; errors are logged rather than ending it.
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                timeout = self.next_due()
+                try:
+                    self.add(queue.get(timeout=min(timeout, 1.0) if timeout is not None else 1.0))
+                except Queue.Empty:
+                    pass
+                self.flush()
+            except Exception:
+                logger.exception("Error processing change notifications")
+        self.flush(force=True)
@@ -0,0 +1,78 @@
+"""Choosing how many things to ask for per page.
+
+Too few things per request wastes round trips; too many makes big, slow responses. A
+:py:class:`PageSizer` learns, for each data type, how big a thing is in a response and how
+long responses take per byte, and picks the page size that should give responses of the
+size (or taking the time) we want. Pass one to
+:py:meth:`healthvaultlib.healthvault.HealthVaultConn.iter_things`.
+"""
+import threading
+
+
+class PageSizer(object):
+    """Learns page sizes that give responses of about `target_size` bytes, and if
+    `target_time` is given, that take no more than about that many seconds.
+
+    For each data type it keeps exponentially weighted averages of the bytes per thing
+    and the seconds per byte of the pages it's told about (see :py:meth:`observe`); each new
+    page has a weight of `weight`. Until a data type has been seen, its page size is `initial`.
+    Page sizes are kept between `min_size` and `max_size`. The default `max_size` is the
+    most things HealthVault returns in full in one group; it only sends the keys of any more.
+
+    What it's learned is in :py:attr:`learned`, a dictionary mapping each data type to a
+    dictionary with `bytes_per_thing`, `seconds_per_byte` and `pages` keys, e.g. for
+    logging, or to seed a new sizer with it.
+
+    Example::
+
+        sizer = PageSizer(target_size=32 * 1024, target_time=2)
+        for info, weight in conn.iter_things(DataType.WEIGHT_MEASUREMENTS, page_sizer=sizer):
+            ...
+        logger.info("Learned page sizes: %r", sizer.learned)
+
+    :param integer target_size: the response size to aim for, in bytes
+    :param float target_time: the response time not to go over, in seconds; or None
+    :param integer initial: the page size to use for data types we haven't seen yet
+    :param integer min_size: the smallest page size to use
+    :param integer max_size: the largest page size to use
+    :param float weight: how much weight to give each new page, between 0 and 1
+    :param dict learned: what an earlier sizer learned, to start from
+    """
+    def __init__(self, target_size=64 * 1024, target_time=None, initial=30, min_size=1, max_size=30,
+                 weight=0.3, learned=None):
+        self.target_size = target_size
+        self.target_time = target_time
+        self.initial = initial
+        self.min_size = min_size
+        self.max_size = max_size
+        self.weight = weight
+        self.learned = dict((datatype, dict(values)) for (datatype, values) in (learned or {}).items())
+        self._lock = threading.Lock()
+
+    def page_size(self, datatype):
+        """Return how many things of a data type to ask for in the next page."""
+        with self._lock:
+            learned = self.learned.get(datatype)
+            if learned is None:
+                return self.initial
+            size = self.target_size / learned['bytes_per_thing']
+            if self.target_time is not None and learned['seconds_per_byte'] > 0:
+                size = min(size, self.target_time / (learned['seconds_per_byte'] * learned['bytes_per_thing']))
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def observe(self, datatype, things, size, seconds):
+        """Learn from a page of `things` things of a data type, that made a response of
+        `size` bytes and took `seconds` seconds. Empty pages are ignored."""
+        if not things or not size:
+            return
+        bytes_per_thing = float(size) / things
+        seconds_per_byte = float(seconds) / size
+        with self._lock:
+            learned = self.learned.get(datatype)
+            if learned is None:
+                self.learned[datatype] = dict(bytes_per_thing=bytes_per_thing, seconds_per_byte=seconds_per_byte,
+                                              pages=1)
+                return
+            learned['bytes_per_thing'] += self.weight * (bytes_per_thing - learned['bytes_per_thing'])
+            learned['seconds_per_byte'] += self.weight * (seconds_per_byte - learned['seconds_per_byte'])
+            learned['pages'] += 1
@@ -0,0 +1,79 @@
+"""Reusing HTTPS connections to HealthVault.
+
+Opening an HTTPS connection costs a TCP handshake and a TLS handshake, each a round trip
+or more, before the request can even be sent. A :py:class:`ConnectionPool` keeps
+connections open after their response has been read, so later requests (from any thread)
+can use them again.
+"""
+import collections
+import threading
+import time
+
+
+class ConnectionPool(object):
+    """Keeps idle ``httplib.HTTPSConnection`` objects, by host and port, for reuse.
+
+    Pass one to :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `connection_pool`
+    (the same one to all the conns in a process).
+
+    HealthVault may close a connection that's been idle a while without our noticing until
+    we next use it, so connections idle for more than `idle_timeout` seconds are closed
+    rather than reused, and a request that fails on a reused connection before getting any
+    response is sent again once on a new one.
+
+    :py:attr:`stats` counts the connections created and reused.
+
+    :param integer maxsize: the most idle connections to keep for each host and port
+    :param float idle_timeout: how many seconds a connection may be idle and still be reused
+    """
+    def __init__(self, maxsize=10, idle_timeout=30):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.stats = dict(created=0, reused=0, discarded=0)
+        self._lock = threading.Lock()
+        # (host, port) -> deque of (time put back, connection), most recently used last
+        self._idle = {}
+
+    def get(self, host, port):
+        """Return an idle connection to host and port, or None if there isn't one."""
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get((host, port))
+            if idle:
+                when, candidate = idle.pop()
+                if now - when <= self.idle_timeout:
+                    conn = candidate
+                    self.stats['reused'] += 1
+                else:
+                    # The rest have been idle even longer
+                    stale = [candidate] + [other for (when, other) in idle]
+                    idle.clear()
+                    self.stats['discarded'] += len(stale)
+        for candidate in stale:
+            candidate.close()
+        return conn
+
+    def created(self):
+        """Count a new connection, made because there was no idle one."""
+        with self._lock:
+            self.stats['created'] += 1
+
+    def put(self, host, port, conn):
+        """Keep a connection whose response has been read in full, for reuse."""
+        with self._lock:
+            idle = self._idle.setdefault((host, port), collections.deque())
+            if len(idle) < self.maxsize:
+                idle.append((time.time(), conn))
+                return
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for when, conn in connections:
+                conn.close()
@@ -0,0 +1,213 @@
+"""Answering date-range queries from things we've already fetched.
+
+A :py:class:`RangeIndex` remembers, for each record and data type, the things it has
+fetched and which ranges of effective dates it has fetched completely. When asked
+for a range, it answers the part it already covers itself, and asks HealthVault only
+for the gaps, all in one request.
+"""
+import bisect
+import datetime
+import threading
+import time
+
+from .xmlutils import SINGLETON_TYPES, group_data
+
+
+# The request keys a RangeIndex knows how to plan for; requests with any others
+# (or with a 'max') are passed straight through
+PLANNABLE_KEYS = frozenset(['datatype', 'min_date', 'max_date', 'max'])
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or touching (start, end, fetched) ranges. A merged range keeps
+    the oldest of the fetched times, so it isn't trusted for longer than any part of it."""
+    merged = []
+    for start, end, fetched in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            last_start, last_end, last_fetched = merged[-1]
+            merged[-1] = (last_start, max(last_end, end), min(last_fetched, fetched))
+        else:
+            merged.append((start, end, fetched))
+    return merged
+
+
+def _whole_seconds(start, end):
+    """Return [start, end] widened to whole seconds.
+
+    HealthVault is only sent dates to the second, so that's the range a request for
+    [start, end] actually covers.
+    """
+    if start != datetime.datetime.min:
+        start = start.replace(microsecond=0)
+    if end != datetime.datetime.max and end.microsecond:
+        end = end.replace(microsecond=0) + datetime.timedelta(seconds=1)
+    return start, end
+
+
+def missing_ranges(covered, start, end):
+    """Return the parts of [start, end] that aren't in any of the covered ranges.
+
+    :param list covered: (start, end, fetched) tuples, as returned by :py:func:`merge_ranges`
+    :returns: a list of (start, end) tuples
+    """
+    gaps = []
+    for covered_start, covered_end, fetched in covered:
+        if covered_end < start:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > start:
+            gaps.append((start, covered_start))
+        if covered_end >= end:
+            return gaps
+        start = max(start, covered_end)
+    gaps.append((start, end))
+    return gaps
+
+
+class _Series(object):
+    """The things of one data type in one record, sorted by effective date, and the
+    ranges of effective dates we have all the things for."""
+    def __init__(self):
+        self.dates = []
+        self.ids = []
+        self.things = {}
+        self.covered = []
+
+    def remove(self, thing_id):
+        info, data = self.things.pop(thing_id)
+        index = bisect.bisect_left(self.dates, info['eff_date'])
+        while self.ids[index] != thing_id:
+            index += 1
+        del self.dates[index]
+        del self.ids[index]
+
+    def _is_covered(self, point):
+        return any(start <= point <= end for (start, end, fetched) in self.covered)
+
+    def fill(self, start, end, fetched, things):
+        """Replace whatever we had in [start, end] with things, fetched at time `fetched`.
+
+        Things exactly at an end that's also the edge of a range we already cover are kept,
+        unless they were fetched again; that range is still vouching for them.
+        """
+        if self._is_covered(start):
+            low = bisect.bisect_right(self.dates, start)
+        else:
+            low = bisect.bisect_left(self.dates, start)
+        if self._is_covered(end):
+            high = bisect.bisect_left(self.dates, end)
+        else:
+            high = bisect.bisect_right(self.dates, end)
+        for thing_id in self.ids[low:high]:
+            del self.things[thing_id]
+        del self.dates[low:high]
+        del self.ids[low:high]
+        for info, data in things:
+            if info['thing_id'] in self.things:
+                self.remove(info['thing_id'])
+            index = bisect.bisect_right(self.dates, info['eff_date'])
+            self.dates.insert(index, info['eff_date'])
+            self.ids.insert(index, info['thing_id'])
+            self.things[info['thing_id']] = (info, data)
+        self.covered = merge_ranges(self.covered + [(start, end, fetched)])
+
+    def expire(self, oldest):
+        self.covered = [(start, end, fetched) for (start, end, fetched) in self.covered if fetched >= oldest]
+
+    def query(self, start, end):
+        """Return the things in [start, end], newest first, like HealthVault does."""
+        low = bisect.bisect_left(self.dates, start)
+        high = bisect.bisect_right(self.dates, end)
+        return [self.things[thing_id] for thing_id in reversed(self.ids[low:high])]
+
+
+class RangeIndex(object):
+    """An index of fetched things by record, data type and effective date, that answers
+    date-range queries locally where it can.
+
+    Pass one to a :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `range_index`,
+    and ``batch_get`` (and so ``get_weight_measurements(min_date, max_date)`` and the like)
+    uses it for requests with just a data type and dates. Other requests go to HealthVault
+    as usual, in the same request as any gaps.
+
+    Example::
+
+        index = RangeIndex(ttl=300)
+        conn = HealthVaultConn(..., range_index=index)
+        conn.get_weight_measurements(min_date=week_ago)     # fetched
+        conn.get_weight_measurements(min_date=month_ago)    # only month_ago to week_ago is fetched
+
+    :param float ttl: how many seconds to trust a fetched range for
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.stats = dict(local=0, fetched=0)
+        self._lock = threading.Lock()
+        # (record_id, datatype) -> _Series
+        self._series = {}
+
+    def invalidate(self, record_id=None, datatype=None):
+        """Forget what we have for a record (or all records) and data type (or all data types),
+        e.g. after changing things."""
+        with self._lock:
+            for key in list(self._series):
+                if record_id in (None, key[0]) and datatype in (None, key[1]):
+                    del self._series[key]
+
+    def _plannable(self, request):
+        return (set(request) <= PLANNABLE_KEYS and request.get('max') is None
+                and request['datatype'] not in SINGLETON_TYPES)
+
+    def batch_get(self, conn, requests, include_info=False):
+        """Return what ``conn.batch_get(requests, include_info)`` would, answering from
+        the index where we can."""
+        if not isinstance(requests, list):
+            requests = [requests]
+        now = time.time()
+        # For each request, either ('plan', datatype, start, end)
+        # or ('pass', index into the requests we send)
+        plans = []
+        to_send = []
+        gaps = []
+        with self._lock:
+            for request in requests:
+                if not self._plannable(request):
+                    plans.append(('pass', len(to_send)))
+                    to_send.append(request)
+                    continue
+                datatype = request['datatype']
+                start = request.get('min_date') or datetime.datetime.min
+                end = request.get('max_date') or datetime.datetime.max
+                series = self._series.setdefault((conn.record_id, datatype), _Series())
+                series.expire(now - self.ttl)
+                indexes = []
+                for gap_start, gap_end in missing_ranges(series.covered, start, end):
+                    gap_start, gap_end = _whole_seconds(gap_start, gap_end)
+                    indexes.append(len(to_send))
+                    gaps.append((len(to_send), datatype, gap_start, gap_end))
+                    to_send.append({'datatype': datatype,
+                                    'min_date': gap_start if gap_start != datetime.datetime.min else None,
+                                    'max_date': gap_end if gap_end != datetime.datetime.max else None})
+                plans.append(('plan', datatype, start, end))
+                self.stats['fetched' if indexes else 'local'] += 1
+
+        # Each gap comes back whole (things HealthVault leaves out of a group are fetched
+        # by ID, and its ends are whole seconds), so it's safe to mark it covered
+        fetched = conn._batch_get(to_send, True) if to_send else []
+
+        with self._lock:
+            for index, datatype, gap_start, gap_end in gaps:
+                series = self._series.setdefault((conn.record_id, datatype), _Series())
+                series.fill(gap_start, gap_end, now, fetched[index])
+            results = []
+            for plan in plans:
+                if plan[0] == 'pass':
+                    result = fetched[plan[1]]
+                    results.append(result if include_info or to_send[plan[1]].get('keys_only')
+                                   else group_data(result))
+                    continue
+                unused, datatype, start, end = plan
+                things = self._series[(conn.record_id, datatype)].query(start, end)
+                results.append(things if include_info else group_data(things))
+        return results
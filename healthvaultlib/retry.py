@@ -0,0 +1,127 @@
+"""Retrying HealthVault requests that fail for reasons that might go away.
+
+A :py:class:`RetryPolicy` says which failures are worth trying again, how long to wait
+between tries, and how much waiting one call may do in all. Pass one to
+:py:class:`healthvaultlib.healthvault.HealthVaultConn` as `retry_policy`.
+"""
+import errno
+import httplib
+import logging
+import random
+import socket
+import sys
+import time
+
+from .deadlines import current_deadline
+from .exceptions import HealthVaultException, HealthVaultHTTPException
+from .status_codes import HealthVaultStatus
+
+
+logger = logging.getLogger(__name__)
+
+
+# Methods that change something in HealthVault in a way that doing it twice isn't the
+# same as doing it once (e.g. PutThings without version stamps adds a second copy)
+NON_IDEMPOTENT_METHODS = frozenset(['PutThings', 'AssociateAlternateId'])
+
+
+class RetryPolicy(object):
+    """Decides which failed requests to try again, and when.
+
+    Failures are classified like this:
+
+    * A :py:exc:`healthvaultlib.exceptions.HealthVaultHTTPException` is retryable if its
+      HTTP status is in `retry_http_statuses`.
+    * Any other :py:exc:`healthvaultlib.exceptions.HealthVaultException` is retryable if its
+      HealthVault status is in `retry_statuses`.
+    * Socket errors (including timeouts and broken pipes) and ``httplib.HTTPException`` are retryable.
+    * Anything else is fatal.
+
+    For non-idempotent methods (:py:data:`NON_IDEMPOTENT_METHODS`), a request is only
+    tried again if the failure shows HealthVault can't have acted on it: the connection
+    was refused, or the HTTP status is in `safe_http_statuses`.
+
+    Waits grow exponentially, ``base_delay * 2 ** retry``, up to `max_delay`, with "full
+    jitter": the actual wait is random between 0 and that, so many clients that failed at
+    once don't all come back at once. A call gives up after `max_attempts` tries, or when
+    waiting again would take its total waiting past `budget` seconds or past the current
+    deadline (see :py:mod:`healthvaultlib.deadlines`).
+
+    Example::
+
+        policy = RetryPolicy(max_attempts=5, budget=60)
+        conn = HealthVaultConn(..., retry_policy=policy)
+
+    If `refresh_auth_token` is True, a request that fails because our application's
+    authenticated session token has expired gets a new token and is sent again straight away.
+    That doesn't count as one of the attempts.
+
+    :param integer max_attempts: the most times to try a request, including the first
+    :param float base_delay: seconds to wait (at most) before the first retry
+    :param float max_delay: the longest single wait
+    :param float budget: the most seconds one call may spend waiting to retry
+    :param tuple retry_statuses: HealthVault status codes worth retrying
+    :param tuple retry_http_statuses: HTTP status codes worth retrying
+    :param tuple safe_http_statuses: HTTP status codes that mean the request wasn't acted on
+    :param boolean refresh_auth_token: whether to get a new session token when ours expires
+    """
+    RETRY_STATUSES = (
+        HealthVaultStatus.FAILED,
+        HealthVaultStatus.BAD_HTTP,
+        HealthVaultStatus.REQUEST_TIMED_OUT,
+    )
+    RETRY_HTTP_STATUSES = (500, 502, 503, 504)
+    SAFE_HTTP_STATUSES = (503,)
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=10.0, budget=30.0,
+                 retry_statuses=RETRY_STATUSES, retry_http_statuses=RETRY_HTTP_STATUSES,
+                 safe_http_statuses=SAFE_HTTP_STATUSES, refresh_auth_token=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retry_statuses = retry_statuses
+        self.retry_http_statuses = retry_http_statuses
+        self.safe_http_statuses = safe_http_statuses
+        self.refresh_auth_token = refresh_auth_token
+
+    def is_retryable(self, exc, idempotent=True):
+        """Return True if the request that raised `exc` is worth trying again."""
+        if isinstance(exc, HealthVaultHTTPException):
+            statuses = self.retry_http_statuses if idempotent else self.safe_http_statuses
+            return exc.code in statuses
+        if isinstance(exc, HealthVaultException):
+            return idempotent and exc.code in self.retry_statuses
+        if isinstance(exc, socket.error):
+            return idempotent or exc.errno == errno.ECONNREFUSED
+        if isinstance(exc, httplib.HTTPException):
+            return idempotent
+        return False
+
+    def delay(self, retry):
+        """Return how many seconds to wait before retry number `retry` (0 for the first)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def call(self, func, idempotent=True, description="request"):
+        """Return func(), calling it again after a wait each time it fails in a retryable way.
+
+        :param func: callable with no arguments that makes the request
+        :param boolean idempotent: whether making the request twice is the same as making it once
+        :param string description: what to call the request in log messages
+        :raises: whatever the last call to func raised, if it never succeeded
+        """
+        waited = 0.0
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func()
+            except Exception as e:
+                exc_info = sys.exc_info()
+                if attempt == self.max_attempts or not self.is_retryable(e, idempotent):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                wait = self.delay(attempt - 1)
+                when = current_deadline()
+                if waited + wait > self.budget or (when is not None and time.time() + wait >= when):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                logger.warning("%s failed (%s), trying again in %.2f seconds" % (description, e, wait))
+                time.sleep(wait)
+                waited += wait
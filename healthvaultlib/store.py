@@ -0,0 +1,197 @@
+"""Keeping a local copy of things on disk.
+
+A :py:class:`ThingStore` is a SQLite database of parsed things, by record and data type.
+Pass one to a :py:class:`healthvaultlib.healthvault.HealthVaultConn` as `thing_store` and
+every thing fetched with ``batch_get`` is written to it. It survives restarts, so
+:py:meth:`ThingStore.sync` can bring it up to date by fetching only what has changed.
+"""
+import cPickle as pickle
+import hashlib
+import sqlite3
+import threading
+
+from .xmlutils import parse_datetime
+
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS things ('
+    ' record_id TEXT NOT NULL,'
+    ' thing_id TEXT NOT NULL,'
+    ' type_id TEXT NOT NULL,'
+    ' version_stamp TEXT NOT NULL,'
+    ' eff_date TEXT,'
+    ' updated TEXT,'
+    ' data BLOB NOT NULL,'
+    ' checksum TEXT NOT NULL,'
+    ' PRIMARY KEY (record_id, thing_id))',
+    'CREATE INDEX IF NOT EXISTS things_by_date ON things (record_id, type_id, eff_date)',
+]
+
+
+def _format_date(dt):
+    # Sorts the same as the datetimes do, so the index can be used for date ranges
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%f') if dt else None
+
+
+def _checksum(blob):
+    return hashlib.sha1(blob).hexdigest()
+
+
+class ThingStore(object):
+    """A SQLite database of parsed things, indexed by record, data type and effective date.
+
+    Each thing is stored with a checksum of its data, so :py:meth:`check` can find rows
+    that have been corrupted. Only the latest version we've seen of each thing is kept.
+
+    Example::
+
+        store = ThingStore('/var/lib/ourapp/things.db')
+        conn = HealthVaultConn(..., thing_store=store)
+        store.sync(conn, DataType.WEIGHT_MEASUREMENTS)
+        for info, weight in store.get_things(conn.record_id, DataType.WEIGHT_MEASUREMENTS):
+            ...
+
+    :param string path: the database file; ':memory:' for a database that isn't saved
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+
+    def put_things(self, record_id, things):
+        """Store things, replacing any earlier versions of them.
+
+        :param string record_id: the record the things are in
+        :param list things: (info, data) pairs, as returned by ``batch_get(..., include_info=True)``
+        """
+        rows = []
+        for info, data in things:
+            blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            rows.append((record_id, info['thing_id'], info['type_id'], info['version_stamp'],
+                         _format_date(info['eff_date']), _format_date(info.get('updated')),
+                         sqlite3.Binary(blob), _checksum(blob)))
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO things '
+                                 '(record_id, thing_id, type_id, version_stamp, eff_date, updated, data, checksum) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+
+    def remove_things(self, record_id, thing_ids):
+        """Remove things from the store, e.g. because they've been deleted from HealthVault."""
+        with self._lock:
+            self._db.executemany('DELETE FROM things WHERE record_id = ? AND thing_id = ?',
+                                 [(record_id, thing_id) for thing_id in thing_ids])
+            self._db.commit()
+
+    def _where(self, record_id, type_id, min_date, max_date):
+        where = 'record_id = ? AND type_id = ?'
+        args = [record_id, type_id]
+        if min_date:
+            where += ' AND eff_date >= ?'
+            args.append(_format_date(min_date))
+        if max_date:
+            where += ' AND eff_date <= ?'
+            args.append(_format_date(max_date))
+        return where, args
+
+    def get_things(self, record_id, type_id, min_date=None, max_date=None):
+        """Return the stored things of a data type in a record, newest first, like HealthVault does.
+
+        :param datetime.datetime min_date: Only things with an effective datetime after this are returned.
+        :param datetime.datetime max_date: Only things with an effective datetime before this are returned.
+        :returns: a list of (info, data) pairs, where info has the thing_id, version_stamp, type_id,
+            eff_date and updated keys described in :py:func:`healthvaultlib.xmlutils.parse_thing_info`
+        """
+        where, args = self._where(record_id, type_id, min_date, max_date)
+        with self._lock:
+            rows = self._db.execute('SELECT thing_id, version_stamp, type_id, eff_date, updated, data FROM things '
+                                    'WHERE ' + where + ' ORDER BY eff_date DESC', args).fetchall()
+        return [(dict(thing_id=thing_id, version_stamp=version_stamp, type_id=type_id,
+                      eff_date=parse_datetime(eff_date), updated=parse_datetime(updated)),
+                 pickle.loads(str(data)))
+                for (thing_id, version_stamp, type_id, eff_date, updated, data) in rows]
+
+    def versions(self, record_id, type_id, min_date=None, max_date=None):
+        """Return a dictionary mapping the IDs of the stored things of a data type in a record
+        to their version stamps."""
+        where, args = self._where(record_id, type_id, min_date, max_date)
+        with self._lock:
+            return dict(self._db.execute('SELECT thing_id, version_stamp FROM things WHERE ' + where, args))
+
+    def sync(self, conn, type_id, min_date=None, max_date=None):
+        """Bring the stored things of a data type in the conn's record up to date.
+
+        Asks HealthVault for the keys of all the things (see
+        :py:meth:`healthvaultlib.healthvault.HealthVaultConn.iter_thing_keys`), then fetches
+        only the things that are new or have a new version, and removes things that
+        are no longer in HealthVault. A stored thing that isn't listed is only removed once
+        asking for it by ID (see :py:meth:`healthvaultlib.healthvault.HealthVaultConn.get_things_by_ids`)
+        shows it's gone, so a listing that misses things never loses them.
+
+        :param datetime.datetime min_date: Only sync things with an effective datetime after this.
+        :param datetime.datetime max_date: Only sync things with an effective datetime before this.
+        :returns: a dictionary with the numbers of things fetched and stored, and removed, e.g.
+            ``{'fetched': 3, 'removed': 1}``
+        """
+        record_id = conn.record_id
+        stored = self.versions(record_id, type_id, min_date, max_date)
+        changed = []
+        for key in conn.iter_thing_keys(type_id, min_date=min_date, max_date=max_date):
+            if stored.pop(key.thing_id, None) != key.version_stamp:
+                changed.append(key)
+        things = []
+        if changed:
+            fetched = conn.get_things_by_keys([(key.thing_id, key.version_stamp) for key in changed])
+            # Any that have changed again or been deleted since are left for the next sync
+            things = [(key._asdict(), fetched[key.thing_id]) for key in changed if key.thing_id in fetched]
+            self.put_things(record_id, things)
+        gone = []
+        if stored:
+            # Not listed, but only removed if HealthVault doesn't have them either
+            found = conn.get_things_by_ids(stored.keys())
+            gone = [thing_id for thing_id in stored if thing_id not in found]
+            self.remove_things(record_id, gone)
+        return dict(fetched=len(things), removed=len(gone))
+
+    def check(self, repair=False):
+        """Check the database for corruption.
+
+        Runs SQLite's own integrity check, and checks every stored thing's data against
+        its checksum.
+
+        :param boolean repair: If True, remove things whose data is corrupt, so the next
+            :py:meth:`sync` fetches them again.
+        :returns: a list of problems found, as strings. Empty if all is well.
+        """
+        with self._lock:
+            problems = [row[0] for row in self._db.execute('PRAGMA integrity_check') if row[0] != 'ok']
+            bad = []
+            for record_id, thing_id, data, checksum in self._db.execute(
+                    'SELECT record_id, thing_id, data, checksum FROM things'):
+                if _checksum(str(data)) != checksum:
+                    bad.append((record_id, thing_id))
+            problems.extend("Corrupt data for thing %s in record %s" % (thing_id, record_id)
+                            for (record_id, thing_id) in bad)
+            if repair and bad:
+                self._db.executemany('DELETE FROM things WHERE record_id = ? AND thing_id = ?', bad)
+                self._db.commit()
+        return problems
+
+    def compact(self, keep_records=None):
+        """Reclaim unused space in the database file.
+
+        :param list keep_records: If given, first remove the things of all other records,
+            e.g. of people who have deauthorized our application.
+        """
+        with self._lock:
+            if keep_records is not None:
+                keep = set(keep_records)
+                gone = [record_id for (record_id,) in self._db.execute('SELECT DISTINCT record_id FROM things')
+                        if record_id not in keep]
+                self._db.executemany('DELETE FROM things WHERE record_id = ?', [(record_id,) for record_id in gone])
+                self._db.commit()
+            self._db.execute('VACUUM')
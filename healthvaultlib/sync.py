@@ -0,0 +1,162 @@
+"""Incremental sync of HealthVault data into an application's own database.
+
+Fetching things by effective date (e.g. ``get_weight_measurements(min_date=...)``)
+misses things that were entered later with an earlier effective date, and fetches
+things again that haven't changed. :py:class:`SyncEngine` instead remembers, for
+each record and data type, the last time anything changed (a "high-water mark"), and
+next time asks HealthVault only for things created or updated since then.
+
+The marks are kept in a checkpoint store. A mark is only moved forward after the
+application's handler has dealt with the things, so a job that crashes part way
+picks up exactly where it left off next time.
+"""
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+from .xmlutils import parse_datetime
+
+
+# Requested for every thing we sync, so we know when it was last updated
+SYNC_SECTIONS = ['core', 'audits']
+
+
+class CheckpointStore(object):
+    """Somewhere to keep the high-water marks of a :py:class:`SyncEngine`.
+
+    Subclasses implement :py:meth:`get` and :py:meth:`put`. A checkpoint is a
+    dictionary that can be serialized as JSON.
+    """
+    def get(self, record_id, datatype):
+        """Return the checkpoint for this record and data type, or None if there isn't one."""
+        raise NotImplementedError
+
+    def put(self, record_id, datatype, checkpoint):
+        """Save the checkpoint for this record and data type."""
+        raise NotImplementedError
+
+
+class MemoryCheckpointStore(CheckpointStore):
+    """Keeps checkpoints in memory; mostly useful for testing."""
+    def __init__(self):
+        self._checkpoints = {}
+
+    def get(self, record_id, datatype):
+        return self._checkpoints.get((record_id, datatype))
+
+    def put(self, record_id, datatype, checkpoint):
+        self._checkpoints[(record_id, datatype)] = checkpoint
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Keeps checkpoints in a JSON file.
+
+    The file is rewritten on each :py:meth:`put` by writing a new file and renaming it
+    over the old one, so a crash never leaves it half written.
+
+    :param string path: the file to use
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, record_id, datatype):
+        with self._lock:
+            return self._load().get(record_id, {}).get(datatype)
+
+    def put(self, record_id, datatype, checkpoint):
+        with self._lock:
+            checkpoints = self._load()
+            checkpoints.setdefault(record_id, {})[datatype] = checkpoint
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(checkpoints, f)
+            os.rename(tmp_path, self.path)
+
+
+def _format_mark(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+class SyncEngine(object):
+    """Fetch only what's changed in a record since the last sync.
+
+    Example::
+
+        engine = SyncEngine(FileCheckpointStore('/var/lib/ourapp/hv-checkpoints.json'))
+
+        def handler(record_id, datatype, things):
+            for info, data in things:
+                save_to_our_db(record_id, info['thing_id'], data)
+
+        engine.sync(conn, [DataType.WEIGHT_MEASUREMENTS, DataType.BLOOD_PRESSURE_MEASUREMENTS], handler)
+
+    Deleted things aren't reported; HealthVault doesn't return them.
+
+    :param CheckpointStore store: where to keep the high-water marks
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def sync(self, conn, datatypes, handler):
+        """Fetch the things of the given data types that have changed in the conn's record
+        since the last sync, and pass them to handler.
+
+        All the changed things of each data type are fetched, a page at a time with
+        :py:meth:`healthvaultlib.healthvault.HealthVaultConn.iter_things`, before any are
+        passed to the handler. HealthVault returns them by effective date, not by when they
+        changed, so the high-water mark can only be moved once it has them all.
+
+        :param conn: a connected :py:class:`healthvaultlib.healthvault.HealthVaultConn`
+        :param list datatypes: the data types to sync
+        :param handler: called once per data type that has changes, as
+            ``handler(record_id, datatype, things)``, where `things` is a list of (info, data)
+            pairs as returned by ``batch_get(..., include_info=True)``. If it raises an exception,
+            the checkpoints for that data type and any later ones aren't moved.
+        :returns: a dictionary mapping each data type to the number of changed things.
+        """
+        record_id = conn.record_id
+        counts = {}
+        for datatype in datatypes:
+            checkpoint = self.store.get(record_id, datatype)
+            updated_min = parse_datetime(checkpoint['updated']) if checkpoint else None
+            things = list(conn.iter_things(datatype, updated_min=updated_min, sections=SYNC_SECTIONS))
+            things = self._new_things(checkpoint, things)
+            counts[datatype] = len(things)
+            if not things:
+                continue
+            handler(record_id, datatype, things)
+            self.store.put(record_id, datatype, self._checkpoint(checkpoint, things))
+        return counts
+
+    def _new_things(self, checkpoint, things):
+        """Leave out things we already handled at the high-water mark itself;
+        HealthVault's updated-date-min is inclusive, and only to the second."""
+        if not checkpoint:
+            return things
+        mark = parse_datetime(checkpoint['updated'])
+        seen = set(checkpoint['versions'])
+        return [(info, data) for (info, data) in things
+                if not (self._updated(info) <= mark and info['version_stamp'] in seen)]
+
+    def _updated(self, info):
+        return info['updated'] or info['eff_date'] or datetime.datetime.min
+
+    def _checkpoint(self, old, things):
+        """Return the new checkpoint after handling things."""
+        mark = max(self._updated(info) for (info, data) in things)
+        old_mark = parse_datetime(old['updated']) if old else None
+        if old_mark is not None and old_mark > mark:
+            return old
+        versions = set(info['version_stamp'] for (info, data) in things if self._updated(info) == mark)
+        if old_mark == mark:
+            versions.update(old['versions'])
+        return {'updated': _format_mark(mark), 'versions': sorted(versions)}
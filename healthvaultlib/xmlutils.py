@@ -1,5 +1,6 @@
 """Some utilities for handling XML"""
 import StringIO
+import collections
 import datetime
 import logging
 
@@ -102,6 +103,30 @@ def when_to_datetime(when):
     #return datetime.datetime(*[int(when.find(path).text) for path in paths])
 
 
+def parse_datetime(text):
+    """Parse an XML Schema dateTime as HealthVault returns them, e.g. '2012-11-08T13:02:38.649'
+    or '2012-11-08T18:02:38.649Z'.
+
+    :returns: a naive datetime.datetime object. If the text had a time zone, it's converted to UTC.
+    """
+    if text is None:
+        return None
+    offset = datetime.timedelta(0)
+    if text.endswith('Z'):
+        text = text[:-1]
+    elif len(text) > 6 and text[-6] in '+-' and text[-3] == ':':
+        sign = 1 if text[-6] == '+' else -1
+        offset = sign * datetime.timedelta(hours=int(text[-5:-3]), minutes=int(text[-2:]))
+        text = text[:-6]
+    if '.' in text:
+        text, fraction = text.split('.')
+        microsecond = int((fraction + '000000')[:6])
+    else:
+        microsecond = 0
+    dt = datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S').replace(microsecond=microsecond)
+    return dt - offset
+
+
 # Parse specific MS HealthVault XML types and return dictionaries
 def parse_approximate_date(elt):
     """
@@ -582,6 +607,229 @@ def parse_connect_request(elt):
     )
 
 
+def parse_person_info(elt):
+    """
+    A <person-info> element, as returned by GetPersonInfo
+    https://platform.healthvault-ppe.com/platform/XSD/response-getpersoninfo.xsd
+    """
+    return dict(
+        person_id=text_or_none(elt, 'person-id'),
+        name=text_or_none(elt, 'name'),
+        selected_record_id=text_or_none(elt, 'selected-record-id'),
+        records=[parse_record(e) for e in elt.findall('record')],
+    )
+
+
+def parse_record(elt):
+    """
+    A <record> the person has authorized the application to access, from <person-info>
+    https://platform.healthvault-ppe.com/platform/XSD/types.xsd
+    """
+    return dict(
+        id=elt.get('id'),
+        name=elt.text,
+        display_name=elt.get('display-name'),
+        rel_name=elt.get('rel-name'),
+        state=elt.get('state'),
+        auth_expires=parse_datetime(elt.get('auth-expires')),
+    )
+
+
+def parse_begin_put_blob(elt):
+    """
+    https://platform.healthvault-ppe.com/platform/XSD/response-beginputblob.xsd
+    """
+    return dict(
+        blob_ref_url=text_or_none(elt, 'blob-ref-url'),
+        blob_chunk_size=int_or_none(elt, 'blob-chunk-size'),
+        max_blob_size=int_or_none(elt, 'max-blob-size'),
+        blob_hash_algorithm=text_or_none(elt, 'blob-hash-algorithm'),
+        block_size=int_or_none(elt, 'blob-hash-parameters/block-size'),
+    )
+
+
+def parse_blob(elt):
+    """
+    A <blob> from the blob-payload section of a thing
+    https://platform.healthvault-ppe.com/platform/XSD/thing.xsd
+    """
+    return dict(
+        name=text_or_none(elt, 'blob-info/name') or '',
+        content_type=text_or_none(elt, 'blob-info/content-type'),
+        hash=text_or_none(elt, 'blob-info/hash-info/hash'),
+        content_length=int_or_none(elt, 'content-length'),
+        blob_ref_url=text_or_none(elt, 'blob-ref-url'),
+    )
+
+
+def parse_basic_demographic(elt):
+    """
+    urn:com.microsoft.wc.thing.basic:basic
+    http://developer.healthvault.com/pages/types/type.aspx?id=3b3e6b16-eb69-483c-8d7e-dfe116ae6092
+    """
+    return dict(
+        gender=text_or_none(elt, 'gender'),
+        birthyear=int_or_none(elt, 'birthyear'),
+        country_text=text_or_none(elt, 'country/text'),
+        country_code=text_or_none(elt, 'country/code/value'),
+        postcode=text_or_none(elt, 'postcode'),
+        state=text_or_none(elt,'state/text')
+    )
+
+
+def parse_blood_pressure(elt):
+    """
+    urn:com.microsoft.wc.thing.bp:blood-pressure
+    http://developer.healthvault.com/pages/types/type.aspx?id=ca3c57f4-f4c1-4e15-be67-0a3caf5414ed
+    """
+    return dict(
+        when = when_to_datetime(elt.find("when")),
+        systolic = int_or_none(elt, 'systolic'),
+        diastolic = int_or_none(elt, 'diastolic'),
+        pulse = int_or_none(elt, 'pulse'),
+        irregular_heartbeat = boolean_or_none(elt, 'irregular-heartbeat'),
+    )
+
+
+# For each data type we can parse, the tag of the element inside <data-xml>
+# and the function that parses it
+THING_PARSERS = {
+    DataType.BASIC_DEMOGRAPHIC_DATA: ('basic', parse_basic_demographic),
+    DataType.BLOOD_GLUCOSE_MEASUREMENT: ('blood-glucose', parse_blood_glucose),
+    DataType.BLOOD_PRESSURE_MEASUREMENTS: ('blood-pressure', parse_blood_pressure),
+    DataType.DEVICES: ('device', parse_device),
+    DataType.EXERCISE: ('exercise', parse_exercise),
+    DataType.HEIGHT_MEASUREMENTS: ('height', parse_height),
+    DataType.SLEEP_SESSIONS: ('sleep-am', parse_sleep_session),
+    DataType.WEIGHT_MEASUREMENTS: ('weight', parse_weight),
+}
+
+# Data types where there's only one thing per record, so we return it
+# by itself instead of in a list
+SINGLETON_TYPES = (DataType.BASIC_DEMOGRAPHIC_DATA,)
+
+
+def parse_thing(thing):
+    """Given a <thing> element, return the parsed contents of its <data-xml>, using the
+    parser for its data type. Returns None if the thing has no data of the expected form.
+
+    :raises: :py:exc:`HealthVaultException` if we don't know how to parse things of this type.
+    """
+    data_type = thing.find('type-id').text
+    if data_type not in THING_PARSERS:
+        raise HealthVaultException("Unknown data type in group response: name='%s'" % data_type)
+    tag, parser = THING_PARSERS[data_type]
+    for data_xml in thing.findall('data-xml'):
+        # Skip the output of any transforms we asked for
+        if data_xml.get('transform') is None:
+            return parse_optional_item(data_xml, tag, parser)
+    return None
+
+
+# The element a digitally signed thing's signature is in
+XMLDSIG_SIGNATURE = '{http://www.w3.org/2000/09/xmldsig#}Signature'
+
+
+def parse_thing_sections(thing):
+    """Given a <thing> element, return a dictionary with whatever it has from the sections
+    other than core and from transforms. Only the keys for things present are included:
+
+    * blobs: a list of blobs, as returned by :py:func:`parse_blob` (blobpayload section)
+    * effective_permissions: a list of permission names, e.g. ``['Read', 'Update']``
+      (effectivepermissions section)
+    * tags: a string (tags section)
+    * signed: True if the thing has a digital signature (digitalsignatures or signatureinfo section)
+    * transformed: a dictionary mapping the name of each transform to its output, as an
+      ElementTree element
+    """
+    sections = {}
+    if thing.find('blob-payload') is not None:
+        sections['blobs'] = [parse_blob(elt) for elt in thing.findall('blob-payload/blob')]
+    if thing.find('eff-permissions') is not None:
+        sections['effective_permissions'] = text_list(thing, 'eff-permissions/permission')
+    if thing.find('tags') is not None:
+        sections['tags'] = thing.find('tags').text or ''
+    if thing.find('signature-info') is not None or thing.find(XMLDSIG_SIGNATURE) is not None:
+        sections['signed'] = True
+    transformed = dict((elt.get('transform'), elt) for elt in thing.findall('data-xml') if elt.get('transform'))
+    if transformed:
+        sections['transformed'] = transformed
+    return sections
+
+
+def parse_thing_info(thing):
+    """Given a <thing> element, return a dictionary with what identifies it and
+    when it was changed, but not its data.
+
+    `updated` is only available if the audits section was requested, otherwise it's None.
+
+    Example::
+
+        {'thing_id': '10993223-00c5-45bb-b615-ef9feda9410d',
+         'version_stamp': '50b1d853-c990-407d-bd93-3cc7563d9171',
+         'type_id': '3d34d87e-7fc1-4153-800f-f56592cb0d17',
+         'eff_date': datetime.datetime(2012, 11, 12, 11, 24),
+         'updated': datetime.datetime(2012, 11, 12, 16, 30, 5, 120000)}
+
+    Anything from other sections or transforms is added too; see :py:func:`parse_thing_sections`.
+    """
+    thing_id = thing.find('thing-id')
+    info = dict(
+        thing_id=thing_id.text,
+        version_stamp=thing_id.get('version-stamp'),
+        type_id=text_or_none(thing, 'type-id'),
+        eff_date=parse_datetime(text_or_none(thing, 'eff-date')),
+        updated=parse_datetime(text_or_none(thing, 'updated/timestamp')),
+    )
+    info.update(parse_thing_sections(thing))
+    return info
+
+
+# What a keys-only query returns for each thing; see parse_thing_key
+ThingKey = collections.namedtuple('ThingKey', 'thing_id version_stamp type_id eff_date updated')
+
+
+def parse_thing_key(thing):
+    """Given a <thing> element, return a :py:data:`ThingKey` tuple with the same values as
+    :py:func:`parse_thing_info`, for when there are too many things to want a dictionary each."""
+    thing_id = thing.find('thing-id')
+    return ThingKey(thing_id.text,
+                    thing_id.get('version-stamp'),
+                    text_or_none(thing, 'type-id'),
+                    parse_datetime(text_or_none(thing, 'eff-date')),
+                    parse_datetime(text_or_none(thing, 'updated/timestamp')))
+
+
+def parse_group_keys(group):
+    """Given a <group> element, return a list of :py:data:`ThingKey` tuples, one for each thing.
+
+    That includes the things HealthVault only lists the keys of, in
+    <unprocessed-thing-key-info> elements, because there were more than it returns in
+    full; their `updated` is None, as it isn't listed.
+    """
+    return [parse_thing_key(thing)
+            for thing in group.findall('thing') + group.findall('unprocessed-thing-key-info')]
+
+
+def parse_group_things(group):
+    """Given a <group> element, return a list of (info, data) pairs, one for each thing,
+    where info is what :py:func:`parse_thing_info` returns and data is what
+    :py:func:`parse_thing` returns."""
+    return [(parse_thing_info(thing), parse_thing(thing)) for thing in group.findall('thing')]
+
+
+def group_data(things):
+    """Given a list of (info, data) pairs, as returned by :py:func:`parse_group_things`,
+    return what :py:func:`parse_group` would have returned for the same group."""
+    if not things:
+        return []
+    parsed = [data for (info, data) in things if data is not None]
+    if things[0][0]['type_id'] in SINGLETON_TYPES:
+        # No data if it wasn't asked for, e.g. only transforms or no XML at all
+        return parsed[0] if parsed else None
+    return parsed
+
+
 def parse_group(group):
     """Given an element that contains a <group>...</group>
     return whatever parsing that group as a response to the specific API
@@ -591,46 +839,14 @@ def parse_group(group):
     from the <thing><type-id>xxxxxxxx</type-id></thing> value.
     """
 
-    if not len(group.findall('thing')):
+    things = group.findall('thing')
+    if not things:
         # No results
         return []
 
-    data_type = group.find('thing/type-id').text
-
-    # FIXME: should we replace all these if/elif clauses with a table-driven implementation?
-    if data_type == DataType.BASIC_DEMOGRAPHIC_DATA:
-        basic = group.find('thing/data-xml/basic')
-        return dict(
-            gender=text_or_none(basic, 'gender'),
-            birthyear=int_or_none(basic, 'birthyear'),
-            country_text=text_or_none(basic, 'country/text'),
-            country_code=text_or_none(basic, 'country/code/value'),
-            postcode=text_or_none(basic, 'postcode'),
-            state=text_or_none(basic,'state/text')
-        )
-    elif data_type == DataType.BLOOD_GLUCOSE_MEASUREMENT:
-        return [parse_blood_glucose(item) for item in group.findall('thing/data-xml/blood-glucose')]
-    elif data_type == DataType.BLOOD_PRESSURE_MEASUREMENTS:
-        things = []
-        for thing in group.findall('thing/data-xml/blood-pressure'):
-            things.append(dict(
-                when = when_to_datetime(thing.find("when")),
-                systolic = int_or_none(thing, 'systolic'),
-                diastolic = int_or_none(thing, 'diastolic'),
-                pulse = int_or_none(thing, 'pulse'),
-                irregular_heartbeat = boolean_or_none(thing, 'irregular-heartbeat'),
-            ))
-        return things
-    elif data_type == DataType.DEVICES:
-        return [parse_device(e) for e in group.findall('thing/data-xml/device')]
-    elif data_type == DataType.EXERCISE:
-        return [parse_exercise(e) for e in group.findall('thing/data-xml/exercise')]
-    elif data_type == DataType.HEIGHT_MEASUREMENTS:
-        return [parse_height(e) for e in group.findall('thing/data-xml/height')]
-    elif data_type == DataType.SLEEP_SESSIONS:
-        return [parse_sleep_session(s) for s in group.findall('thing/data-xml/sleep-am')]
-    elif data_type == DataType.WEIGHT_MEASUREMENTS:
-        return [parse_weight(e) for e in group.findall('thing/data-xml/weight')]
-    else:
-        # import here to avoid circular imports
-        raise HealthVaultException("Unknown data type in group response: name='%s'" % data_type)
+    data_type = things[0].find('type-id').text
+    parsed = [item for item in (parse_thing(thing) for thing in things) if item is not None]
+    if data_type in SINGLETON_TYPES:
+        # No data if it wasn't asked for, e.g. only transforms or no XML at all
+        return parsed[0] if parsed else None
+    return parsed
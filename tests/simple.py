@@ -196,6 +196,22 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.wfile.write("".join(["<li>" + repr(d) + "</li>" for d in data]))
             self.wfile.write("</ul>\n")
 
+        # Compare how many bytes different formats of the same query cost
+        self.wfile.write("Bytes received for weights: <ul>")
+        for label, request in [("full", {}),
+                               ("keys only", {'keys_only': True}),
+                               ("no data-xml", {'include_xml': False}),
+                               ("mtt transform only", {'include_xml': False, 'transforms': ['mtt']})]:
+            request['datatype'] = DataType.WEIGHT_MEASUREMENTS
+            before = conn.stats['bytes_received']
+            try:
+                conn.batch_get([request])
+            except HealthVaultException as e:
+                self.wfile.write("<li>%s: exception %s</li>" % (label, e))
+            else:
+                self.wfile.write("<li>%s: %d</li>" % (label, conn.stats['bytes_received'] - before))
+        self.wfile.write("</ul>\n")
+
         self.wfile.write("END.<br/>\n")
 
 
@@ -0,0 +1,80 @@
+"""Tests for batching get_* calls"""
+
+import datetime
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.batching import Batch, plan_batches
+from healthvaultlib.datatypes import DataType
+from healthvaultlib.exceptions import HealthVaultException
+from healthvaultlib.healthvault import HealthVaultConn
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        with mock.patch.object(HealthVaultConn, '_get_auth_token'):
+            self.conn = HealthVaultConn("APP", "THUMBPRINT", 1L, 1L)
+        self.conn.batch_get = mock.Mock()
+
+    def test_one_request(self):
+        self.conn.batch_get.return_value = ["WEIGHTS", "DEVICES"]
+        week_ago = datetime.datetime(2012, 1, 1)
+        with Batch(self.conn) as batch:
+            weights = batch.get_weight_measurements(min_date=week_ago)
+            devices = batch.get_devices()
+            self.assertFalse(weights.done())
+        self.conn.batch_get.assert_called_once_with(
+            [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': week_ago, 'max_date': None, 'max': None},
+             {'datatype': DataType.DEVICES}], False, deadline=None)
+        self.assertEqual("WEIGHTS", weights.result())
+        self.assertEqual("DEVICES", devices.result())
+
+    def test_duplicates(self):
+        self.conn.batch_get.return_value = ["WEIGHTS"]
+        batch = Batch(self.conn)
+        first = batch.get_weight_measurements()
+        second = batch.batch_get({'datatype': DataType.WEIGHT_MEASUREMENTS})[0]
+        self.assertIs(first, second)
+        # Asking for a result sends the batch
+        self.assertEqual("WEIGHTS", second.result())
+        self.assertEqual(1, len(self.conn.batch_get.call_args[0][0]))
+        self.assertEqual(dict(requests=2, sent=1, batches=1), batch.stats)
+
+    def test_include_info_and_deadline(self):
+        self.conn.batch_get.side_effect = [["HEIGHTS"], ["INFO"]]
+        batch = Batch(self.conn)
+        heights = batch.get_height_measurements(deadline=1010)
+        info = batch.batch_get({'datatype': DataType.HEIGHT_MEASUREMENTS}, include_info=True, deadline=1005)[0]
+        batch.flush()
+        self.assertEqual([mock.call([{'datatype': DataType.HEIGHT_MEASUREMENTS, 'min_date': None,
+                                      'max_date': None, 'max': None}], False, deadline=1005),
+                          mock.call([{'datatype': DataType.HEIGHT_MEASUREMENTS}], True, deadline=1005)],
+                         self.conn.batch_get.call_args_list)
+        self.assertEqual("HEIGHTS", heights.result())
+        self.assertEqual("INFO", info.result())
+
+    def test_exception(self):
+        self.conn.batch_get.side_effect = HealthVaultException("Nope")
+        with Batch(self.conn) as batch:
+            weights = batch.get_weight_measurements()
+        self.assertTrue(weights.done())
+        self.assertRaises(HealthVaultException, weights.result)
+
+    def test_not_batchable(self):
+        self.assertRaises(AttributeError, getattr, Batch(self.conn), 'remove_things')
+
+
+class PlanBatchesTests(TestCase):
+    def test_max_groups(self):
+        requests = [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'max': 1}] * 25
+        self.assertEqual([range(10), range(10, 20), range(20, 25)], plan_batches(requests, 10))
+
+    def test_max_size(self):
+        big = {'datatype': DataType.WEIGHT_MEASUREMENTS}
+        small = {'datatype': DataType.WEIGHT_MEASUREMENTS, 'max': 1}
+        keys = {'datatype': DataType.WEIGHT_MEASUREMENTS, 'keys_only': True}
+        # Without a max, about 100 things, 2000 bytes each
+        self.assertEqual([[0, 1], [2, 3, 4]], plan_batches([big, small, big, keys, small], 10, max_size=300000))
+        # Too big on its own still gets sent
+        self.assertEqual([[0], [1]], plan_batches([big, big], 10, max_size=1000))
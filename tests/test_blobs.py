@@ -0,0 +1,88 @@
+"""Tests for blob streaming helpers"""
+
+import base64
+import hashlib
+import StringIO
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.blobs import BlobHasher, download_chunks, upload_chunks
+from healthvaultlib.exceptions import HealthVaultHTTPException
+
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+class BlobHasherTests(TestCase):
+    def test_one_block(self):
+        hasher = BlobHasher(block_size=8)
+        hasher.update("abc")
+        expected = base64.b64encode(sha256(sha256("abc")))
+        self.assertEqual(expected, hasher.digest())
+
+    def test_empty(self):
+        expected = base64.b64encode(sha256(sha256("")))
+        self.assertEqual(expected, BlobHasher(block_size=8).digest())
+
+    def test_blocks_split_across_updates(self):
+        # How the data is split up between calls to update doesn't matter
+        data = "0123456789abcdefXYZ"
+        expected = base64.b64encode(sha256(sha256("01234567") + sha256("89abcdef") + sha256("XYZ")))
+        hasher = BlobHasher(block_size=8)
+        for piece in ("012", "3456789abcd", "efX", "YZ"):
+            hasher.update(piece)
+        self.assertEqual(expected, hasher.digest())
+        hasher = BlobHasher(block_size=8)
+        hasher.update(data)
+        self.assertEqual(expected, hasher.digest())
+
+    def test_exact_blocks(self):
+        expected = base64.b64encode(sha256(sha256("01234567") + sha256("89abcdef")))
+        hasher = BlobHasher(block_size=8)
+        hasher.update("0123456789abcdef")
+        self.assertEqual(expected, hasher.digest())
+
+
+class TransferTests(TestCase):
+    def mock_conn(self, status=200):
+        conn = mock.Mock()
+        conn.getresponse.return_value.status = status
+        return conn
+
+    def test_upload_chunks(self):
+        conn = self.mock_conn()
+        # The buffers get reused, so copy what's sent at the time
+        sent = []
+        conn.send.side_effect = lambda chunk: sent.append(str(chunk))
+        hasher = BlobHasher(block_size=4)
+        nbytes = upload_chunks(conn, "/blob?token=1", StringIO.StringIO("0123456789"), 4, hasher)
+        self.assertEqual(10, nbytes)
+        self.assertEqual(["0123", "4567", "89"], sent)
+        conn.putheader.assert_any_call('Content-Range', 'bytes 8-9/*')
+        # Only the last chunk says the blob is complete
+        complete_calls = [c for c in conn.putheader.call_args_list if c[0][0] == 'x-hv-blob-complete']
+        self.assertEqual(1, len(complete_calls))
+        self.assertEqual(conn.putheader.call_args_list[-1], complete_calls[0])
+        check = BlobHasher(block_size=4)
+        check.update("0123456789")
+        self.assertEqual(check.digest(), hasher.digest())
+
+    def test_upload_exact_multiple_of_chunk_size(self):
+        # Reading ahead means we don't send an empty chunk at the end
+        conn = self.mock_conn()
+        upload_chunks(conn, "/blob", StringIO.StringIO("01234567"), 4, BlobHasher(block_size=4))
+        self.assertEqual(2, conn.send.call_count)
+        self.assertEqual(('x-hv-blob-complete', '1'), conn.putheader.call_args_list[-1][0])
+
+    def test_upload_failure(self):
+        conn = self.mock_conn(status=500)
+        self.assertRaises(HealthVaultHTTPException, upload_chunks,
+                          conn, "/blob", StringIO.StringIO("0123"), 4, BlobHasher(block_size=4))
+
+    def test_download_chunks(self):
+        out = StringIO.StringIO()
+        nbytes = download_chunks(StringIO.StringIO("0123456789"), out, chunk_size=3)
+        self.assertEqual(10, nbytes)
+        self.assertEqual("0123456789", out.getvalue())
@@ -0,0 +1,91 @@
+"""Tests for the circuit breaker"""
+
+import socket
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from healthvaultlib.exceptions import (HealthVaultAccessDeniedException, HealthVaultCircuitOpenException,
+                                       HealthVaultHTTPException)
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        patcher = mock.patch('healthvaultlib.breaker.time')
+        mock_time = patcher.start()
+        mock_time.time.side_effect = lambda: self.time
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_rate=0.5, min_requests=4, window=60, open_time=30)
+        self.changes = []
+        self.breaker.add_listener(lambda server, old, new: self.changes.append((server, old, new)))
+
+    def fail(self, server="S", exc=None):
+        def func():
+            raise exc or socket.error(104, "Connection reset by peer")
+        self.assertRaises(Exception, self.breaker.call, server, func)
+
+    def test_opens_on_failure_rate(self):
+        self.assertEqual("OK", self.breaker.call("S", lambda: "OK"))
+        self.fail()
+        self.fail()
+        # Not enough requests yet to judge
+        self.assertEqual(CLOSED, self.breaker.state("S"))
+        self.fail()
+        self.assertEqual(OPEN, self.breaker.state("S"))
+        self.assertEqual([("S", CLOSED, OPEN)], self.changes)
+        func = mock.Mock()
+        self.assertRaises(HealthVaultCircuitOpenException, self.breaker.call, "S", func)
+        self.assertFalse(func.called)
+        self.assertEqual(1, self.breaker.stats['rejected'])
+        # Other servers aren't affected
+        self.assertEqual("OK", self.breaker.call("T", lambda: "OK"))
+
+    def test_healthvault_errors_dont_count(self):
+        for i in range(4):
+            self.fail(exc=HealthVaultAccessDeniedException("Access denied", code=11))
+        self.assertEqual(CLOSED, self.breaker.state("S"))
+        for i in range(4):
+            self.fail(exc=HealthVaultHTTPException("Service unavailable", code=503))
+        self.assertEqual(OPEN, self.breaker.state("S"))
+
+    def test_old_failures_forgotten(self):
+        for i in range(3):
+            self.fail()
+        self.time += 61
+        for i in range(3):
+            self.breaker.call("S", lambda: "OK")
+        self.assertEqual(CLOSED, self.breaker.state("S"))
+
+    def test_opens_on_slow_requests(self):
+        breaker = CircuitBreaker(slow_request_time=10, min_requests=2)
+
+        def slow():
+            self.time += 11
+        breaker.call("S", slow)
+        breaker.call("S", slow)
+        self.assertEqual(OPEN, breaker.state("S"))
+
+    def test_half_open(self):
+        for i in range(4):
+            self.fail()
+        self.time += 31
+        self.assertEqual(HALF_OPEN, self.breaker.state("S"))
+
+        # Only one probe at a time
+        def probe():
+            self.assertRaises(HealthVaultCircuitOpenException, self.breaker.call, "S", lambda: "OK")
+            return "OK"
+        self.assertEqual("OK", self.breaker.call("S", probe))
+        self.assertEqual(CLOSED, self.breaker.state("S"))
+        self.assertEqual([("S", CLOSED, OPEN), ("S", OPEN, HALF_OPEN), ("S", HALF_OPEN, CLOSED)], self.changes)
+        self.assertEqual(dict(opened=1, half_opened=1, closed=1, rejected=1), self.breaker.stats)
+
+    def test_failed_probe_opens_again(self):
+        for i in range(4):
+            self.fail()
+        self.time += 31
+        self.fail()
+        self.assertEqual(OPEN, self.breaker.state("S"))
+        self.assertEqual(2, self.breaker.stats['opened'])
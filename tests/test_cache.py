@@ -0,0 +1,382 @@
+"""Tests for the thing cache"""
+
+import datetime
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.cache import (MemoryPersonInfoCache, NegativeCache, RequestCoalescer, ResponseCache,
+                                  SingleFlight, SQLitePersonInfoCache, ThingCache)
+from healthvaultlib.datatypes import DataType
+from healthvaultlib.exceptions import (HealthVaultAccessDeniedException, HealthVaultException,
+                                       HealthVaultHTTPException)
+from healthvaultlib.status_codes import HealthVaultStatus
+from healthvaultlib.targets import ApplicationTarget
+
+
+def info(thing_id, version_stamp, type_id=DataType.WEIGHT_MEASUREMENTS):
+    return dict(thing_id=thing_id, version_stamp=version_stamp, type_id=type_id,
+                eff_date=datetime.datetime(2012, 1, 1), updated=None)
+
+
+class ThingCacheTests(TestCase):
+    def test_get_put(self):
+        cache = ThingCache()
+        self.assertEqual((False, None), cache.get("T1", "V1"))
+        cache.put("T1", "V1", {'kg': 60.0})
+        self.assertEqual((True, {'kg': 60.0}), cache.get("T1", "V1"))
+        # Another version of the thing is a miss, and replaces the old one
+        self.assertEqual((False, None), cache.get("T1", "V2"))
+        cache.put("T1", "V2", {'kg': 61.0})
+        self.assertEqual((False, None), cache.get("T1", "V1"))
+        self.assertEqual({'hits': 1, 'misses': 3}, cache.stats)
+        self.assertEqual(0.25, cache.hit_rate)
+
+    def test_lru(self):
+        cache = ThingCache(maxsize=2)
+        cache.put("T1", "V", 1)
+        cache.put("T2", "V", 2)
+        cache.get("T1", "V")
+        cache.put("T3", "V", 3)
+        # T2 was the least recently used
+        self.assertEqual((False, None), cache.get("T2", "V"))
+        self.assertEqual((True, 1), cache.get("T1", "V"))
+        self.assertEqual((True, 3), cache.get("T3", "V"))
+
+    def test_sqlite(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dirname, "things.db")
+            cache = ThingCache(maxsize=1, path=path)
+            cache.put("T1", "V1", {'when': datetime.datetime(2012, 1, 1)})
+            cache.put("T2", "V1", None)
+            # T1 fell out of memory but is still in the database
+            self.assertEqual((True, {'when': datetime.datetime(2012, 1, 1)}), cache.get("T1", "V1"))
+            # and so is everything for a new cache using the same file
+            cache = ThingCache(path=path)
+            self.assertEqual((True, None), cache.get("T2", "V1"))
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_batch_get(self):
+        cache = ThingCache()
+        cache.put("T1", "V1", {'kg': 60.0})
+        cache.put("T2", "OLD", {'kg': 0.0})
+        conn = mock.Mock()
+        conn.batch_get.return_value = [[(info("T1", "V1"), None), (info("T2", "V2"), None)],
+                                       [(info("T3", "V1", DataType.BASIC_DEMOGRAPHIC_DATA), None)]]
+        conn.get_things_by_keys.return_value = {"T2": {'kg': 61.0}, "T3": {'gender': 'f'}}
+        result = cache.batch_get(conn, [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'max': 2},
+                                        {'datatype': DataType.BASIC_DEMOGRAPHIC_DATA}])
+        self.assertEqual([[{'kg': 60.0}, {'kg': 61.0}], {'gender': 'f'}], result)
+        # The first request was for keys only
+        conn.batch_get.assert_called_with(
+            [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'max': 2, 'include_xml': False},
+             {'datatype': DataType.BASIC_DEMOGRAPHIC_DATA, 'include_xml': False}],
+            include_info=True)
+        # Only the new and changed things were downloaded
+        conn.get_things_by_keys.assert_called_with([("T2", "V2"), ("T3", "V1")])
+
+        # Next time, everything comes from the cache
+        conn.get_things_by_keys.reset_mock()
+        result = cache.batch_get(conn, {'datatype': DataType.WEIGHT_MEASUREMENTS, 'max': 2}, include_info=True)
+        self.assertEqual([[(info("T1", "V1"), {'kg': 60.0}), (info("T2", "V2"), {'kg': 61.0})]], result)
+        self.assertFalse(conn.get_things_by_keys.called)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        self.conn = mock.Mock(record_id="RECORD")
+        # Requests are keyed by the XML they'd be sent as
+        self.conn._build_thing_group.side_effect = lambda **request: repr(sorted(request.items()))
+        self.time = 1000.0
+        patcher = mock.patch('healthvaultlib.cache.time')
+        self.addCleanup(patcher.stop)
+        patcher.start().time.side_effect = lambda: self.time
+
+    def test_hits_and_misses(self):
+        cache = ResponseCache(ttl=10)
+        self.conn._batch_get.return_value = [["W"], ["D"]]
+        weights = {'datatype': DataType.WEIGHT_MEASUREMENTS}
+        devices = {'datatype': DataType.DEVICES}
+        self.assertEqual([["W"], ["D"]], cache.batch_get(self.conn, [weights, devices]))
+        # Only what isn't cached yet is fetched
+        self.conn._batch_get.return_value = [["H"]]
+        heights = {'datatype': DataType.HEIGHT_MEASUREMENTS}
+        self.assertEqual([["W"], ["H"]], cache.batch_get(self.conn, [weights, heights]))
+        self.conn._batch_get.assert_called_with([heights], False)
+        # Other records and include_info are cached separately
+        self.conn.record_id = "OTHER"
+        self.conn._batch_get.return_value = [["W2"]]
+        self.assertEqual([["W2"]], cache.batch_get(self.conn, weights))
+        self.assertEqual(dict(hits=1, misses=4, stale=0, refreshes=0, errors=0), cache.stats)
+
+    def test_ttls_and_lru(self):
+        cache = ResponseCache(ttl=10, ttls={DataType.DEVICES: 100}, stale_ttl=0, maxsize=2)
+        weights = {'datatype': DataType.WEIGHT_MEASUREMENTS}
+        devices = {'datatype': DataType.DEVICES}
+        self.conn._batch_get.return_value = [["W"], ["D"]]
+        cache.batch_get(self.conn, [weights, devices])
+        self.time += 50
+        self.conn._batch_get.return_value = [["W2"]]
+        self.assertEqual([["W2"], ["D"]], cache.batch_get(self.conn, [weights, devices]))
+        self.conn._batch_get.return_value = [["H"]]
+        cache.batch_get(self.conn, {'datatype': DataType.HEIGHT_MEASUREMENTS})
+        # Devices was least recently used, so it was dropped
+        self.conn._batch_get.return_value = [["D2"]]
+        self.assertEqual([["D2"]], cache.batch_get(self.conn, devices))
+
+    def test_stale_while_revalidate(self):
+        cache = ResponseCache(ttl=10, stale_ttl=60)
+        weights = {'datatype': DataType.WEIGHT_MEASUREMENTS}
+        self.conn._batch_get.return_value = [["W"]]
+        cache.batch_get(self.conn, weights)
+        self.time += 30
+        self.conn._batch_get.return_value = [["W2"]]
+        with mock.patch('healthvaultlib.cache.threading.Thread') as Thread:
+            # The stale result comes back straight away
+            self.assertEqual([["W"]], cache.batch_get(self.conn, weights))
+            # A second caller doesn't start a second refresh
+            self.assertEqual([["W"]], cache.batch_get(self.conn, weights))
+        self.assertEqual(1, Thread.call_count)
+        # Run the refresh
+        target, args = Thread.call_args[1]['target'], Thread.call_args[1]['args']
+        target(*args)
+        self.assertEqual([["W2"]], cache.batch_get(self.conn, weights))
+        self.assertEqual(1, cache.stats['refreshes'])
+
+    def test_stale_if_error(self):
+        cache = ResponseCache(ttl=10, stale_ttl=0, stale_if_error=100)
+        weights = {'datatype': DataType.WEIGHT_MEASUREMENTS}
+        self.conn._batch_get.return_value = [["W"]]
+        cache.batch_get(self.conn, weights)
+        self.time += 50
+        self.conn._batch_get.side_effect = socket.timeout("timed out")
+        self.assertEqual([["W"]], cache.batch_get(self.conn, weights))
+        self.assertEqual(1, cache.stats['errors'])
+        # Other errors aren't hidden
+        self.conn._batch_get.side_effect = HealthVaultException("Access denied", code=11)
+        self.assertRaises(HealthVaultException, cache.batch_get, self.conn, weights)
+        # and neither are errors once the result is too old
+        self.time += 100
+        self.conn._batch_get.side_effect = HealthVaultHTTPException("Busy", code=503)
+        self.assertRaises(HealthVaultHTTPException, cache.batch_get, self.conn, weights)
+
+    def test_interrupted_fill(self):
+        cache = ResponseCache(ttl=10, stale_ttl=0, stale_if_error=100)
+        weights = {'datatype': DataType.WEIGHT_MEASUREMENTS}
+        self.conn._batch_get.return_value = [["W"]]
+        cache.batch_get(self.conn, weights)
+        self.time += 50
+        # Not hidden by the cached result, and the request isn't left claimed
+        self.conn._batch_get.side_effect = KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, cache.batch_get, self.conn, weights)
+        self.conn._batch_get.side_effect = None
+        self.conn._batch_get.return_value = [["W2"]]
+        self.assertEqual([["W2"]], cache.batch_get(self.conn, weights))
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        self.conn._batch_get.return_value = [["W"]]
+        cache.batch_get(self.conn, {'datatype': DataType.WEIGHT_MEASUREMENTS})
+        cache.invalidate("RECORD")
+        cache.batch_get(self.conn, {'datatype': DataType.WEIGHT_MEASUREMENTS})
+        self.assertEqual(2, self.conn._batch_get.call_count)
+
+
+class SingleFlightTests(TestCase):
+    def test_one_call(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "result"
+        results = []
+        first = threading.Thread(target=lambda: results.append(flight.do("key", fetch)))
+        first.start()
+        started.wait()
+        call, leader = flight.claim("key")
+        self.assertFalse(leader)
+        release.set()
+        self.assertEqual("result", call.wait())
+        first.join()
+        self.assertEqual(["result"], results)
+        self.assertEqual(1, len(calls))
+        # Once it's finished, the next call runs again
+        self.assertEqual("result", flight.do("key", fetch))
+        self.assertEqual(2, len(calls))
+
+    def test_exception_shared(self):
+        flight = SingleFlight()
+        call, leader = flight.claim("key")
+        self.assertTrue(leader)
+        try:
+            raise ValueError("nope")
+        except ValueError:
+            flight.finish("key", exc_info=sys.exc_info())
+        self.assertRaises(ValueError, call.wait)
+
+
+    def test_released_on_any_exception(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def interrupted():
+            started.set()
+            release.wait()
+            raise KeyboardInterrupt()
+        errors = []
+
+        def leader():
+            try:
+                flight.do("key", interrupted)
+            except KeyboardInterrupt as e:
+                errors.append(e)
+        first = threading.Thread(target=leader)
+        first.start()
+        started.wait()
+        call, is_leader = flight.claim("key")
+        self.assertFalse(is_leader)
+        release.set()
+        # Whoever was waiting is woken, and the key isn't left claimed
+        self.assertRaises(KeyboardInterrupt, call.wait)
+        first.join()
+        self.assertEqual(1, len(errors))
+        self.assertEqual("result", flight.do("key", lambda: "result"))
+
+
+class RequestCoalescerTests(TestCase):
+    def test_key(self):
+        coalescer = RequestCoalescer()
+        self.assertEqual(coalescer.key("GetThings", "APP", "TOKEN", "R", "<info>\n  <group/>\n</info>"),
+                         coalescer.key("GetThings", "APP", "TOKEN", "R", "<info><group/></info>"))
+        # Never shared between users or records
+        self.assertNotEqual(coalescer.key("GetThings", "APP", "TOKEN", "R", "<info/>"),
+                            coalescer.key("GetThings", "APP", "OTHER", "R", "<info/>"))
+        self.assertNotEqual(coalescer.key("GetThings", "APP", "TOKEN", "R", "<info/>"),
+                            coalescer.key("GetThings", "APP", "TOKEN", "S", "<info/>"))
+
+    def test_do(self):
+        coalescer = RequestCoalescer()
+        started = threading.Event()
+        release = threading.Event()
+        send = mock.Mock()
+
+        def slow_send():
+            started.set()
+            release.wait()
+            return send()
+        send.return_value = "RESPONSE"
+        results = []
+        first = threading.Thread(target=lambda: results.append(coalescer.do("key", slow_send)))
+        first.start()
+        started.wait()
+        second = threading.Thread(target=lambda: results.append(coalescer.do("key", send)))
+        second.start()
+        while coalescer.stats['requests'] < 2:
+            pass
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(["RESPONSE", "RESPONSE"], results)
+        self.assertEqual(1, send.call_count)
+        self.assertEqual(dict(requests=2, coalesced=1), coalescer.stats)
+
+    def test_released_on_any_exception(self):
+        coalescer = RequestCoalescer()
+
+        def interrupted():
+            raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, coalescer.do, "key", interrupted)
+        # The next request isn't left waiting for it
+        self.assertEqual("RESPONSE", coalescer.do("key", lambda: "RESPONSE"))
+        self.assertEqual(dict(requests=2, coalesced=0), coalescer.stats)
+
+
+class PersonInfoCacheTests(TestCase):
+    def test_ttl(self):
+        cache = MemoryPersonInfoCache(ttl=10)
+        with mock.patch('healthvaultlib.cache.time') as mock_time:
+            mock_time.time.return_value = 1000.0
+            cache.put("TOKEN", {'selected_record_id': 'R'})
+            self.assertEqual({'selected_record_id': 'R'}, cache.get("TOKEN"))
+            self.assertIsNone(cache.get("OTHER"))
+            mock_time.time.return_value = 1010.0
+            self.assertIsNone(cache.get("TOKEN"))
+
+    def test_sqlite_shared(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dirname, "people.db")
+            SQLitePersonInfoCache(path).put("TOKEN", {'selected_record_id': 'R'})
+            # e.g. in another process
+            other = SQLitePersonInfoCache(path)
+            self.assertEqual({'selected_record_id': 'R'}, other.get("TOKEN"))
+            other.invalidate("TOKEN")
+            self.assertIsNone(SQLitePersonInfoCache(path).get("TOKEN"))
+            # Tokens aren't stored as they are
+            with open(path, 'rb') as f:
+                self.assertNotIn("TOKEN", f.read())
+        finally:
+            shutil.rmtree(dirname)
+
+
+class NegativeCacheTests(TestCase):
+    def setUp(self):
+        self.cache = NegativeCache(ttl=10, backoff=3, max_ttl=50)
+        self.time = 1000.0
+        patcher = mock.patch('healthvaultlib.cache.time')
+        self.addCleanup(patcher.stop)
+        mock_time = patcher.start()
+        mock_time.time.side_effect = lambda: self.time
+        mock_time.ctime.return_value = "later"
+
+    def test_record_backoff(self):
+        denied = HealthVaultAccessDeniedException("Access denied", code=HealthVaultStatus.ACCESS_DENIED)
+        self.cache.failed(denied, record_id="R", wctoken="TOKEN")
+        with self.assertRaises(HealthVaultAccessDeniedException) as cm:
+            self.cache.check(record_id="R")
+        self.assertEqual(HealthVaultStatus.ACCESS_DENIED, cm.exception.code)
+        # Only the record was marked
+        self.cache.check(record_id="OTHER", wctoken="TOKEN")
+        self.time += 10
+        self.cache.check(record_id="R")
+        # It failed again, so it's refused for longer: 30 seconds, then 50 at most
+        self.cache.failed(denied, record_id="R")
+        self.time += 29
+        self.assertRaises(HealthVaultAccessDeniedException, self.cache.check, record_id="R")
+        self.time += 1
+        self.cache.failed(denied, record_id="R")
+        self.time += 49
+        self.assertRaises(HealthVaultAccessDeniedException, self.cache.check, record_id="R")
+        self.time += 1
+        self.cache.check(record_id="R")
+        self.assertEqual(dict(refused=3, marked=3), self.cache.stats)
+
+    def test_wctoken_and_other_errors(self):
+        expired = HealthVaultException("Expired", code=HealthVaultStatus.CREDENTIAL_TOKEN_EXPIRED)
+        self.cache.failed(expired, record_id="R", wctoken="TOKEN")
+        self.assertRaises(HealthVaultException, self.cache.check, wctoken="TOKEN")
+        self.cache.check(record_id="R")
+        self.cache.failed(HealthVaultException("Oops", code=HealthVaultStatus.FAILED), record_id="R")
+        self.cache.failed(socket.error("reset"), record_id="R")
+        self.cache.check(record_id="R")
+
+    def test_reauthorized(self):
+        self.cache.failed(HealthVaultException("No", code=HealthVaultStatus.INVALID_RECORD), record_id="R")
+        self.cache.handle_target(ApplicationTarget.SIGN_OUT, record_id="R")
+        self.assertRaises(HealthVaultException, self.cache.check, record_id="R")
+        self.cache.handle_target(ApplicationTarget.APP_AUTH_SUCCESS, record_id="R")
+        self.cache.check(record_id="R")
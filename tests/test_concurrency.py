@@ -0,0 +1,44 @@
+"""Tests for running requests concurrently"""
+
+import threading
+import time
+from unittest import TestCase
+
+from healthvaultlib.concurrency import run_concurrently
+
+
+class RunConcurrentlyTests(TestCase):
+    def test_results_in_order(self):
+        def func(n):
+            time.sleep(0.01 * (5 - n))
+            return n * 2
+        results = run_concurrently(func, range(5), max_workers=3)
+        self.assertEqual([(0, None), (2, None), (4, None), (6, None), (8, None)], results)
+
+    def test_exceptions(self):
+        def func(n):
+            if n == 1:
+                raise ValueError("one")
+            return n
+        results = run_concurrently(func, [0, 1, 2])
+        self.assertEqual((0, None), results[0])
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1][1], ValueError)
+        self.assertEqual((2, None), results[2])
+
+    def test_max_workers(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0}
+
+        def func(n):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+        run_concurrently(func, range(10), max_workers=2)
+        self.assertEqual(2, state['most'])
+
+    def test_empty(self):
+        self.assertEqual([], run_concurrently(lambda n: n, []))
@@ -1,16 +1,35 @@
 """Tests for HealthVaultConn"""
 
+import base64
 import datetime
+import hashlib
+import httplib as real_httplib
 import re
 import socket
+import StringIO
+import threading
 from unittest import TestCase
 import xml.etree.ElementTree as ET
 
 import mock
-from healthvaultlib.exceptions import HealthVaultException
+from healthvaultlib.breaker import CircuitBreaker, OPEN
+from healthvaultlib import deadlines
+from healthvaultlib.cache import MemoryPersonInfoCache, NegativeCache, RequestCoalescer, ResponseCache
+from healthvaultlib.exceptions import (HealthVaultAccessDeniedException, HealthVaultCircuitOpenException,
+                                       HealthVaultDeadlineExceededException, HealthVaultException,
+                                       HealthVaultHTTPException, HealthVaultRateLimitedException)
 
+from healthvaultlib.datatypes import DataType
 from healthvaultlib.healthvault import HealthVaultConn
-from healthvaultlib.xmlutils import elt_to_string, elt_as_string
+from healthvaultlib.hedging import Hedger
+from healthvaultlib.limits import AdaptiveLimiter
+from healthvaultlib.paging import PageSizer
+from healthvaultlib.pool import ConnectionPool
+from healthvaultlib.ranges import RangeIndex
+from healthvaultlib.retry import RetryPolicy
+from healthvaultlib.status_codes import HealthVaultStatus
+from healthvaultlib.targets import ApplicationTarget
+from healthvaultlib.xmlutils import elt_to_string, elt_as_string, parse_subscription, ThingKey
 
 
 TEST_PUBLIC_KEY = long("b81c20fc71cc63324ccb3860c8a092c464f9e54cbe6f228fb79d0a9b2e303c3b233989b4a45fa1b8595b42791beed"
@@ -150,6 +169,7 @@ class ConnTests(TestCase):
                     wctoken="fakewctoken", server="6", shell_server="7"
                 )
             self.assertEqual("RECORD-ID", c.record_id)
+            self.assertEqual("PERSON-ID", c.person_id)
 
     def test_is_authorized(self):
         with mock.patch.object(HealthVaultConn, '_get_auth_token'):
@@ -243,6 +263,30 @@ class ConnTests(TestCase):
         self.assertEqual(WC_TOKEN, header.find('auth-session/user-auth-token').text)
         self.assertEqual("BOO", request.find('info').text)
 
+    def test_build_and_send_request_streamed(self):
+        # info can be given as an iterable of chunks; it's hashed and spooled,
+        # then passed to _send_request as one part of the payload
+        c = self.get_dummy_health_vault_conn()
+        c.auth_token = "AUTHKEY"
+        c.record_id = "8"
+        chunks = ["<info>", "<a>1</a>", u"<b>2</b>", "</info>"]
+        with mock.patch.object(c, '_send_request') as sendRequest:
+            def read_parts(parts, idempotent=True):
+                head, info, tail = parts
+                return head + info.read() + tail
+            sendRequest.side_effect = read_parts
+            payload = c._build_and_send_request(method_name="METHOD", info=iter(chunks))
+        request = ET.fromstring(payload)
+        self.assertEqual("METHOD", request.find('header/method').text)
+        self.assertEqual("1", request.find('info/a').text)
+        expected_hash = base64.encodestring(hashlib.sha1("".join(chunks)).digest()).strip()
+        self.assertEqual(expected_hash, request.find('header/info-hash/hash-data').text)
+        # Same hash we'd have got sending the info as one string
+        with mock.patch.object(c, '_send_request') as sendRequest:
+            c._build_and_send_request(method_name="METHOD", info="".join(chunks))
+        request = ET.fromstring(sendRequest.call_args[0][0])
+        self.assertEqual(expected_hash, request.find('header/info-hash/hash-data').text)
+
     def test_send_request(self):
         c = self.get_dummy_health_vault_conn()
         with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
@@ -256,6 +300,23 @@ class ConnTests(TestCase):
             response, returned_body, tree = c._send_request("PAYLOAD")
             self.assertEqual(mock_response, response)
             self.assertEqual(body, returned_body)
+        self.assertEqual(dict(requests=1, bytes_sent=len("PAYLOAD"), bytes_received=len(body)), c.stats)
+
+    def test_send_request_parts(self):
+        # A payload made of parts is sent piece by piece, files in chunks
+        c = self.get_dummy_health_vault_conn()
+        with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+            mock_conn = mock.Mock()
+            httplib.HTTPSConnection.return_value = mock_conn
+            mock_response = mock.Mock()
+            mock_response.status = 200
+            mock_conn.getresponse.return_value = mock_response
+            mock_response.read.return_value = "<response><status><code>0</code></status></response>"
+            with mock.patch('healthvaultlib.healthvault.STREAM_CHUNK_SIZE', 4):
+                c._send_request(["<head>", StringIO.StringIO("0123456789"), "</head>"])
+        mock_conn.putheader.assert_any_call('Content-Length', '23')
+        sent = [args[0] for (args, kwargs) in mock_conn.send.call_args_list]
+        self.assertEqual(["<head>", "0123", "4567", "89", "</head>"], sent)
 
     def test_send_request_not_200(self):
         c = self.get_dummy_health_vault_conn()
@@ -641,3 +702,969 @@ class ConnTests(TestCase):
             (None, response_body, ET.fromstring(response_body)),
             expected_return_value
         )
+
+    def test_get_blob(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''
+        <response>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">
+                <group><thing>
+                    <thing-id version-stamp="VS">THING</thing-id>
+                    <blob-payload><blob>
+                        <blob-info><name/><content-type>text/plain</content-type></blob-info>
+                        <content-length>10</content-length>
+                        <blob-ref-url>https://blobhost/streaming/wildcatblob.ashx?blob-ref-token=TOKEN</blob-ref-url>
+                    </blob></blob-payload>
+                </thing></group>
+            </x:info>
+        </response>
+        '''
+        out = StringIO.StringIO()
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+                mock_conn = httplib.HTTPSConnection.return_value
+                mock_conn.getresponse.return_value = mock.Mock(status=200, read=StringIO.StringIO("0123456789").read)
+                result = c.get_blob("THING", out)
+        self.assertEqual("0123456789", out.getvalue())
+        httplib.HTTPSConnection.assert_called_with('blobhost', 443)
+        mock_conn.request.assert_called_with('GET', '/streaming/wildcatblob.ashx?blob-ref-token=TOKEN')
+        self.assertEqual(10, result['bytes'])
+        self.assertEqual('text/plain', result['content_type'])
+        self.assertIn('bytes_per_second', result)
+        request = ET.fromstring(basr.call_args[0][1])
+        self.assertEqual("THING", request.find('group/id').text)
+        # No such blob
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            self.assertRaises(HealthVaultException, c.get_blob, "THING", out, name="other")
+
+    def test_put_blob(self):
+        c = self.get_dummy_health_vault_conn()
+        begin_body = '''
+        <response>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.BeginPutBlob">
+                <blob-ref-url>https://blobhost/streaming/wildcatblob.ashx?blob-ref-token=TOKEN</blob-ref-url>
+                <blob-chunk-size>4</blob-chunk-size>
+                <max-blob-size>100</max-blob-size>
+                <blob-hash-algorithm>SHA256Block</blob-hash-algorithm>
+                <blob-hash-parameters><block-size>4</block-size></blob-hash-parameters>
+            </x:info>
+        </response>
+        '''
+        put_body = '''
+        <response>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.PutThings">
+                <thing-id version-stamp="NEWVS">THING</thing-id>
+            </x:info>
+        </response>
+        '''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.side_effect = [(None, begin_body, ET.fromstring(begin_body)),
+                                (None, put_body, ET.fromstring(put_body))]
+            with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+                mock_conn = httplib.HTTPSConnection.return_value
+                mock_conn.getresponse.return_value.status = 200
+                result = c.put_blob("THING", "VS", StringIO.StringIO("0123456789"), name="a&b.txt",
+                                    content_type="text/plain")
+        self.assertEqual(3, mock_conn.send.call_count)
+        self.assertEqual("NEWVS", result['version_stamp'])
+        self.assertEqual(10, result['content_length'])
+        (method_name, info), kwargs = basr.call_args
+        self.assertEqual("PutThings", method_name)
+        thing = ET.fromstring(info).find('thing')
+        self.assertEqual("VS", thing.find('thing-id').get('version-stamp'))
+        self.assertEqual("a&b.txt", thing.find('blob-payload/blob/blob-info/name').text)
+        self.assertEqual(result['hash'], thing.find('blob-payload/blob/blob-info/hash-info/hash').text)
+        self.assertEqual("10", thing.find('blob-payload/blob/content-length').text)
+
+    def test_put_things(self):
+        c = self.get_dummy_health_vault_conn()
+        c.auth_token = "AUTHKEY"
+        c.record_id = "8"
+        put_body = '''
+        <response>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.PutThings">
+                <thing-id version-stamp="V0">T0</thing-id>
+                <thing-id version-stamp="V1">T1</thing-id>
+            </x:info>
+        </response>
+        '''
+        sent = []
+
+        def send_request(parts, idempotent=True):
+            head, info, tail = parts
+            sent.append((head, info.read(), idempotent))
+            return (None, put_body, ET.fromstring(put_body))
+        things = ('<thing><type-id>%s</type-id><data-xml><weight>%d</weight></data-xml></thing>'
+                  % (DataType.WEIGHT_MEASUREMENTS, kg) for kg in (60, 61))
+        with mock.patch.object(c, '_send_request', side_effect=send_request):
+            self.assertEqual([("T0", "V0"), ("T1", "V1")], c.put_things(things))
+        [(head, info, idempotent)] = sent
+        # The info was streamed from the generator, and hashed as it went
+        self.assertEqual(['60', '61'], [elt.text for elt in ET.fromstring(info).findall('thing/data-xml/weight')])
+        request = ET.fromstring(head + '</wc-request:request>')
+        self.assertEqual("PutThings", request.find('header/method').text)
+        self.assertEqual("2", request.find('header/method-version').text)
+        self.assertEqual(base64.encodestring(hashlib.sha1(info).digest()).strip(),
+                         request.find('header/info-hash/hash-data').text)
+        self.assertFalse(idempotent)
+
+    def test_remove_things(self):
+        c = self.get_dummy_health_vault_conn()
+        keys = [("T%d" % i, "V%d" % i) for i in range(5)]
+        infos = []
+
+        def basr(method_name, info):
+            self.assertEqual("RemoveThings", method_name)
+            infos.append(info)
+            ids = [elt.text for elt in ET.fromstring(info).findall('thing-id')]
+            if "T3" in ids:
+                raise HealthVaultException("Bad thing", code=13)
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request', side_effect=basr):
+            outcomes = c.remove_things(keys, chunk_size=2, max_workers=1)
+        self.assertEqual(set("T%d" % i for i in range(5)), set(outcomes))
+        self.assertEqual(13, outcomes["T3"].code)
+        self.assertEqual([None] * 4, [outcomes[t] for t in ("T0", "T1", "T2", "T4")])
+        # 3 chunks, and the one with T3 in it was split in two
+        self.assertEqual(5, len(infos))
+        first = ET.fromstring(infos[0]).findall('thing-id')
+        self.assertEqual([("T0", "V0"), ("T1", "V1")], [(e.text, e.get('version-stamp')) for e in first])
+
+    def test_remove_things_other_error(self):
+        # Errors that aren't about particular things are reported for every thing in the request
+        c = self.get_dummy_health_vault_conn()
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.side_effect = HealthVaultException("Denied", code=11)
+            outcomes = c.remove_things([("T1", "V1"), ("T2", "V2")])
+        self.assertEqual(1, basr.call_count)
+        self.assertEqual(11, outcomes["T1"].code)
+        self.assertEqual(11, outcomes["T2"].code)
+
+    def test_subscribe(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''
+        <response>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.SubscribeToEvent">
+                <subscription-id>SUB-ID</subscription-id>
+            </x:info>
+        </response>
+        '''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            subscription_id = c.subscribe("https://example.com/notify", ["TYPE1", "TYPE2"], "secret", "1")
+        self.assertEqual("SUB-ID", subscription_id)
+        (method_name, info), kwargs = basr.call_args
+        self.assertEqual("SubscribeToEvent", method_name)
+        self.assertEqual({'use_record_id': False, 'use_wctoken': False}, kwargs)
+        # What we send parses back the same way HealthVault would return it
+        subscription = parse_subscription(ET.fromstring(info).find('subscription'))
+        self.assertEqual({
+            'common': {
+                'id': None,
+                'notification_authentication_info': {
+                    'hv_eventing_shared_key': {'notification_key': 'secret', 'notification_key_version_id': '1'}},
+                'notification_channel': {'http_notification_channel': {'url': 'https://example.com/notify'}}},
+            'record_item_changed_event': {'filters': [{'type_ids': ['TYPE1', 'TYPE2']}]},
+        }, subscription)
+
+    def test_get_subscriptions(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''
+        <response>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetEventSubscriptions">
+                <subscriptions>
+                    <subscription>
+                        <common>
+                            <id>SUB-ID</id>
+                            <notification-authentication-info><hv-eventing-shared-key>
+                                <notification-key>secret</notification-key>
+                                <notification-key-version-id>1</notification-key-version-id>
+                            </hv-eventing-shared-key></notification-authentication-info>
+                            <notification-channel><http-notification-channel>
+                                <url>https://example.com/notify</url>
+                            </http-notification-channel></notification-channel>
+                        </common>
+                        <record-item-changed-event><filters><filter><type-ids>
+                            <type-id>TYPE1</type-id>
+                        </type-ids></filter></filters></record-item-changed-event>
+                    </subscription>
+                </subscriptions>
+            </x:info>
+        </response>
+        '''
+        self.validate_basr_method(
+            c.get_subscriptions, [], {},
+            ("GetEventSubscriptions", "<info/>"), {'use_record_id': False, 'use_wctoken': False},
+            (None, body, ET.fromstring(body)),
+            [{'common': {
+                'id': 'SUB-ID',
+                'notification_authentication_info': {
+                    'hv_eventing_shared_key': {'notification_key': 'secret', 'notification_key_version_id': '1'}},
+                'notification_channel': {'http_notification_channel': {'url': 'https://example.com/notify'}}},
+              'record_item_changed_event': {'filters': [{'type_ids': ['TYPE1']}]}}]
+        )
+
+    def test_update_subscription(self):
+        c = self.get_dummy_health_vault_conn()
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            c.update_subscription("SUB-ID", "https://example.com/notify", ["TYPE1"], "secret", "2")
+        (method_name, info), kwargs = basr.call_args
+        self.assertEqual("UpdateEventSubscription", method_name)
+        self.assertEqual("SUB-ID", ET.fromstring(info).find('subscription/common/id').text)
+
+    def test_unsubscribe(self):
+        c = self.get_dummy_health_vault_conn()
+        self.validate_basr_method(
+            c.unsubscribe, ["SUB-ID"], {},
+            ("UnsubscribeToEvent", "<info><subscription-id>SUB-ID</subscription-id></info>"),
+            {'use_record_id': False, 'use_wctoken': False},
+            None,
+            None
+        )
+
+    def test_get_things_by_ids_one_request(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''
+        <response>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">
+                <group>
+                    <thing>
+                        <thing-id version-stamp="V1">T1</thing-id>
+                        <type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>
+                        <data-xml><weight><when><date><y>2012</y><m>11</m><d>12</d></date></when>
+                            <value><kg>60</kg></value></weight></data-xml>
+                    </thing>
+                    <thing>
+                        <thing-id version-stamp="V2">T2</thing-id>
+                        <type-id>3b3e6b16-eb69-483c-8d7e-dfe116ae6092</type-id>
+                        <data-xml><basic><gender>f</gender></basic></data-xml>
+                    </thing>
+                </group>
+            </x:info>
+        </response>
+        '''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            things = c.get_things_by_ids(["T1", "T2", "T3"])
+        self.assertEqual(('GetThings', '<info><group><id>T1</id><id>T2</id><id>T3</id>'
+                                       '<format><section>core</section><xml/></format></group></info>'),
+                         basr.call_args[0])
+        self.assertEqual(['T1', 'T2'], sorted(things))
+        self.assertEqual(60.0, things['T1']['kg'])
+        self.assertEqual('f', things['T2']['gender'])
+
+    def test_get_things_by_ids_chunking(self):
+        # Many IDs are split into several groups per request, and several requests
+        c = self.get_dummy_health_vault_conn()
+        infos = []
+
+        def basr(method_name, info):
+            infos.append(info)
+            groups = ''
+            for group in ET.fromstring(info).findall('group'):
+                groups += '<group>' + ''.join(
+                    '<thing><thing-id version-stamp="V">%s</thing-id>'
+                    '<type-id>3b3e6b16-eb69-483c-8d7e-dfe116ae6092</type-id>'
+                    '<data-xml><basic><gender>f</gender></basic></data-xml></thing>' % elt.text
+                    for elt in group.findall('id')) + '</group>'
+            body = '<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">' + groups + \
+                   '</x:info></response>'
+            return (None, body, ET.fromstring(body))
+        ids = ["T%d" % i for i in range(7)]
+        with mock.patch.multiple('healthvaultlib.healthvault', MAX_THINGS_PER_GROUP=2, MAX_GROUPS_PER_REQUEST=2):
+            with mock.patch.object(HealthVaultConn, '_build_and_send_request', side_effect=basr):
+                things = c.get_things_by_ids(ids, max_workers=1)
+        self.assertEqual(sorted(ids), sorted(things))
+        self.assertEqual(2, len(infos))
+        self.assertEqual([2, 2], [len(g.findall('id')) for g in ET.fromstring(infos[0]).findall('group')])
+        self.assertEqual([2, 1], [len(g.findall('id')) for g in ET.fromstring(infos[1]).findall('group')])
+
+    def test_get_things_by_keys_unprocessed(self):
+        # Things HealthVault doesn't return in full are asked for again
+        c = self.get_dummy_health_vault_conn()
+        first = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group>
+            <thing><thing-id version-stamp="V1">T1</thing-id><type-id>3b3e6b16-eb69-483c-8d7e-dfe116ae6092</type-id>
+                <data-xml><basic><gender>f</gender></basic></data-xml></thing>
+            <unprocessed-thing-key-info><thing-id version-stamp="V2">T2</thing-id></unprocessed-thing-key-info>
+            </group></x:info></response>'''
+        second = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group>
+            <thing><thing-id version-stamp="V2">T2</thing-id><type-id>3b3e6b16-eb69-483c-8d7e-dfe116ae6092</type-id>
+                <data-xml><basic><gender>m</gender></basic></data-xml></thing>
+            </group></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.side_effect = [(None, first, ET.fromstring(first)), (None, second, ET.fromstring(second))]
+            things = c.get_things_by_keys([("T1", "V1"), ("T2", "V2")])
+        self.assertEqual('f', things['T1']['gender'])
+        self.assertEqual('m', things['T2']['gender'])
+        keys = ET.fromstring(basr.call_args_list[0][0][1]).findall('group/key')
+        self.assertEqual([("T1", "V1"), ("T2", "V2")], [(k.text, k.get('version-stamp')) for k in keys])
+        keys = ET.fromstring(basr.call_args_list[1][0][1]).findall('group/key')
+        self.assertEqual([("T2", "V2")], [(k.text, k.get('version-stamp')) for k in keys])
+
+    def test_batch_get_include_info(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group>
+            <thing><thing-id version-stamp="V1">T1</thing-id><type-id>3b3e6b16-eb69-483c-8d7e-dfe116ae6092</type-id>
+                <eff-date>2012-11-08T13:02:38.649</eff-date>
+                <updated><timestamp>2012-11-08T18:02:38.5-05:00</timestamp></updated>
+                <data-xml><basic><gender>f</gender></basic></data-xml></thing>
+            </group></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            result = c.batch_get([{'datatype': DataType.BASIC_DEMOGRAPHIC_DATA, 'sections': ['core', 'audits'],
+                                   'updated_min': datetime.datetime(2012, 11, 1, 9, 30, 15)}],
+                                 include_info=True)
+        group = ET.fromstring(basr.call_args[0][1]).find('group')
+        self.assertEqual('2012-11-01T09:30:15', group.find('filter/updated-date-min').text)
+        self.assertEqual(['core', 'audits'], [e.text for e in group.findall('format/section')])
+        [[(info, data)]] = result
+        self.assertEqual({'thing_id': 'T1', 'version_stamp': 'V1', 'type_id': DataType.BASIC_DEMOGRAPHIC_DATA,
+                          'eff_date': datetime.datetime(2012, 11, 8, 13, 2, 38, 649000),
+                          'updated': datetime.datetime(2012, 11, 8, 23, 2, 38, 500000)}, info)
+        self.assertEqual('f', data['gender'])
+
+    def test_build_thing_group_without_xml(self):
+        c = self.get_dummy_health_vault_conn()
+        group = ET.fromstring(c._build_thing_group(DataType.WEIGHT_MEASUREMENTS, include_xml=False))
+        self.assertEqual(['section'], [elt.tag for elt in group.find('format')])
+
+    def test_batch_get_keys_only(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group>
+            <thing><thing-id version-stamp="V1">T1</thing-id><type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>
+                <eff-date>2012-11-08T13:02:38</eff-date>
+                <updated><timestamp>2012-11-09T10:00:00Z</timestamp></updated></thing>
+            </group></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            [keys] = c.batch_get({'datatype': DataType.WEIGHT_MEASUREMENTS, 'keys_only': True})
+        group = ET.fromstring(basr.call_args[0][1]).find('group')
+        self.assertEqual(['core', 'audits'], [e.text for e in group.findall('format/section')])
+        self.assertIsNone(group.find('format/xml'))
+        self.assertEqual([ThingKey('T1', 'V1', DataType.WEIGHT_MEASUREMENTS, datetime.datetime(2012, 11, 8, 13, 2, 38),
+                                   datetime.datetime(2012, 11, 9, 10))], keys)
+        self.assertEqual('T1', keys[0].thing_id)
+
+    def test_iter_thing_keys(self):
+        c = self.get_dummy_health_vault_conn()
+
+        def key(thing_id, day):
+            return ThingKey(thing_id, 'V', DataType.WEIGHT_MEASUREMENTS, datetime.datetime(2012, 1, day), None)
+        pages = [
+            [key('A', 9), key('B', 8), key('C', 7)],
+            # C comes back again, having the same effective date we asked for things up to
+            [key('C', 7), key('D', 7), key('E', 7)],
+            # More things on day 7 than fit in a page, so we ask for a bigger page
+            [key('C', 7), key('D', 7), key('E', 7)],
+            [key('C', 7), key('D', 7), key('E', 7), key('F', 7), key('G', 5), key('H', 4)],
+            [key('H', 4)],
+        ]
+        with mock.patch.object(HealthVaultConn, 'batch_get') as batch_get:
+            batch_get.side_effect = [[page] for page in pages]
+            keys = list(c.iter_thing_keys(DataType.WEIGHT_MEASUREMENTS, page_size=3))
+        self.assertEqual(list('ABCDEFGH'), [k.thing_id for k in keys])
+        requests = [call[0][0] for call in batch_get.call_args_list]
+        self.assertEqual([None, datetime.datetime(2012, 1, 7), datetime.datetime(2012, 1, 7),
+                          datetime.datetime(2012, 1, 7), datetime.datetime(2012, 1, 4)],
+                         [r['max_date'] for r in requests])
+        self.assertEqual([3, 3, 3, 6, 6], [r['max'] for r in requests])
+        self.assertTrue(all(r['keys_only'] for r in requests))
+
+    def test_iter_thing_keys_fractional_seconds(self):
+        c = self.get_dummy_health_vault_conn()
+
+        def key(thing_id, microsecond):
+            return ThingKey(thing_id, 'V', DataType.WEIGHT_MEASUREMENTS,
+                            datetime.datetime(2012, 1, 7, 10, 0, 0, microsecond), None)
+        pages = [
+            [key('A', 900000), key('B', 500000)],
+            # Asked for things up to 10:00:01, so A and B come again
+            [key('A', 900000), key('B', 500000)],
+            # and with a bigger page, C, which is older than B but in the same second
+            [key('A', 900000), key('B', 500000), key('C', 200000)],
+        ]
+        with mock.patch.object(HealthVaultConn, 'batch_get') as batch_get:
+            batch_get.side_effect = [[page] for page in pages]
+            keys = list(c.iter_thing_keys(DataType.WEIGHT_MEASUREMENTS, page_size=2))
+        self.assertEqual(list('ABC'), [k.thing_id for k in keys])
+        requests = [call[0][0] for call in batch_get.call_args_list]
+        self.assertEqual([None, datetime.datetime(2012, 1, 7, 10, 0, 1), datetime.datetime(2012, 1, 7, 10, 0, 1)],
+                         [r['max_date'] for r in requests])
+        self.assertEqual([2, 2, 4], [r['max'] for r in requests])
+
+    def test_iter_thing_keys_unprocessed(self):
+        # HealthVault only returns 30 things in full per group; the keys of the rest
+        # come as unprocessed-thing-key-info, and are listed too
+        c = self.get_dummy_health_vault_conn()
+
+        def key(tag, minute):
+            return ('<%s><thing-id version-stamp="V">T%02d</thing-id>'
+                    '<type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>'
+                    '<eff-date>2012-01-01T00:%02d:00</eff-date></%s>' % (tag, minute, minute, tag))
+
+        def response(group):
+            body = ('<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">'
+                    '<group>%s</group></x:info></response>' % group)
+            return (None, body, ET.fromstring(body))
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.side_effect = [
+                response(''.join(key('thing', minute) for minute in range(59, 29, -1)) +
+                         ''.join(key('unprocessed-thing-key-info', minute) for minute in range(29, 19, -1))),
+                response(''.join(key('thing', minute) for minute in range(20, 14, -1))),
+            ]
+            keys = list(c.iter_thing_keys(DataType.WEIGHT_MEASUREMENTS, page_size=40))
+        self.assertEqual(['T%02d' % minute for minute in range(59, 14, -1)], [k.thing_id for k in keys])
+        self.assertEqual(datetime.datetime(2012, 1, 1, 0, 29), keys[30].eff_date)
+        self.assertEqual(2, basr.call_count)
+
+    def test_iter_things_page_sizer(self):
+        c = self.get_dummy_health_vault_conn()
+
+        def thing(thing_id, day):
+            return ({'thing_id': thing_id, 'eff_date': datetime.datetime(2012, 1, day)}, thing_id.lower())
+        pages = [
+            [thing('A', 9), thing('B', 8)],
+            # B comes back again, having the same effective date we asked for things up to
+            [thing('B', 8), thing('C', 7)],
+            [thing('C', 7), thing('D', 6)],
+            [thing('D', 6)],
+        ]
+
+        def batch_get_one(requests, include_info, observe):
+            observe(len(pages[0]), 1000 * len(pages[0]), 0.1)
+            return [pages.pop(0)]
+        sizer = PageSizer(target_size=2000, initial=2, min_size=1, weight=1)
+        with mock.patch.object(HealthVaultConn, '_batch_get_one') as bgo:
+            bgo.side_effect = batch_get_one
+            things = list(c.iter_things(DataType.WEIGHT_MEASUREMENTS, page_sizer=sizer))
+        self.assertEqual(list('abcd'), [data for (info, data) in things])
+        requests = [call[0][0][0] for call in bgo.call_args_list]
+        # Each thing turned out to be 1000 bytes, so pages of 2 make 2000 byte responses
+        self.assertEqual([2, 2, 2, 2], [r['max'] for r in requests])
+        self.assertEqual([None, datetime.datetime(2012, 1, 8), datetime.datetime(2012, 1, 7),
+                          datetime.datetime(2012, 1, 6)],
+                         [r['max_date'] for r in requests])
+        self.assertTrue(all(call[0][1] for call in bgo.call_args_list))
+        learned = sizer.learned[DataType.WEIGHT_MEASUREMENTS]
+        self.assertEqual(1000, learned['bytes_per_thing'])
+        self.assertAlmostEqual(0.0001, learned['seconds_per_byte'])
+        self.assertEqual(4, learned['pages'])
+
+    def test_iter_things_truncated_page(self):
+        c = self.get_dummy_health_vault_conn()
+
+        def weight(thing_id, day):
+            return ('''<thing><thing-id version-stamp="V">%s</thing-id>
+                <type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id><eff-date>2012-01-%02dT00:00:00</eff-date>
+                <data-xml><weight><when><date><y>2012</y><m>1</m><d>%d</d></date></when>
+                <value><kg>%d</kg><display units="kg">60</display></value></weight></data-xml></thing>'''
+                    % (thing_id, day, day, day))
+
+        def unprocessed(thing_id, day):
+            return ('<unprocessed-thing-key-info><thing-id version-stamp="V">%s</thing-id>'
+                    '<type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>'
+                    '<eff-date>2012-01-%02dT00:00:00</eff-date></unprocessed-thing-key-info>' % (thing_id, day))
+
+        def response(group):
+            body = ('<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">'
+                    '<group>%s</group></x:info></response>' % group)
+            return (None, body, ET.fromstring(body))
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.side_effect = [
+                # A full page, with only one thing returned in full
+                response(weight('C', 9) + unprocessed('B', 8)),
+                response(weight('B', 8)),
+                response(weight('B', 8) + weight('A', 7)),
+                response(weight('A', 7)),
+            ]
+            things = list(c.iter_things(DataType.WEIGHT_MEASUREMENTS, page_size=2))
+        self.assertEqual([9, 8, 7], [data['kg'] for (info, data) in things])
+        groups = [ET.fromstring(call[0][1]).find('group') for call in basr.call_args_list]
+        self.assertEqual(['2', None, '2', '2'], [group.get('max') for group in groups])
+        self.assertEqual(['B'], [elt.text for elt in groups[1].findall('id')])
+
+    def test_iter_things_page_size_limit(self):
+        c = self.get_dummy_health_vault_conn()
+        with mock.patch.object(HealthVaultConn, '_batch_get_one') as bgo:
+            bgo.return_value = [[]]
+            list(c.iter_things(DataType.WEIGHT_MEASUREMENTS, page_size=1000))
+            list(c.iter_things(DataType.WEIGHT_MEASUREMENTS, page_sizer=PageSizer(max_size=1000, initial=1000)))
+        self.assertEqual([30, 30], [call[0][0][0]['max'] for call in bgo.call_args_list])
+
+    def test_build_thing_group_sections_and_transforms(self):
+        c = self.get_dummy_health_vault_conn()
+        group = ET.fromstring(c._build_thing_group(DataType.WEIGHT_MEASUREMENTS, sections=['core', 'blobpayload'],
+                                                   include_xml=False, transforms=['mtt']))
+        self.assertEqual([('section', 'core'), ('section', 'blobpayload'), ('xml', 'mtt')],
+                         [(elt.tag, elt.text) for elt in group.find('format')])
+        self.assertRaises(ValueError, c._build_thing_group, DataType.WEIGHT_MEASUREMENTS, sections=['everything'])
+
+    def test_batch_get_sections_and_transforms(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group>
+            <thing><thing-id version-stamp="V1">T1</thing-id><type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>
+                <eff-date>2012-11-08T13:02:38</eff-date>
+                <data-xml transform="mtt"><row wc-id="T1" wc-value="60 kg"/></data-xml>
+                <data-xml><weight><when><date><y>2012</y><m>11</m><d>8</d></date></when>
+                    <value><kg>60</kg><display units="kg">60</display></value></weight></data-xml>
+                <eff-permissions immutable="false"><permission>Read</permission><permission>Update</permission></eff-permissions>
+                <tags>morning,scale</tags>
+            </thing></group></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            [[(info, data)]] = c.batch_get({'datatype': DataType.WEIGHT_MEASUREMENTS, 'transforms': ['mtt'],
+                                            'sections': ['core', 'effectivepermissions', 'tags']},
+                                           include_info=True)
+        # The transformed data doesn't confuse the parser
+        self.assertEqual(60.0, data['kg'])
+        self.assertEqual(['Read', 'Update'], info['effective_permissions'])
+        self.assertEqual('morning,scale', info['tags'])
+        self.assertEqual('60 kg', info['transformed']['mtt'].find('row').get('wc-value'))
+
+    def test_batch_get_fetches_unprocessed(self):
+        c = self.get_dummy_health_vault_conn()
+        c.range_index = RangeIndex()
+
+        def weight(thing_id, month):
+            return ('''<thing><thing-id version-stamp="V">%s</thing-id>
+                <type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id><eff-date>2012-%02d-01T00:00:00</eff-date>
+                <data-xml><weight><when><date><y>2012</y><m>%d</m><d>1</d></date></when>
+                <value><kg>60</kg><display units="kg">60</display></value></weight></data-xml></thing>'''
+                    % (thing_id, month, month))
+
+        def response(*groups):
+            body = ('<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">%s</x:info>'
+                    '</response>' % ''.join('<group>%s</group>' % group for group in groups))
+            return (None, body, ET.fromstring(body))
+        # HealthVault returns some in full, and just the keys of the rest
+        truncated = (weight('DEC', 12) + '<unprocessed-thing-key-info><thing-id version-stamp="V">JAN</thing-id>'
+                     '<type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>'
+                     '<eff-date>2012-01-01T00:00:00</eff-date></unprocessed-thing-key-info>')
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.side_effect = [response(truncated), response(weight('JAN', 1))]
+            year = c.batch_get({'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': datetime.datetime(2012, 1, 1),
+                                'max_date': datetime.datetime(2012, 12, 31)}, include_info=True)[0]
+            self.assertEqual(['DEC', 'JAN'], [info['thing_id'] for (info, data) in year])
+            self.assertEqual(['JAN'], [elt.text for elt in ET.fromstring(basr.call_args[0][1]).findall('group/id')])
+            # So the index can answer for January itself
+            january = c.get_weight_measurements(min_date=datetime.datetime(2012, 1, 1),
+                                                 max_date=datetime.datetime(2012, 1, 31))
+            self.assertEqual(1, len(january))
+            self.assertEqual(2, basr.call_count)
+
+    def test_get_things_sections_and_transforms(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group/></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            c.get_things(DataType.WEIGHT_MEASUREMENTS, sections=['core', 'tags'], include_xml=False,
+                         transforms=['mtt'], updated_min=datetime.datetime(2012, 1, 2))
+            group = ET.fromstring(basr.call_args[0][1]).find('group')
+            self.assertEqual([('section', 'core'), ('section', 'tags'), ('xml', 'mtt')],
+                             [(elt.tag, elt.text) for elt in group.find('format')])
+            self.assertEqual('2012-01-02T00:00:00', group.find('filter/updated-date-min').text)
+            c.get_things(DataType.WEIGHT_MEASUREMENTS, keys_only=True)
+            group = ET.fromstring(basr.call_args[0][1]).find('group')
+            self.assertIsNone(group.find('format/xml'))
+
+    def test_batch_get_singleton_without_xml(self):
+        c = self.get_dummy_health_vault_conn()
+        body = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group>
+            <thing><thing-id version-stamp="V1">T1</thing-id><type-id>3b3e6b16-eb69-483c-8d7e-dfe116ae6092</type-id>
+                <eff-date>2012-11-08T13:02:38</eff-date>
+            </thing></group></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            request = {'datatype': DataType.BASIC_DEMOGRAPHIC_DATA, 'include_xml': False}
+            self.assertEqual([None], c.batch_get(request))
+            c.thing_store = mock.Mock()
+            self.assertEqual([None], c.batch_get(dict(request, include_xml=True)))
+
+    def test_batch_get_response_cache(self):
+        c = self.get_dummy_health_vault_conn()
+        c.response_cache = mock.Mock()
+        c.response_cache.batch_get.return_value = ["CACHED"]
+        self.assertEqual("CACHED", c.get_weight_measurements())
+        c.response_cache.batch_get.assert_called_with(c, [{'datatype': DataType.WEIGHT_MEASUREMENTS,
+                                                           'min_date': None, 'max_date': None, 'max': None}], False)
+
+    def test_batch_get_thing_store(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "8"
+        c.thing_store = mock.Mock()
+        body = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">
+            <group><thing><thing-id version-stamp="V1">T1</thing-id><type-id>3b3e6b16-eb69-483c-8d7e-dfe116ae6092</type-id>
+                <eff-date>2012-11-08T13:02:38</eff-date>
+                <data-xml><basic><gender>f</gender></basic></data-xml></thing></group>
+            <group/></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request') as basr:
+            basr.return_value = (None, body, ET.fromstring(body))
+            demographics, keys = c.batch_get([{'datatype': DataType.BASIC_DEMOGRAPHIC_DATA},
+                                              {'datatype': DataType.WEIGHT_MEASUREMENTS, 'keys_only': True}])
+        self.assertEqual('f', demographics['gender'])
+        self.assertEqual([], keys)
+        # Only the things with data were stored
+        [[(record_id, things), kwargs]] = c.thing_store.put_things.call_args_list
+        self.assertEqual("8", record_id)
+        self.assertEqual([('T1', 'f')], [(info['thing_id'], data['gender']) for (info, data) in things])
+
+    def test_connect_person_info_cache(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = None
+        c.auth_token = "AUTH"
+        c.person_info_cache = MemoryPersonInfoCache()
+        body = '''<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetPersonInfo">
+            <person-info><person-id>P</person-id><name>Jane</name><selected-record-id>R</selected-record-id>
+                <record id="R" display-name="Jane" rel-name="Self" state="Active"
+                        auth-expires="9999-12-31T23:59:59.999Z">Jane Doe</record>
+            </person-info></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_send_request') as sr:
+            sr.return_value = (None, body, ET.fromstring(body))
+            c.connect("TOKEN")
+            self.assertEqual(1, sr.call_count)
+            self.assertEqual(("R", "P"), (c.record_id, c.person_id))
+            [record] = c.get_person_info()['records']
+            self.assertEqual({'id': 'R', 'name': 'Jane Doe', 'display_name': 'Jane', 'rel_name': 'Self',
+                              'state': 'Active', 'auth_expires': datetime.datetime(9999, 12, 31, 23, 59, 59, 999000)},
+                             record)
+            # Another conn for the same wctoken doesn't need to ask
+            c.record_id = None
+            c.connect("TOKEN")
+            self.assertEqual(1, sr.call_count)
+            self.assertEqual(("R", "P"), (c.record_id, c.person_id))
+
+            # The user revoked our access, so the entry is dropped
+            sr.side_effect = HealthVaultException("Access denied", code=11)
+            self.assertRaises(HealthVaultException, c.get_alternate_ids)
+        self.assertIsNone(c.person_info_cache.get("TOKEN"))
+
+    def test_negative_cache(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.negative_cache = NegativeCache()
+        with mock.patch.object(HealthVaultConn, '_send_request') as sr:
+            sr.side_effect = HealthVaultAccessDeniedException("Access denied", code=11)
+            self.assertRaises(HealthVaultAccessDeniedException, c.get_alternate_ids)
+            self.assertRaises(HealthVaultAccessDeniedException, c.get_alternate_ids)
+            # The second time we didn't ask HealthVault
+            self.assertEqual(1, sr.call_count)
+            # until the user authorizes us again
+            c.negative_cache.handle_target(ApplicationTarget.APP_AUTH_SUCCESS, record_id="R")
+            body = '<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetAlternateIds"/></response>'
+            sr.side_effect = None
+            sr.return_value = (None, body, ET.fromstring(body))
+            self.assertEqual([], c.get_alternate_ids())
+
+    def test_retry_policy(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.retry_policy = RetryPolicy(base_delay=0)
+        body = '<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetAlternateIds"/></response>'
+        with mock.patch.object(HealthVaultConn, '_send_request') as sr:
+            sr.side_effect = [HealthVaultHTTPException("Bad gateway", code=502), (None, body, ET.fromstring(body))]
+            self.assertEqual([], c.get_alternate_ids())
+            self.assertEqual(2, sr.call_count)
+            # Not for a method that might add things twice
+            sr.side_effect = HealthVaultHTTPException("Bad gateway", code=502)
+            sr.reset_mock()
+            self.assertRaises(HealthVaultHTTPException, c._build_and_send_request, "PutThings", "<info/>")
+            self.assertEqual(1, sr.call_count)
+
+    def test_retry_policy_refreshes_auth_token(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.retry_policy = RetryPolicy()
+        body = '<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetAlternateIds"/></response>'
+        expired = HealthVaultException("Session expired", code=HealthVaultStatus.AUTHENTICATED_SESSION_TOKEN_EXPIRED)
+        with mock.patch.object(HealthVaultConn, '_send_request') as sr:
+            with mock.patch.object(HealthVaultConn, '_get_auth_token', return_value="NEWAUTH"):
+                sr.side_effect = [expired, (None, body, ET.fromstring(body))]
+                self.assertEqual([], c.get_alternate_ids())
+        self.assertEqual("NEWAUTH", c.auth_token)
+        self.assertIn("<auth-token>NEWAUTH</auth-token>", sr.call_args[0][0])
+
+    def test_circuit_breaker(self):
+        c = self.get_dummy_health_vault_conn()
+        c.circuit_breaker = CircuitBreaker(min_requests=1)
+        with mock.patch.object(HealthVaultConn, '_post') as post:
+            post.side_effect = socket.error(104, "Connection reset by peer")
+            self.assertRaises(socket.error, c._send_request, "PAYLOAD")
+            self.assertRaises(HealthVaultCircuitOpenException, c._send_request, "PAYLOAD")
+            self.assertEqual(1, post.call_count)
+
+    def test_timeouts(self):
+        c = self.get_dummy_health_vault_conn()
+        c.connect_timeout = 5
+        c.read_timeout = 30
+        with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+            conn = c._connect("HOST", 443)
+            httplib.HTTPSConnection.assert_called_with("HOST", 443, timeout=5)
+            conn.connect.assert_called_with()
+            conn.sock.settimeout.assert_called_with(30)
+            # Cut short by the deadline
+            with mock.patch('healthvaultlib.deadlines.time') as mock_time:
+                mock_time.time.return_value = 1000
+                with deadlines.deadline(1010):
+                    conn = c._connect("HOST", 443)
+            httplib.HTTPSConnection.assert_called_with("HOST", 443, timeout=5)
+            conn.sock.settimeout.assert_called_with(10)
+
+    def test_deadline(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.retry_policy = RetryPolicy(base_delay=5)
+        with mock.patch.object(HealthVaultConn, '_post') as post:
+            post.side_effect = socket.timeout("timed out")
+            # Not enough time left to wait and try again
+            with mock.patch('healthvaultlib.retry.time') as mock_time:
+                mock_time.time.return_value = 1000
+                with mock.patch('healthvaultlib.retry.random.uniform', return_value=5):
+                    with mock.patch('healthvaultlib.deadlines.time.time', return_value=1000):
+                        self.assertRaises(socket.timeout, c.get_weight_measurements, deadline=1004)
+            self.assertEqual(1, post.call_count)
+            self.assertFalse(mock_time.sleep.called)
+        # Passed already, so nothing is sent
+        with mock.patch.object(HealthVaultConn, '_connect') as connect:
+            self.assertRaises(HealthVaultDeadlineExceededException, c.get_weight_measurements, deadline=1)
+        self.assertFalse(connect.called)
+
+    def test_limiter(self):
+        c = self.get_dummy_health_vault_conn()
+        c.limiter = AdaptiveLimiter(initial_limit=4)
+        with mock.patch.object(HealthVaultConn, '_post') as post:
+            post.side_effect = HealthVaultHTTPException("Too many requests", code=429)
+            self.assertRaises(HealthVaultHTTPException, c._send_request, "PAYLOAD")
+        self.assertEqual(2, c.limiter.limit)
+        self.assertEqual(0, c.limiter.in_flight)
+
+    def test_rate_limiter(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.rate_limiter = mock.Mock()
+        with mock.patch.object(HealthVaultConn, '_send_request') as sr:
+            c._build_and_send_request("GetPersonInfo", "<info/>", use_record_id=False)
+            c.rate_limiter.acquire.assert_called_with(c.app_id, None)
+            c._build_and_send_request("GetThings", "<info/>")
+            c.rate_limiter.acquire.assert_called_with(c.app_id, "R")
+            # Not sent if the limiter says no
+            c.rate_limiter.acquire.side_effect = HealthVaultRateLimitedException("Slow down", retry_after=1)
+            self.assertRaises(HealthVaultRateLimitedException, c._build_and_send_request, "GetThings", "<info/>")
+        self.assertEqual(2, sr.call_count)
+
+    def test_coalescer(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.coalescer = mock.Mock(methods=frozenset(['GetThings']))
+        c.coalescer.do.return_value = "RESULT"
+        with mock.patch.object(HealthVaultConn, '_send_request') as sr:
+            self.assertEqual("RESULT", c._build_and_send_request("GetThings", "<info/>"))
+            self.assertFalse(sr.called)
+            c.coalescer.key.assert_called_with("GetThings", c.app_id, c.wctoken, "R", "<info/>")
+            # Sent by do()
+            send = c.coalescer.do.call_args[0][1]
+            sr.return_value = "SENT"
+            self.assertEqual("SENT", send())
+            # Only the methods it's for
+            c.coalescer.do.reset_mock()
+            self.assertEqual("SENT", c._build_and_send_request("PutThings", "<info/>"))
+            self.assertFalse(c.coalescer.do.called)
+
+    def test_coalesced_failure_backs_off_once(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.coalescer = RequestCoalescer(methods=('GetAlternateIds',))
+        c.negative_cache = NegativeCache()
+        started = threading.Event()
+        release = threading.Event()
+
+        def refused(payload, idempotent=True):
+            started.set()
+            release.wait()
+            raise HealthVaultAccessDeniedException("Access denied", code=11)
+        errors = []
+
+        def get():
+            try:
+                c.get_alternate_ids()
+            except HealthVaultAccessDeniedException as e:
+                errors.append(e)
+        with mock.patch.object(HealthVaultConn, '_send_request', side_effect=refused) as sr:
+            first = threading.Thread(target=get)
+            first.start()
+            started.wait()
+            second = threading.Thread(target=get)
+            second.start()
+            while c.coalescer.stats['requests'] < 2:
+                pass
+            release.set()
+            first.join()
+            second.join()
+        self.assertEqual(2, len(errors))
+        self.assertEqual(1, sr.call_count)
+        # Only the request that was sent marked the record
+        self.assertEqual(1, c.negative_cache.stats['marked'])
+
+    def test_hedger(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.hedger = Hedger(min_samples=1, max_rate=1, burst=1, min_delay=0.01)
+        c.hedger.record(0.01)
+        body = "<response><status><code>0</code></status></response>"
+        shut_down = threading.Event()
+
+        def hang():
+            shut_down.wait(5)
+            raise socket.error(107, "Transport endpoint is not connected")
+        slow, fast = mock.Mock(name='slow'), mock.Mock(name='fast')
+        slow.getresponse.side_effect = hang
+        slow.sock.shutdown.side_effect = lambda how: shut_down.set()
+        fast.getresponse.return_value = mock.Mock(status=200, will_close=False)
+        fast.getresponse.return_value.read.return_value = body
+        with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+            httplib.HTTPException = Exception
+            httplib.HTTPSConnection.side_effect = [slow, fast]
+            (response, got, tree) = c._build_and_send_request("GetThings", "<info/>")
+            self.assertEqual(body, got)
+            # The slow one was cancelled
+            self.assertTrue(shut_down.is_set())
+            self.assertEqual(dict(requests=1, hedged=1, won=1, refused=0), c.hedger.stats)
+            # Only reads are hedged
+            httplib.HTTPSConnection.side_effect = None
+            httplib.HTTPSConnection.return_value = fast
+            c.hedger.record(0)
+            c._build_and_send_request("PutThings", "<info/>")
+            self.assertEqual(1, c.hedger.stats['requests'])
+
+    def test_response_cache_while_circuit_open(self):
+        c = self.get_dummy_health_vault_conn()
+        c.record_id = "R"
+        c.auth_token = "AUTH"
+        c.response_cache = ResponseCache(ttl=0, stale_ttl=0, stale_if_error=3600)
+        c.circuit_breaker = CircuitBreaker(min_requests=1, open_time=60)
+        body = '''<response><status><code>0</code></status>
+            <x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings"><group>
+            <thing><thing-id version-stamp="V1">T1</thing-id><type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>
+                <eff-date>2012-11-08T13:02:38</eff-date>
+                <data-xml><weight><when><date><y>2012</y><m>11</m><d>8</d></date></when>
+                    <value><kg>60</kg><display units="kg">60</display></value></weight></data-xml>
+            </thing></group></x:info></response>'''
+        with mock.patch.object(HealthVaultConn, '_post') as post:
+            post.return_value = (None, body, ET.fromstring(body))
+            weights = c.get_weight_measurements()
+            post.side_effect = socket.error(104, "Connection reset by peer")
+            self.assertEqual(weights, c.get_weight_measurements())
+            self.assertEqual(OPEN, c.circuit_breaker.state("6"))
+            # The circuit's open, so HealthVault isn't asked, but we still get what was cached
+            self.assertEqual(weights, c.get_weight_measurements())
+            self.assertEqual(2, post.call_count)
+            self.assertEqual(2, c.response_cache.stats['errors'])
+
+    def test_batch_get_split(self):
+        # More groups than fit in one request are sent in several, and put back in order
+        c = self.get_dummy_health_vault_conn()
+
+        def basr(method_name, info):
+            groups = ET.fromstring(info).findall('group')
+            body = ('<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">' +
+                    ''.join('<group><thing><thing-id version-stamp="V">%s</thing-id>'
+                            '<type-id>%s</type-id><eff-date>2012-11-08T13:02:38</eff-date></thing></group>' %
+                            (group.find('filter/type-id').text + group.get('max'), DataType.DEVICES)
+                            for group in groups) +
+                    '</x:info></response>')
+            return (None, body, ET.fromstring(body))
+        requests = [{'datatype': DataType.DEVICES, 'max': n + 1} for n in range(25)]
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request', side_effect=basr) as mock_basr:
+            results = c.batch_get(requests, include_info=True)
+        self.assertEqual(3, mock_basr.call_count)
+        self.assertEqual([DataType.DEVICES + str(n + 1) for n in range(25)],
+                         [things[0][0]['thing_id'] for things in results])
+
+    def test_connection_pool(self):
+        c = self.get_dummy_health_vault_conn()
+        c.connection_pool = ConnectionPool()
+        body = "<response><status><code>0</code></status></response>"
+        with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+            httplib.HTTPException = Exception
+            httplib.BadStatusLine = real_httplib.BadStatusLine
+            mock_conn = httplib.HTTPSConnection.return_value
+            mock_conn.getresponse.return_value = mock.Mock(status=200, will_close=False)
+            mock_conn.getresponse.return_value.read.return_value = body
+            c._send_request("PAYLOAD")
+            c._send_request("PAYLOAD")
+            self.assertEqual(1, httplib.HTTPSConnection.call_count)
+            self.assertEqual(dict(created=1, reused=1, discarded=0), c.connection_pool.stats)
+            # A reused connection HealthVault has closed is replaced
+            mock_conn.getresponse.side_effect = [real_httplib.BadStatusLine("''"),
+                                                 mock_conn.getresponse.return_value]
+            c._send_request("PAYLOAD")
+            self.assertEqual(2, httplib.HTTPSConnection.call_count)
+
+    def test_connection_pool_no_resend(self):
+        # A request HealthVault might have acted on isn't sent again on a new connection
+        body = "<response><status><code>0</code></status></response>"
+        cases = [
+            # Timed out waiting for the response
+            (dict(getresponse=socket.timeout("timed out")), {}),
+            # Reset after the request was sent
+            (dict(getresponse=socket.error(104, "Connection reset by peer")), {}),
+            # Timed out sending it
+            (dict(send=socket.timeout("timed out")), {}),
+            # Not safe to send twice
+            (dict(getresponse=real_httplib.BadStatusLine("''")), dict(idempotent=False)),
+            (dict(send=socket.error(32, "Broken pipe")), dict(idempotent=False)),
+        ]
+        for (errors, kwargs) in cases:
+            c = self.get_dummy_health_vault_conn()
+            c.connection_pool = ConnectionPool()
+            with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+                httplib.HTTPException = Exception
+                httplib.BadStatusLine = real_httplib.BadStatusLine
+                mock_conn = httplib.HTTPSConnection.return_value
+                response = mock.Mock(status=200, will_close=False)
+                response.read.return_value = body
+                mock_conn.getresponse.return_value = response
+                c._send_request("PAYLOAD")
+                for (name, error) in errors.items():
+                    getattr(mock_conn, name).side_effect = error
+                with self.assertRaises(type(errors.values()[0])):
+                    c._send_request("PAYLOAD", **kwargs)
+                self.assertEqual(1, httplib.HTTPSConnection.call_count)
+                mock_conn.close.assert_called_with()
+
+    def test_connection_pool_resend_unsent(self):
+        # A request that failed while being sent on a reused connection is sent on a new one
+        c = self.get_dummy_health_vault_conn()
+        c.connection_pool = ConnectionPool()
+        body = "<response><status><code>0</code></status></response>"
+        with mock.patch('healthvaultlib.healthvault.httplib') as httplib:
+            httplib.HTTPException = Exception
+            httplib.BadStatusLine = real_httplib.BadStatusLine
+            old, new = mock.Mock(), mock.Mock()
+            httplib.HTTPSConnection.side_effect = [old, new]
+            for conn in (old, new):
+                conn.getresponse.return_value = mock.Mock(status=200, will_close=False)
+                conn.getresponse.return_value.read.return_value = body
+            c._send_request("PAYLOAD")
+            old.send.side_effect = socket.error(32, "Broken pipe")
+            c._send_request("PAYLOAD")
+        self.assertEqual(2, httplib.HTTPSConnection.call_count)
+        new.send.assert_called_with("PAYLOAD")
+
+    def test_build_and_send_request_idempotent(self):
+        c = self.get_dummy_health_vault_conn()
+        c.auth_token = "AUTHKEY"
+        c.record_id = "8"
+        with mock.patch.object(c, '_send_request') as sendRequest:
+            c._build_and_send_request("GetThings", "<info/>")
+            self.assertEqual(dict(idempotent=True), sendRequest.call_args[1])
+            c._build_and_send_request("PutThings", "<info/>")
+            self.assertEqual(dict(idempotent=False), sendRequest.call_args[1])
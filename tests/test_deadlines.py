@@ -0,0 +1,49 @@
+"""Tests for call deadlines"""
+
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.concurrency import run_concurrently
+from healthvaultlib.deadlines import current_deadline, deadline, limit, time_left
+from healthvaultlib.exceptions import HealthVaultDeadlineExceededException
+
+
+class DeadlineTests(TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        patcher = mock.patch('healthvaultlib.deadlines.time')
+        mock_time = patcher.start()
+        mock_time.time.side_effect = lambda: self.time
+        self.addCleanup(patcher.stop)
+
+    def test_no_deadline(self):
+        self.assertIsNone(time_left())
+        self.assertEqual(5, limit(5))
+        self.assertIsNone(limit(None))
+
+    def test_limit(self):
+        with deadline(1010):
+            self.assertEqual(10, time_left())
+            self.assertEqual(5, limit(5))
+            self.assertEqual(10, limit(30))
+            self.assertEqual(10, limit(None))
+            self.time += 10
+            self.assertRaises(HealthVaultDeadlineExceededException, limit, 5)
+        self.assertIsNone(current_deadline())
+
+    def test_nested(self):
+        # An inner call can't extend the outer deadline, only shorten it
+        with deadline(1010):
+            with deadline(1020):
+                self.assertEqual(1010, current_deadline())
+            with deadline(1005):
+                self.assertEqual(1005, current_deadline())
+            with deadline(None):
+                self.assertEqual(1010, current_deadline())
+            self.assertEqual(1010, current_deadline())
+
+    def test_passed_to_threads(self):
+        with deadline(1010):
+            results = run_concurrently(lambda item: current_deadline(), [1, 2, 3], max_workers=3)
+        self.assertEqual([(1010, None)] * 3, results)
@@ -0,0 +1,147 @@
+"""Tests for hedged requests"""
+
+import threading
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib import deadlines, hedging
+from healthvaultlib.exceptions import HealthVaultHedgeCancelledException
+from healthvaultlib.hedging import Hedger
+
+
+class HedgerTests(TestCase):
+    def test_delay(self):
+        hedger = Hedger(percentile=90, min_samples=10, min_delay=0.5)
+        for i in range(9):
+            hedger.record(i + 1)
+        self.assertEqual(None, hedger.delay())
+        hedger.record(10)
+        self.assertEqual(9, hedger.delay())
+        hedger = Hedger(min_samples=1, min_delay=0.5)
+        hedger.record(0.1)
+        self.assertEqual(0.5, hedger.delay())
+
+    def test_no_hedge_when_fast(self):
+        hedger = Hedger(min_samples=1, max_rate=1, burst=1)
+        hedger.record(5)
+        func = mock.Mock(return_value="OK")
+        self.assertEqual("OK", hedger.call(func))
+        self.assertEqual(1, func.call_count)
+        self.assertEqual(dict(requests=1, hedged=0, won=0, refused=0), hedger.stats)
+
+    def test_hedge_wins(self):
+        hedger = Hedger(min_samples=1, max_rate=1, burst=1, min_delay=0.01)
+        hedger.record(0.01)
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(threading.current_thread())
+            if len(calls) == 1:
+                release.wait(5)
+                return "SLOW"
+            return "FAST"
+        self.assertEqual("FAST", hedger.call(func))
+        release.set()
+        self.assertEqual(2, len(calls))
+        self.assertEqual(dict(requests=1, hedged=1, won=1, refused=0), hedger.stats)
+
+    def test_failure_waits_for_other(self):
+        hedger = Hedger(min_samples=1, max_rate=1, burst=1, min_delay=0.01)
+        hedger.record(0.01)
+        hedge_started = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            if len(calls) == 1:
+                # Fails, but only once the hedge is out
+                hedge_started.wait(5)
+                raise ValueError("first")
+            hedge_started.set()
+            return "SECOND"
+        self.assertEqual("SECOND", hedger.call(func))
+
+        def fail():
+            raise ValueError("both")
+        hedger._budget = 1
+        self.assertRaises(ValueError, hedger.call, fail)
+
+    def test_any_exception_passed_on(self):
+        # Even a copy killed by something that isn't an Exception wakes the caller
+        hedger = Hedger(min_samples=1, max_rate=1, burst=1, min_delay=0.01)
+        hedger.record(0.01)
+
+        def func():
+            raise SystemExit()
+        self.assertRaises(SystemExit, hedger.call, func)
+
+    def test_rate_cap(self):
+        # Always hedge after the fastest time so far
+        hedger = Hedger(percentile=1, min_samples=1, max_rate=0.5, burst=1, min_delay=0.01)
+        hedger.record(0.01)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow():
+            release.wait(0.05)
+            return "OK"
+        for i in range(4):
+            hedger.call(slow)
+        # Half a hedge a request
+        self.assertEqual(2, hedger.stats['hedged'])
+
+    def test_admit(self):
+        hedger = Hedger(min_samples=1, max_rate=1, burst=1, min_delay=0.01)
+        hedger.record(0.01)
+        release = threading.Event()
+
+        def slow():
+            release.wait(0.05)
+            return "OK"
+        self.assertEqual("OK", hedger.call(slow, admit=lambda: False))
+        self.assertEqual(dict(requests=1, hedged=0, won=0, refused=1), hedger.stats)
+
+    def test_deadline_passed_on(self):
+        hedger = Hedger(min_samples=1, max_rate=1, burst=1, min_delay=0)
+        hedger.record(0)
+        with deadlines.deadline(12345):
+            self.assertEqual(12345, hedger.call(deadlines.current_deadline))
+
+    def test_cancel_shuts_connection(self):
+        hedger = Hedger(min_samples=1, max_rate=1, burst=1, min_delay=0.01)
+        hedger.record(0.01)
+        slow, fast = mock.Mock(name='slow'), mock.Mock(name='fast')
+        conns = [slow, fast]
+        shut_down = threading.Event()
+        slow.sock.shutdown.side_effect = lambda how: shut_down.set()
+        seen = []
+        finished = threading.Event()
+
+        def func():
+            conn = conns.pop(0)
+            hedging.use(conn)
+            if conn is slow:
+                shut_down.wait(5)
+                seen.append((hedging.cancelled(), hedging.finish()))
+                finished.set()
+                return "SLOW"
+            return "FAST"
+        self.assertEqual("FAST", hedger.call(func))
+        self.assertTrue(finished.wait(5))
+        # Cancelled, so its connection mustn't be reused
+        self.assertEqual([(True, False)], seen)
+
+    def test_use_after_cancel(self):
+        attempt = hedging._Attempt(lambda: None, mock.Mock())
+        attempt.cancel()
+        conn = mock.Mock()
+        self.assertRaises(HealthVaultHedgeCancelledException, attempt.use, conn)
+        conn.close.assert_called_with()
+
+    def test_not_hedged(self):
+        conn = mock.Mock()
+        hedging.use(conn)
+        self.assertFalse(hedging.cancelled())
+        self.assertTrue(hedging.finish())
@@ -0,0 +1,174 @@
+"""Tests for the adaptive concurrency limiter"""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib import deadlines
+from healthvaultlib.exceptions import (HealthVaultAccessDeniedException, HealthVaultDeadlineExceededException,
+                                       HealthVaultHTTPException, HealthVaultRateLimitedException)
+from healthvaultlib.limits import AdaptiveLimiter, BACKGROUND, MemoryRateLimiter, SQLiteRateLimiter
+
+
+class AdaptiveLimiterTests(TestCase):
+    def test_additive_increase(self):
+        limiter = AdaptiveLimiter(initial_limit=2, max_limit=3)
+        # About one more for each limit's worth of good requests
+        limiter.call(lambda: "OK")
+        limiter.call(lambda: "OK")
+        self.assertEqual(2, limiter.limit)
+        limiter.call(lambda: "OK")
+        self.assertEqual(3, limiter.limit)
+        for i in range(10):
+            limiter.call(lambda: "OK")
+        self.assertEqual(3, limiter.limit)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveLimiter(initial_limit=8, min_limit=2)
+
+        def throttled():
+            raise HealthVaultHTTPException("Service unavailable", code=503)
+        self.assertRaises(HealthVaultHTTPException, limiter.call, throttled)
+        self.assertEqual(4, limiter.limit)
+        self.assertRaises(socket.error, limiter.call, mock.Mock(side_effect=socket.error(104, "reset")))
+        self.assertEqual(2, limiter.limit)
+        self.assertRaises(socket.error, limiter.call, mock.Mock(side_effect=socket.error(104, "reset")))
+        self.assertEqual(2, limiter.limit)
+        self.assertEqual(1, limiter.stats['throttled'])
+        self.assertEqual(2, limiter.stats['failed'])
+
+    def test_healthvault_errors_dont_count(self):
+        limiter = AdaptiveLimiter(initial_limit=4)
+        func = mock.Mock(side_effect=HealthVaultAccessDeniedException("Access denied", code=11))
+        self.assertRaises(HealthVaultAccessDeniedException, limiter.call, func)
+        self.assertEqual(4, limiter.limit)
+
+    def test_slow(self):
+        limiter = AdaptiveLimiter(initial_limit=4, slow_request_time=10)
+        token = limiter.acquire()
+        limiter.release(token, 11)
+        self.assertEqual(2, limiter.limit)
+        self.assertEqual(1, limiter.stats['slow'])
+
+    def test_cut_once_per_epoch(self):
+        # Requests sent before a cut don't cut the limit again
+        limiter = AdaptiveLimiter(initial_limit=8)
+        tokens = [limiter.acquire() for i in range(3)]
+        self.assertEqual(3, limiter.in_flight)
+        for token in tokens:
+            limiter.release(token, 0, socket.error(104, "reset"))
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_queue_fifo(self):
+        # One at a time, so they run in the order they're let through
+        limiter = AdaptiveLimiter(initial_limit=1, max_limit=1)
+        token = limiter.acquire()
+        order = []
+
+        def wait(n):
+            limiter.call(order.append, n)
+        threads = []
+        for n in range(3):
+            thread = threading.Thread(target=wait, args=(n,))
+            thread.start()
+            threads.append(thread)
+            # Make sure they queue in order
+            while limiter.queue_depth < n + 1:
+                pass
+        self.assertEqual(1, limiter.in_flight)
+        limiter.release(token, 0, ValueError())
+        for thread in threads:
+            thread.join()
+        self.assertEqual([0, 1, 2], order)
+        self.assertEqual(0, limiter.queue_depth)
+
+    def test_deadline_while_queued(self):
+        limiter = AdaptiveLimiter(initial_limit=1)
+        limiter.acquire()
+        with mock.patch('healthvaultlib.deadlines.time') as mock_time:
+            mock_time.time.return_value = 1000
+            with deadlines.deadline(1000.01):
+                self.assertRaises(HealthVaultDeadlineExceededException, limiter.acquire)
+        self.assertEqual(0, limiter.queue_depth)
+        self.assertEqual(1, limiter.in_flight)
+
+
+class RateLimiterTests(TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        patcher = mock.patch('healthvaultlib.limits.time')
+        self.mock_time = patcher.start()
+        self.mock_time.time.side_effect = lambda: self.time
+
+        def sleep(seconds):
+            self.time += seconds
+        self.mock_time.sleep.side_effect = sleep
+        self.addCleanup(patcher.stop)
+
+    def test_blocking(self):
+        limiter = MemoryRateLimiter(rate=2, burst=2)
+        for i in range(3):
+            limiter.acquire("APP")
+        # The third had to wait for a token
+        self.assertEqual([mock.call(0.5)], self.mock_time.sleep.call_args_list)
+        self.assertEqual(dict(requests=3, waits=1, waited=0.5, refused=0), limiter.stats)
+
+    def test_fail_fast(self):
+        limiter = MemoryRateLimiter(rate=1, blocking=False)
+        limiter.acquire("APP")
+        try:
+            limiter.acquire("APP")
+        except HealthVaultRateLimitedException as e:
+            self.assertEqual(1, e.retry_after)
+        else:
+            self.fail("Expected HealthVaultRateLimitedException")
+        self.time += 1
+        limiter.acquire("APP")
+
+    def test_per_record(self):
+        limiter = MemoryRateLimiter(rate=10, record_rate=1, blocking=False)
+        limiter.acquire("APP", "R1")
+        self.assertRaises(HealthVaultRateLimitedException, limiter.acquire, "APP", "R1")
+        limiter.acquire("APP", "R2")
+        limiter.acquire("APP")
+        # The refused request didn't use up an application token
+        self.assertEqual(3, limiter.stats['requests'])
+        for i in range(7):
+            limiter.acquire("APP")
+        self.assertRaises(HealthVaultRateLimitedException, limiter.acquire, "APP")
+
+    def test_priority_lane(self):
+        limiter = MemoryRateLimiter(rate=1, burst=10, reserve=0.2, blocking=False)
+        with limiter.options(priority=BACKGROUND):
+            for i in range(8):
+                limiter.acquire("APP")
+            self.assertRaises(HealthVaultRateLimitedException, limiter.acquire, "APP")
+        # The last two are kept for interactive requests
+        limiter.acquire("APP")
+        limiter.acquire("APP")
+        self.assertRaises(HealthVaultRateLimitedException, limiter.acquire, "APP")
+
+    def test_options(self):
+        limiter = MemoryRateLimiter(rate=1)
+        limiter.acquire("APP")
+        with limiter.options(blocking=False):
+            self.assertRaises(HealthVaultRateLimitedException, limiter.acquire, "APP")
+        self.assertEqual(BACKGROUND, MemoryRateLimiter(rate=1, priority=BACKGROUND)._option('priority'))
+
+    def test_sqlite_shared(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'rates.db')
+        first = SQLiteRateLimiter(path, rate=1, burst=2, blocking=False)
+        second = SQLiteRateLimiter(path, rate=1, burst=2, blocking=False)
+        first.acquire("APP")
+        second.acquire("APP")
+        self.assertRaises(HealthVaultRateLimitedException, first.acquire, "APP")
+        self.time += 1
+        second.acquire("APP")
@@ -0,0 +1,171 @@
+"""Tests for receiving HealthVault notifications"""
+
+import base64
+import hashlib
+import hmac
+import Queue
+import StringIO
+import threading
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.notifications import NotificationReceiver, RecordChangeCoalescer
+
+
+NOTIFICATION = '<notification>' \
+               '<common><subscription-id>SUB-ID</subscription-id></common>' \
+               '<record-change-notification>' \
+               '<person-id>PERSON-ID</person-id><record-id>RECORD-ID</record-id>' \
+               '<things><thing><thing-id>THING1</thing-id></thing><thing><thing-id>THING2</thing-id></thing></things>' \
+               '</record-change-notification>' \
+               '</notification>'
+
+
+def sign(body, key, version="1"):
+    signature = base64.b64encode(hmac.new(key, body, hashlib.sha256).digest())
+    return "HMACSHA256 %s:%s" % (version, signature)
+
+
+class NotificationReceiverTests(TestCase):
+    def call(self, receiver, body, signature, method='POST'):
+        environ = {
+            'REQUEST_METHOD': method,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO.StringIO(body),
+            'HTTP_X_HV_SIGNATURE': signature,
+        }
+        statuses = []
+        receiver(environ, lambda status, headers: statuses.append(status))
+        return statuses[0]
+
+    def test_receive(self):
+        receiver = NotificationReceiver({'1': 'secret'})
+        self.assertEqual('200 OK', self.call(receiver, NOTIFICATION, sign(NOTIFICATION, 'secret')))
+        notification = receiver.queue.get_nowait()
+        self.assertEqual('SUB-ID', notification['common']['subscription_id'])
+        change = notification['record_change_notification']
+        self.assertEqual('RECORD-ID', change['record_id'])
+        self.assertEqual(['THING1', 'THING2'], change['things'])
+        self.assertEqual(1, receiver.stats['received'])
+
+    def test_key_versions(self):
+        receiver = NotificationReceiver({'1': 'old', '2': 'new'})
+        self.assertEqual('200 OK', self.call(receiver, NOTIFICATION, sign(NOTIFICATION, 'old', '1')))
+        self.assertEqual('200 OK', self.call(receiver, NOTIFICATION, sign(NOTIFICATION, 'new', '2')))
+        # Right key, wrong version
+        self.assertEqual('401 Unauthorized', self.call(receiver, NOTIFICATION, sign(NOTIFICATION, 'new', '1')))
+
+    def test_bad_signatures(self):
+        receiver = NotificationReceiver({'1': 'secret'})
+        for signature in (None, '', 'garbage', sign(NOTIFICATION, 'wrong'), sign(NOTIFICATION + ' ', 'secret'),
+                          sign(NOTIFICATION, 'secret').replace('HMACSHA256', 'HMACSHA1')):
+            self.assertEqual('401 Unauthorized', self.call(receiver, NOTIFICATION, signature))
+        self.assertTrue(receiver.queue.empty())
+        self.assertEqual(6, receiver.stats['rejected'])
+
+    def test_add_subscription(self):
+        receiver = NotificationReceiver()
+        receiver.add_subscription({'common': {'notification_authentication_info': {
+            'hv_eventing_shared_key': {'notification_key': u'secret', 'notification_key_version_id': '7'}}}})
+        self.assertTrue(receiver.verify(NOTIFICATION, sign(NOTIFICATION, 'secret', '7')))
+
+    def test_queue_full(self):
+        receiver = NotificationReceiver({'1': 'secret'}, maxsize=1)
+        signature = sign(NOTIFICATION, 'secret')
+        self.assertEqual('200 OK', self.call(receiver, NOTIFICATION, signature))
+        self.assertEqual('503 Service Unavailable', self.call(receiver, NOTIFICATION, signature))
+        self.assertEqual(1, receiver.stats['dropped'])
+
+    def test_not_post(self):
+        receiver = NotificationReceiver({'1': 'secret'})
+        self.assertEqual('405 Method Not Allowed', self.call(receiver, '', None, method='GET'))
+
+
+def change(record_id, *thing_ids):
+    return {'common': {'subscription_id': 'SUB-ID'},
+            'record_change_notification': {'person_id': 'P', 'record_id': record_id, 'things': list(thing_ids)}}
+
+
+class RecordChangeCoalescerTests(TestCase):
+    def setUp(self):
+        self.conns = {}
+        self.handled = []
+
+    def get_conn(self, record_id):
+        conn = self.conns.setdefault(record_id, mock.Mock())
+        conn.get_things_by_ids.side_effect = lambda ids: dict((i, {'thing': i}) for i in ids if i != 'GONE')
+        return conn
+
+    def handler(self, record_id, things):
+        self.handled.append((record_id, things))
+
+    def test_coalesce_per_record(self):
+        coalescer = RecordChangeCoalescer(self.get_conn, self.handler, window=60)
+        coalescer.add(change('R1', 'T1', 'T2'))
+        coalescer.add(change('R2', 'T3'))
+        coalescer.add(change('R1', 'T2', 'GONE'))
+        # Nothing's due yet
+        self.assertEqual(0, coalescer.flush())
+        self.assertTrue(0 < coalescer.next_due() <= 60)
+        self.assertEqual(2, coalescer.flush(force=True))
+        # One request per record, with duplicate IDs removed
+        self.conns['R1'].get_things_by_ids.assert_called_once_with(['GONE', 'T1', 'T2'])
+        self.conns['R2'].get_things_by_ids.assert_called_once_with(['T3'])
+        handled = dict(self.handled)
+        self.assertEqual({'T1': {'thing': 'T1'}, 'T2': {'thing': 'T2'}, 'GONE': None}, handled['R1'])
+        self.assertIsNone(coalescer.next_due())
+
+    def test_window(self):
+        coalescer = RecordChangeCoalescer(self.get_conn, self.handler, window=0)
+        coalescer.add(change('R1', 'T1'))
+        self.assertEqual(1, coalescer.flush())
+
+    def test_fetch_error_retried(self):
+        failing = mock.Mock()
+        failing.get_things_by_ids.side_effect = ValueError("Boom")
+        conns = [failing]
+        coalescer = RecordChangeCoalescer(lambda record_id: conns.pop() if conns else self.get_conn(record_id),
+                                          self.handler, window=0)
+        coalescer.add(change('R1', 'T1'))
+        self.assertEqual(0, coalescer.flush())
+        self.assertEqual([], self.handled)
+        # Kept to try again
+        self.assertEqual(1, coalescer.flush())
+        self.assertEqual([('R1', {'T1': {'thing': 'T1'}})], self.handled)
+
+    def test_handler_error_retried(self):
+        calls = []
+
+        def handler(record_id, things):
+            calls.append(record_id)
+            if record_id == 'R1' and calls.count('R1') == 1:
+                raise ValueError("Boom")
+            self.handler(record_id, things)
+        coalescer = RecordChangeCoalescer(self.get_conn, handler, window=0)
+        coalescer.add(change('R1', 'T1'))
+        coalescer.add(change('R2', 'T2'))
+        # The failure doesn't lose the other record's changes
+        self.assertEqual(1, coalescer.flush())
+        self.assertEqual([('R2', {'T2': {'thing': 'T2'}})], self.handled)
+        # and its own are kept to try again
+        self.assertEqual(1, coalescer.flush())
+        self.assertEqual(('R1', {'T1': {'thing': 'T1'}}), self.handled[-1])
+
+    def test_run_survives_errors(self):
+        coalescer = RecordChangeCoalescer(self.get_conn, self.handler, window=0)
+        stop = threading.Event()
+        notifications = Queue.Queue()
+        notifications.put(change('R1', 'T1'))
+        with mock.patch.object(coalescer, 'add') as add:
+            def boom(notification):
+                stop.set()
+                raise ValueError("Boom")
+            add.side_effect = boom
+            coalescer.run(notifications, stop)
+        self.assertTrue(add.called)
+
+    def test_ignores_other_notifications(self):
+        coalescer = RecordChangeCoalescer(self.get_conn, self.handler)
+        coalescer.add({'common': {'subscription_id': 'SUB-ID'}, 'record_change_notification': None})
+        self.assertIsNone(coalescer.next_due())
@@ -0,0 +1,48 @@
+"""Tests for learning page sizes"""
+
+from unittest import TestCase
+
+from healthvaultlib.paging import PageSizer
+
+
+class PageSizerTests(TestCase):
+    def test_initial(self):
+        sizer = PageSizer(initial=25)
+        self.assertEqual(25, sizer.page_size('TYPE'))
+        # Empty pages teach us nothing
+        sizer.observe('TYPE', 0, 200, 0.1)
+        self.assertEqual(25, sizer.page_size('TYPE'))
+        self.assertEqual({}, sizer.learned)
+
+    def test_target_size(self):
+        sizer = PageSizer(target_size=100000, max_size=1000, weight=0.5)
+        sizer.observe('TYPE', 10, 10000, 1)
+        self.assertEqual(100, sizer.page_size('TYPE'))
+        # Things turn out to be bigger, so the average moves halfway there
+        sizer.observe('TYPE', 10, 30000, 1)
+        self.assertEqual(2000, sizer.learned['TYPE']['bytes_per_thing'])
+        self.assertEqual(50, sizer.page_size('TYPE'))
+        # Other types are learned separately
+        self.assertEqual(30, sizer.page_size('OTHER'))
+
+    def test_target_time(self):
+        # 1000 bytes a thing at a millisecond a kilobyte: 1000 things a second
+        sizer = PageSizer(target_size=10 ** 9, target_time=0.5, max_size=10000)
+        sizer.observe('TYPE', 100, 100000, 0.1)
+        self.assertEqual(500, sizer.page_size('TYPE'))
+
+    def test_limits(self):
+        sizer = PageSizer(target_size=1000, min_size=10, max_size=200)
+        sizer.observe('BIG', 1, 10000, 0.1)
+        self.assertEqual(10, sizer.page_size('BIG'))
+        sizer.observe('SMALL', 100, 100, 0.1)
+        self.assertEqual(200, sizer.page_size('SMALL'))
+
+    def test_learned(self):
+        first = PageSizer(target_size=5000)
+        first.observe('TYPE', 10, 10000, 1)
+        self.assertEqual(dict(bytes_per_thing=1000, seconds_per_byte=0.0001, pages=1), first.learned['TYPE'])
+        second = PageSizer(target_size=5000, min_size=1, learned=first.learned)
+        self.assertEqual(5, second.page_size('TYPE'))
+        second.observe('TYPE', 10, 10000, 1)
+        self.assertEqual(1, first.learned['TYPE']['pages'])
@@ -0,0 +1,51 @@
+"""Tests for the connection pool"""
+
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.pool import ConnectionPool
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        patcher = mock.patch('healthvaultlib.pool.time')
+        mock_time = patcher.start()
+        mock_time.time.side_effect = lambda: self.time
+        self.addCleanup(patcher.stop)
+
+    def test_reuse(self):
+        pool = ConnectionPool()
+        self.assertIsNone(pool.get("HOST", 443))
+        conn = mock.Mock()
+        pool.put("HOST", 443, conn)
+        self.assertIsNone(pool.get("OTHER", 443))
+        self.assertIs(conn, pool.get("HOST", 443))
+        self.assertIsNone(pool.get("HOST", 443))
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=30)
+        old, new = mock.Mock(), mock.Mock()
+        pool.put("HOST", 443, old)
+        self.time += 20
+        pool.put("HOST", 443, new)
+        self.time += 20
+        # The most recently used is reused first
+        self.assertIs(new, pool.get("HOST", 443))
+        pool.put("HOST", 443, new)
+        self.time += 31
+        self.assertIsNone(pool.get("HOST", 443))
+        self.assertTrue(old.close.called)
+        self.assertTrue(new.close.called)
+        self.assertEqual(2, pool.stats['discarded'])
+
+    def test_maxsize(self):
+        pool = ConnectionPool(maxsize=1)
+        first, second = mock.Mock(), mock.Mock()
+        pool.put("HOST", 443, first)
+        pool.put("HOST", 443, second)
+        self.assertTrue(second.close.called)
+        pool.close()
+        self.assertTrue(first.close.called)
+        self.assertIsNone(pool.get("HOST", 443))
@@ -0,0 +1,105 @@
+"""Tests for the date-range index"""
+
+import datetime
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.datatypes import DataType
+from healthvaultlib.ranges import RangeIndex, merge_ranges, missing_ranges
+
+
+def day(n):
+    return datetime.datetime(2012, 1, n)
+
+
+def thing(thing_id, n):
+    return (dict(thing_id=thing_id, version_stamp='V', type_id=DataType.WEIGHT_MEASUREMENTS,
+                 eff_date=day(n), updated=None), {'id': thing_id})
+
+
+class RangeTests(TestCase):
+    def test_merge_ranges(self):
+        self.assertEqual([(day(1), day(5), 10), (day(7), day(8), 30)],
+                         merge_ranges([(day(3), day(5), 20), (day(7), day(8), 30), (day(1), day(3), 10)]))
+
+    def test_missing_ranges(self):
+        covered = [(day(3), day(5), 0), (day(7), day(8), 0)]
+        self.assertEqual([(day(1), day(3)), (day(5), day(7)), (day(8), day(10))],
+                         missing_ranges(covered, day(1), day(10)))
+        self.assertEqual([], missing_ranges(covered, day(3), day(4)))
+        self.assertEqual([(day(5), day(6))], missing_ranges(covered, day(4), day(6)))
+        self.assertEqual([(day(1), day(1))], missing_ranges([], day(1), day(1)))
+
+
+class RangeIndexTests(TestCase):
+    def setUp(self):
+        self.conn = mock.Mock(record_id="R1")
+        self.index = RangeIndex(ttl=60)
+        self.time = 1000.0
+        patcher = mock.patch('healthvaultlib.ranges.time')
+        self.addCleanup(patcher.stop)
+        patcher.start().time.side_effect = lambda: self.time
+
+    def weights(self, start, end):
+        return {'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': start, 'max_date': end, 'max': None}
+
+    def test_gaps_fetched_in_one_request(self):
+        self.conn._batch_get.return_value = [[thing('C', 6), thing('B', 5)]]
+        self.assertEqual([[{'id': 'C'}, {'id': 'B'}]], self.index.batch_get(self.conn, self.weights(day(5), day(7))))
+
+        # Only the parts before and after what we have are fetched, along with another request
+        device = (dict(thing('E', 1)[0], type_id=DataType.DEVICES), 'DEVICE')
+        self.conn._batch_get.return_value = [[thing('A', 3)], [thing('D', 9)], [device]]
+        result = self.index.batch_get(self.conn, [self.weights(day(1), day(10)),
+                                                  {'datatype': DataType.DEVICES, 'max': 1}])
+        self.assertEqual([[{'id': 'D'}, {'id': 'C'}, {'id': 'B'}, {'id': 'A'}], ['DEVICE']], result)
+        self.conn._batch_get.assert_called_with(
+            [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': day(1), 'max_date': day(5)},
+             {'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': day(7), 'max_date': day(10)},
+             {'datatype': DataType.DEVICES, 'max': 1}], True)
+
+        # Now it's all local
+        self.conn._batch_get.reset_mock()
+        result = self.index.batch_get(self.conn, self.weights(day(2), day(6)), include_info=True)
+        self.assertEqual([[thing('C', 6), thing('B', 5), thing('A', 3)]], result)
+        self.assertFalse(self.conn._batch_get.called)
+        self.assertEqual(dict(local=1, fetched=2), self.index.stats)
+
+    def test_refetched_range_replaces_things(self):
+        self.conn._batch_get.return_value = [[thing('B', 5), thing('A', 3)]]
+        self.index.batch_get(self.conn, self.weights(None, None))
+        # Once the ttl has passed, the range is fetched again; A was deleted and B moved
+        self.time += 61
+        self.conn._batch_get.return_value = [[thing('B', 2)]]
+        self.assertEqual([[{'id': 'B'}]], self.index.batch_get(self.conn, self.weights(None, day(4))))
+        self.conn._batch_get.assert_called_with(
+            [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': None, 'max_date': day(4)}], True)
+        self.assertEqual([[{'id': 'B'}]], self.index.batch_get(self.conn, self.weights(day(1), day(6))))
+
+    def test_gaps_in_whole_seconds(self):
+        # HealthVault only gets whole seconds, so the gaps asked for are widened to them
+        start = datetime.datetime(2012, 1, 3, 12, 0, 0, 400000)
+        end = datetime.datetime(2012, 1, 3, 12, 0, 5, 700000)
+        late = (dict(thing('L', 3)[0], eff_date=datetime.datetime(2012, 1, 3, 12, 0, 5, 300000)), {'id': 'L'})
+        early = (dict(thing('E', 3)[0], eff_date=datetime.datetime(2012, 1, 3, 12, 0, 0, 200000)), {'id': 'E'})
+        self.conn._batch_get.return_value = [[late, early]]
+        self.assertEqual([[{'id': 'L'}]], self.index.batch_get(self.conn, self.weights(start, end)))
+        self.conn._batch_get.assert_called_with(
+            [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': datetime.datetime(2012, 1, 3, 12, 0, 0),
+              'max_date': datetime.datetime(2012, 1, 3, 12, 0, 6)}], True)
+        # A later gap that starts in the same second doesn't lose what was fetched in it
+        self.conn._batch_get.reset_mock()
+        self.conn._batch_get.return_value = [[]]
+        result = self.index.batch_get(self.conn, self.weights(start.replace(microsecond=0), day(4)))
+        self.assertEqual([[{'id': 'L'}, {'id': 'E'}]], result)
+        self.conn._batch_get.assert_called_with(
+            [{'datatype': DataType.WEIGHT_MEASUREMENTS, 'min_date': datetime.datetime(2012, 1, 3, 12, 0, 6),
+              'max_date': day(4)}], True)
+
+    def test_unplannable_requests_pass_through(self):
+        self.conn._batch_get.return_value = [[thing('A', 3)]]
+        request = {'datatype': DataType.WEIGHT_MEASUREMENTS, 'max': 1}
+        self.assertEqual([[{'id': 'A'}]], self.index.batch_get(self.conn, request))
+        self.conn._batch_get.assert_called_with([request], True)
+        self.index.invalidate("R1")
@@ -0,0 +1,78 @@
+"""Tests for the retry policy"""
+
+import errno
+import httplib
+import socket
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.exceptions import HealthVaultException, HealthVaultHTTPException
+from healthvaultlib.retry import RetryPolicy
+from healthvaultlib.status_codes import HealthVaultStatus
+
+
+class RetryPolicyTests(TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=10, budget=30)
+
+    def test_is_retryable(self):
+        policy = self.policy
+        self.assertTrue(policy.is_retryable(HealthVaultException("x", code=HealthVaultStatus.FAILED)))
+        self.assertFalse(policy.is_retryable(HealthVaultException("x", code=HealthVaultStatus.ACCESS_DENIED)))
+        self.assertTrue(policy.is_retryable(HealthVaultHTTPException("x", code=502)))
+        self.assertFalse(policy.is_retryable(HealthVaultHTTPException("x", code=400)))
+        self.assertTrue(policy.is_retryable(socket.timeout("timed out")))
+        self.assertTrue(policy.is_retryable(httplib.BadStatusLine("")))
+        self.assertFalse(policy.is_retryable(ValueError("x")))
+
+    def test_is_retryable_not_idempotent(self):
+        # Only failures that mean HealthVault can't have done it
+        policy = self.policy
+        self.assertFalse(policy.is_retryable(HealthVaultException("x", code=HealthVaultStatus.FAILED), False))
+        self.assertFalse(policy.is_retryable(HealthVaultHTTPException("x", code=502), False))
+        self.assertTrue(policy.is_retryable(HealthVaultHTTPException("x", code=503), False))
+        self.assertFalse(policy.is_retryable(socket.timeout("timed out"), False))
+        self.assertTrue(policy.is_retryable(socket.error(errno.ECONNREFUSED, "refused"), False))
+        self.assertFalse(policy.is_retryable(httplib.BadStatusLine(""), False))
+
+    def test_delay(self):
+        with mock.patch('healthvaultlib.retry.random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual([1, 2, 4, 8, 10], [self.policy.delay(retry) for retry in range(5)])
+
+    def test_call_retries(self):
+        func = mock.Mock(side_effect=[HealthVaultHTTPException("x", code=503), socket.timeout(), "OK"])
+        with mock.patch('healthvaultlib.retry.time') as mock_time:
+            with mock.patch('healthvaultlib.retry.random.uniform', side_effect=lambda a, b: b):
+                self.assertEqual("OK", self.policy.call(func))
+        self.assertEqual(3, func.call_count)
+        self.assertEqual([mock.call(1), mock.call(2)], mock_time.sleep.call_args_list)
+
+    def test_call_gives_up(self):
+        func = mock.Mock(side_effect=socket.timeout())
+        with mock.patch('healthvaultlib.retry.time'):
+            self.assertRaises(socket.timeout, self.policy.call, func)
+        self.assertEqual(3, func.call_count)
+
+    def test_call_fatal(self):
+        func = mock.Mock(side_effect=HealthVaultException("x", code=HealthVaultStatus.INVALID_XML))
+        with mock.patch('healthvaultlib.retry.time') as mock_time:
+            self.assertRaises(HealthVaultException, self.policy.call, func)
+        self.assertEqual(1, func.call_count)
+        self.assertFalse(mock_time.sleep.called)
+
+    def test_call_not_idempotent(self):
+        func = mock.Mock(side_effect=socket.timeout())
+        with mock.patch('healthvaultlib.retry.time'):
+            self.assertRaises(socket.timeout, self.policy.call, func, idempotent=False)
+        self.assertEqual(1, func.call_count)
+
+    def test_call_budget(self):
+        # The second wait would take us past the budget, so we give up before it
+        policy = RetryPolicy(max_attempts=10, base_delay=1, budget=2)
+        func = mock.Mock(side_effect=socket.timeout())
+        with mock.patch('healthvaultlib.retry.time') as mock_time:
+            with mock.patch('healthvaultlib.retry.random.uniform', side_effect=lambda a, b: b):
+                self.assertRaises(socket.timeout, policy.call, func)
+        self.assertEqual(2, func.call_count)
+        self.assertEqual([mock.call(1)], mock_time.sleep.call_args_list)
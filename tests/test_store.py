@@ -0,0 +1,134 @@
+"""Tests for the on-disk thing store"""
+
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import xml.etree.ElementTree as ET
+
+import mock
+
+from healthvaultlib.datatypes import DataType
+from healthvaultlib.healthvault import HealthVaultConn
+from healthvaultlib.store import ThingStore
+from healthvaultlib.xmlutils import ThingKey
+
+
+def info(thing_id, version_stamp, day, type_id=DataType.WEIGHT_MEASUREMENTS):
+    return dict(thing_id=thing_id, version_stamp=version_stamp, type_id=type_id,
+                eff_date=datetime.datetime(2012, 1, day), updated=None)
+
+
+class ThingStoreTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "things.db")
+        self.store = ThingStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_and_get(self):
+        self.store.put_things("R1", [(info("T1", "V1", 1), {'kg': 60.0}),
+                                     (info("T2", "V1", 3), {'kg': 61.0}),
+                                     (info("T3", "V1", 2, DataType.DEVICES), {'name': 'scale'})])
+        self.store.put_things("R1", [(info("T1", "V2", 1), {'kg': 59.0})])
+        self.store.put_things("R2", [(info("T4", "V1", 1), {'kg': 80.0})])
+        # Still there after a restart
+        store = ThingStore(self.path)
+        self.assertEqual([(info("T2", "V1", 3), {'kg': 61.0}), (info("T1", "V2", 1), {'kg': 59.0})],
+                         store.get_things("R1", DataType.WEIGHT_MEASUREMENTS))
+        self.assertEqual([(info("T2", "V1", 3), {'kg': 61.0})],
+                         store.get_things("R1", DataType.WEIGHT_MEASUREMENTS, min_date=datetime.datetime(2012, 1, 2)))
+        self.assertEqual({"T1": "V2"}, store.versions("R1", DataType.WEIGHT_MEASUREMENTS,
+                                                      max_date=datetime.datetime(2012, 1, 2)))
+
+    def test_sync(self):
+        self.store.put_things("R1", [(info("T1", "V1", 1), {'kg': 60.0}),
+                                     (info("T2", "V1", 2), {'kg': 61.0}),
+                                     (info("T3", "V1", 3), {'kg': 62.0})])
+        conn = mock.Mock(record_id="R1")
+        # T1 is unchanged, T2 has changed, T3 was deleted and T4 is new
+        conn.iter_thing_keys.return_value = [
+            ThingKey("T4", "V1", DataType.WEIGHT_MEASUREMENTS, datetime.datetime(2012, 1, 4), None),
+            ThingKey("T2", "V2", DataType.WEIGHT_MEASUREMENTS, datetime.datetime(2012, 1, 2), None),
+            ThingKey("T1", "V1", DataType.WEIGHT_MEASUREMENTS, datetime.datetime(2012, 1, 1), None),
+        ]
+        conn.get_things_by_keys.return_value = {"T4": {'kg': 63.0}, "T2": {'kg': 61.5}}
+        conn.get_things_by_ids.return_value = {}
+        self.assertEqual({'fetched': 2, 'removed': 1}, self.store.sync(conn, DataType.WEIGHT_MEASUREMENTS))
+        conn.get_things_by_keys.assert_called_with([("T4", "V1"), ("T2", "V2")])
+        conn.get_things_by_ids.assert_called_with(["T3"])
+        self.assertEqual([{'kg': 63.0}, {'kg': 61.5}, {'kg': 60.0}],
+                         [data for (i, data) in self.store.get_things("R1", DataType.WEIGHT_MEASUREMENTS)])
+
+    def test_sync_trusts_only_what_it_sees(self):
+        self.store.put_things("R1", [(info("T1", "V1", 1), {'kg': 60.0}),
+                                     (info("T2", "V1", 2), {'kg': 61.0})])
+        conn = mock.Mock(record_id="R1")
+        # T1 isn't listed, but is still there; T3 changed again before it could be fetched
+        conn.iter_thing_keys.return_value = [
+            ThingKey("T3", "V1", DataType.WEIGHT_MEASUREMENTS, datetime.datetime(2012, 1, 3), None),
+            ThingKey("T2", "V1", DataType.WEIGHT_MEASUREMENTS, datetime.datetime(2012, 1, 2), None),
+        ]
+        conn.get_things_by_keys.return_value = {}
+        conn.get_things_by_ids.return_value = {"T1": {'kg': 60.0}}
+        self.assertEqual({'fetched': 0, 'removed': 0}, self.store.sync(conn, DataType.WEIGHT_MEASUREMENTS))
+        self.assertEqual({"T1": "V1", "T2": "V1"}, self.store.versions("R1", DataType.WEIGHT_MEASUREMENTS))
+
+    def test_sync_many(self):
+        # More things than HealthVault lists in full in one group
+        def weight(thing_id, minute, version_stamp, kg):
+            return ('<thing><thing-id version-stamp="%s">%s</thing-id>'
+                    '<type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>'
+                    '<eff-date>2012-01-01T00:%02d:00</eff-date>'
+                    '<data-xml><weight><when><date><y>2012</y><m>1</m><d>1</d></date></when>'
+                    '<value><kg>%d</kg><display units="kg">%d</display></value></weight></data-xml></thing>'
+                    % (version_stamp, thing_id, minute, kg, kg))
+
+        def key(thing_id, minute, version_stamp):
+            return ('<unprocessed-thing-key-info><thing-id version-stamp="%s">%s</thing-id>'
+                    '<type-id>3d34d87e-7fc1-4153-800f-f56592cb0d17</type-id>'
+                    '<eff-date>2012-01-01T00:%02d:00</eff-date></unprocessed-thing-key-info>'
+                    % (version_stamp, thing_id, minute))
+        stored = dict(('T%02d' % minute, minute) for minute in range(40))
+        # Newest first; T05 has been deleted, and T35 changed
+        server = [('T%02d' % minute, minute, 'V2' if minute == 35 else 'V1')
+                  for minute in range(39, -1, -1) if minute != 5]
+
+        def basr(method_name, info):
+            groups = []
+            for group in ET.fromstring(info).findall('group'):
+                if group.find('filter') is not None:
+                    groups.append(''.join(weight(*(thing + (0,))) for thing in server[:30]) +
+                                  ''.join(key(*thing) for thing in server[30:]))
+                else:
+                    refs = set(elt.text for elt in group.findall('id') + group.findall('key'))
+                    groups.append(''.join(weight(*(thing + (99,))) for thing in server if thing[0] in refs))
+            body = ('<response><x:info xmlns:x="urn:com.microsoft.wc.methods.response.GetThings">%s</x:info>'
+                    '</response>' % ''.join('<group>%s</group>' % group for group in groups))
+            return (None, body, ET.fromstring(body))
+        self.store.put_things("R1", [(dict(info(thing_id, "V1", 1), eff_date=datetime.datetime(2012, 1, 1, 0, minute)),
+                                      {'kg': minute})
+                                     for (thing_id, minute) in stored.items()])
+        with mock.patch.object(HealthVaultConn, '_get_auth_token'):
+            conn = HealthVaultConn("APP", "THUMBPRINT", 1L, 1L)
+        conn.record_id = "R1"
+        with mock.patch.object(HealthVaultConn, '_build_and_send_request', side_effect=basr):
+            self.assertEqual({'fetched': 1, 'removed': 1}, self.store.sync(conn, DataType.WEIGHT_MEASUREMENTS))
+        versions = self.store.versions("R1", DataType.WEIGHT_MEASUREMENTS)
+        self.assertEqual(sorted(thing[0] for thing in server), sorted(versions))
+        self.assertEqual('V2', versions['T35'])
+
+    def test_check_and_compact(self):
+        self.store.put_things("R1", [(info("T1", "V1", 1), {'kg': 60.0}), (info("T2", "V1", 2), {'kg': 61.0})])
+        self.store.put_things("R2", [(info("T3", "V1", 1), {'kg': 80.0})])
+        self.assertEqual([], self.store.check())
+        self.store._db.execute("UPDATE things SET data = ? WHERE thing_id = 'T2'", (buffer("garbage"),))
+        self.assertEqual(["Corrupt data for thing T2 in record R1"], self.store.check(repair=True))
+        self.assertEqual([], self.store.check())
+        self.assertEqual({"T1": "V1"}, self.store.versions("R1", DataType.WEIGHT_MEASUREMENTS))
+        self.store.compact(keep_records=["R1"])
+        self.assertEqual({}, self.store.versions("R2", DataType.WEIGHT_MEASUREMENTS))
+        self.assertEqual({"T1": "V1"}, self.store.versions("R1", DataType.WEIGHT_MEASUREMENTS))
@@ -0,0 +1,103 @@
+"""Tests for incremental sync"""
+
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from healthvaultlib.datatypes import DataType
+from healthvaultlib.sync import FileCheckpointStore, MemoryCheckpointStore, SyncEngine
+
+
+def thing(thing_id, version_stamp, updated):
+    info = dict(thing_id=thing_id, version_stamp=version_stamp, type_id=DataType.WEIGHT_MEASUREMENTS,
+                eff_date=datetime.datetime(2012, 1, 1), updated=updated)
+    return (info, {'kg': 60.0})
+
+
+class SyncEngineTests(TestCase):
+    def setUp(self):
+        self.conn = mock.Mock(record_id="RECORD")
+        self.store = MemoryCheckpointStore()
+        self.engine = SyncEngine(self.store)
+        self.handled = []
+
+    def handler(self, record_id, datatype, things):
+        self.handled.append((record_id, datatype, [info['thing_id'] for (info, data) in things]))
+
+    def test_first_sync(self):
+        t1 = datetime.datetime(2013, 5, 1, 10, 0, 0, 500000)
+        t2 = datetime.datetime(2013, 5, 2, 10, 0, 0)
+        self.conn.iter_things.side_effect = [iter([thing("T1", "V1", t1), thing("T2", "V2", t2)]), iter([])]
+        counts = self.engine.sync(self.conn, [DataType.WEIGHT_MEASUREMENTS, DataType.DEVICES], self.handler)
+        self.assertEqual({DataType.WEIGHT_MEASUREMENTS: 2, DataType.DEVICES: 0}, counts)
+        self.assertEqual([mock.call(DataType.WEIGHT_MEASUREMENTS, updated_min=None, sections=['core', 'audits']),
+                          mock.call(DataType.DEVICES, updated_min=None, sections=['core', 'audits'])],
+                         self.conn.iter_things.call_args_list)
+        self.assertEqual([("RECORD", DataType.WEIGHT_MEASUREMENTS, ["T1", "T2"])], self.handled)
+        self.assertEqual({'updated': '2013-05-02T10:00:00.000000', 'versions': ['V2']},
+                         self.store.get("RECORD", DataType.WEIGHT_MEASUREMENTS))
+        self.assertIsNone(self.store.get("RECORD", DataType.DEVICES))
+
+    def test_next_sync(self):
+        mark = datetime.datetime(2013, 5, 2, 10, 0, 0, 250000)
+        self.store.put("RECORD", DataType.WEIGHT_MEASUREMENTS,
+                       {'updated': '2013-05-02T10:00:00.250000', 'versions': ['V2']})
+        later = datetime.datetime(2013, 5, 3)
+        # HealthVault returns T2 again because updated-date-min is inclusive
+        self.conn.iter_things.return_value = iter([thing("T2", "V2", mark), thing("T3", "V3", later)])
+        self.engine.sync(self.conn, [DataType.WEIGHT_MEASUREMENTS], self.handler)
+        self.assertEqual(mark, self.conn.iter_things.call_args[1]['updated_min'])
+        self.assertEqual([("RECORD", DataType.WEIGHT_MEASUREMENTS, ["T3"])], self.handled)
+        self.assertEqual({'updated': '2013-05-03T00:00:00.000000', 'versions': ['V3']},
+                         self.store.get("RECORD", DataType.WEIGHT_MEASUREMENTS))
+
+    def test_nothing_new(self):
+        checkpoint = {'updated': '2013-05-02T10:00:00.000000', 'versions': ['V2']}
+        self.store.put("RECORD", DataType.WEIGHT_MEASUREMENTS, checkpoint)
+        self.conn.iter_things.return_value = iter([thing("T2", "V2", datetime.datetime(2013, 5, 2, 10))])
+        self.engine.sync(self.conn, [DataType.WEIGHT_MEASUREMENTS], self.handler)
+        self.assertEqual([], self.handled)
+        self.assertEqual(checkpoint, self.store.get("RECORD", DataType.WEIGHT_MEASUREMENTS))
+
+    def test_handler_fails(self):
+        # The checkpoint doesn't move, so the same things are fetched next time
+        self.conn.iter_things.return_value = iter([thing("T1", "V1", datetime.datetime(2013, 5, 1))])
+
+        def handler(record_id, datatype, things):
+            raise ValueError("Database is down")
+        self.assertRaises(ValueError, self.engine.sync, self.conn, [DataType.WEIGHT_MEASUREMENTS], handler)
+        self.assertIsNone(self.store.get("RECORD", DataType.WEIGHT_MEASUREMENTS))
+
+    def test_paging_fails(self):
+        # Nothing is handled, and the checkpoint doesn't move, until every page is in
+        def pages(datatype, **kwargs):
+            yield thing("T2", "V2", datetime.datetime(2013, 5, 2))
+            raise ValueError("Connection reset")
+        self.conn.iter_things.side_effect = pages
+        self.assertRaises(ValueError, self.engine.sync, self.conn, [DataType.WEIGHT_MEASUREMENTS], self.handler)
+        self.assertEqual([], self.handled)
+        self.assertIsNone(self.store.get("RECORD", DataType.WEIGHT_MEASUREMENTS))
+
+
+class FileCheckpointStoreTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store(self):
+        path = os.path.join(self.dir, "checkpoints.json")
+        store = FileCheckpointStore(path)
+        self.assertIsNone(store.get("R1", "T1"))
+        store.put("R1", "T1", {'updated': 'A', 'versions': []})
+        store.put("R1", "T2", {'updated': 'B', 'versions': ['V']})
+        # A new store (e.g. after a restart) sees the same checkpoints
+        store = FileCheckpointStore(path)
+        self.assertEqual({'updated': 'A', 'versions': []}, store.get("R1", "T1"))
+        self.assertEqual({'updated': 'B', 'versions': ['V']}, store.get("R1", "T2"))
+        self.assertEqual(["checkpoints.json"], os.listdir(self.dir))